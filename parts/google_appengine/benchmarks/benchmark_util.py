@@ -0,0 +1,114 @@
+#!/usr/bin/env python
+#
+# Copyright 2007 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""Helpers shared by the benchmark scripts in this directory.
+
+Importing this module puts the SDK and its bundled libraries on sys.path, the
+same way the dev_appserver.py wrapper does, so the scripts can be run from
+any directory:
+
+  python benchmarks/memcache_concurrency.py
+"""
+
+
+
+import os
+import sys
+import threading
+import time
+
+DIR_PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+EXTRA_PATHS = [
+  DIR_PATH,
+  os.path.join(DIR_PATH, 'lib', 'antlr3'),
+  os.path.join(DIR_PATH, 'lib', 'django'),
+  os.path.join(DIR_PATH, 'lib', 'ipaddr'),
+  os.path.join(DIR_PATH, 'lib', 'webob'),
+  os.path.join(DIR_PATH, 'lib', 'yaml', 'lib'),
+]
+
+sys.path = EXTRA_PATHS + sys.path
+
+from google.appengine.api import apiproxy_stub_map
+
+
+def SetUpStubs(app_id='benchmark', **stubs):
+  """Installs a fresh APIProxyStubMap holding the given stubs.
+
+  Args:
+    app_id: The application ID to put in the environment.
+    stubs: Stubs to register, keyed by service name.
+
+  Returns:
+    The new APIProxyStubMap.
+  """
+  os.environ['APPLICATION_ID'] = app_id
+  os.environ.setdefault('SERVER_SOFTWARE', 'Development/benchmark')
+  os.environ.setdefault('AUTH_DOMAIN', 'gmail.com')
+  apiproxy_stub_map.apiproxy = apiproxy_stub_map.APIProxyStubMap()
+  for service, stub in stubs.iteritems():
+    apiproxy_stub_map.apiproxy.RegisterStub(service, stub)
+  return apiproxy_stub_map.apiproxy
+
+
+def Time(function, *args, **kwargs):
+  """Calls a function and returns how long it took, in seconds."""
+  start = time.time()
+  function(*args, **kwargs)
+  return time.time() - start
+
+
+def RunThreads(count, function, *args):
+  """Calls function(index, *args) on count threads and waits for them.
+
+  Returns:
+    The wall clock time, in seconds, until every thread finished.
+
+  Raises:
+    The first exception raised by any of the threads.
+  """
+  errors = []
+
+  def Run(index):
+    try:
+      function(index, *args)
+    except Exception:
+      errors.append(sys.exc_info())
+
+  threads = [threading.Thread(target=Run, args=(index,))
+             for index in xrange(count)]
+  start = time.time()
+  for thread in threads:
+    thread.start()
+  for thread in threads:
+    thread.join()
+  elapsed = time.time() - start
+  if errors:
+    raise errors[0][0], errors[0][1], errors[0][2]
+  return elapsed
+
+
+def PrintTable(headers, rows):
+  """Prints rows of values as a plain text table with aligned columns."""
+  rows = [[str(value) for value in row] for row in rows]
+  widths = [max([len(header)] + [len(row[i]) for row in rows])
+            for i, header in enumerate(headers)]
+  print '  '.join(header.ljust(width)
+                  for header, width in zip(headers, widths))
+  for row in rows:
+    print '  '.join(value.ljust(width) for value, width in zip(row, widths))
@@ -0,0 +1,186 @@
+#!/usr/bin/env python
+#
+# Copyright 2007 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""Compares ways of keeping a hot counter under contention, using the stubs.
+
+  %(script)s [threads [seconds]]
+
+Threads increment one counter for the given number of seconds (default
+%(seconds)d) while a TaskExecutor runs the deferred tasks, first on one
+thread and then on the given number of threads (default %(threads)d). The
+counter is kept with:
+
+  ext.counter           google.appengine.ext.counter, flushing every second.
+  entity per incr       a datastore transaction on one entity per increment.
+  incr + deferred       memcache.incr(), with a deferred task that reads the
+                        memcache value, adds it to an entity and resets it
+                        to zero, as hand-written counters often do.
+
+Once the threads stop and the pending tasks have run, the stored count is
+compared with the number of increments made.
+"""
+
+
+
+import logging
+import os
+import sys
+import time
+
+import benchmark_util
+
+from google.appengine.api import datastore_file_stub
+from google.appengine.api import memcache
+from google.appengine.api.labs.taskqueue import taskqueue_executor
+from google.appengine.api.labs.taskqueue import taskqueue_stub
+from google.appengine.api.memcache import memcache_stub
+from google.appengine.ext import counter
+from google.appengine.ext import db
+from google.appengine.ext import deferred
+
+DEFAULT_THREADS = 8
+DEFAULT_SECONDS = 4
+FLUSH_SECONDS = 1
+NAME = 'hits'
+
+
+class _Count(db.Model):
+  """A counter stored in a single entity."""
+  count = db.IntegerProperty(default=0)
+
+
+def _AddToEntity(delta):
+  """Adds to the single entity counter. Runs in a transaction."""
+  entity = _Count.get_by_key_name(NAME)
+  if entity is None:
+    entity = _Count(key_name=NAME)
+  entity.count += delta
+  entity.put()
+
+
+def _EntityCount():
+  """Returns the value of the single entity counter."""
+  entity = _Count.get_by_key_name(NAME)
+  return entity and entity.count or 0
+
+
+def IncrCounter():
+  """Increments the ext.counter counter."""
+  counter.incr(NAME)
+
+
+def DrainCounter():
+  """Flushes the pending deltas of the ext.counter counter."""
+  counter.flush([NAME])
+
+
+def ReadCounter():
+  """Returns the value of the ext.counter counter."""
+  return counter.get_count(NAME)
+
+
+def IncrEntity():
+  """Increments the single entity counter in its own transaction."""
+  db.run_in_transaction(_AddToEntity, 1)
+
+
+def IncrMemcache():
+  """Increments the memcache count, deferring a store on the first one."""
+  if memcache.incr(NAME, initial_value=0) == 1:
+    deferred.defer(StoreMemcache, _countdown=FLUSH_SECONDS)
+
+
+def StoreMemcache():
+  """Moves the memcache count to the entity, losing increments in between."""
+  value = memcache.get(NAME)
+  if value:
+    db.run_in_transaction(_AddToEntity, int(value))
+    memcache.set(NAME, 0)
+
+
+APPROACHES = [
+    ('ext.counter', IncrCounter, DrainCounter, ReadCounter),
+    ('entity per incr', IncrEntity, None, _EntityCount),
+    ('incr + deferred', IncrMemcache, StoreMemcache, _EntityCount),
+]
+
+
+def Run(incr_function, drain_function, read_function, threads, seconds):
+  """Runs one approach on new stubs.
+
+  Returns:
+    (increments per second, increments made, count stored)
+  """
+  taskqueue = taskqueue_stub.TaskQueueServiceStub(root_path=None)
+  benchmark_util.SetUpStubs(
+      datastore_v3=datastore_file_stub.DatastoreFileStub('benchmark', None),
+      memcache=memcache_stub.MemcacheServiceStub(),
+      taskqueue=taskqueue)
+  executor = taskqueue_executor.TaskExecutor(
+      taskqueue, taskqueue_executor.WsgiDispatcher(deferred.application))
+  executor.Start()
+
+  counts = [0] * threads
+  deadline = time.time() + seconds
+
+  def Increment(index):
+    while time.time() < deadline:
+      incr_function()
+      counts[index] += 1
+
+  try:
+    elapsed = benchmark_util.RunThreads(threads, Increment)
+    while taskqueue.GetTasks('default'):
+      time.sleep(0.1)
+  finally:
+    executor.Stop()
+  if drain_function is not None:
+    drain_function()
+  made = sum(counts)
+  return made / elapsed, made, read_function()
+
+
+def main(argv):
+  threads = DEFAULT_THREADS
+  seconds = DEFAULT_SECONDS
+  try:
+    if len(argv) > 1:
+      threads = int(argv[1])
+    if len(argv) > 2:
+      seconds = float(argv[2])
+  except ValueError:
+    print >>sys.stderr, __doc__ % {'script': os.path.basename(argv[0]),
+                                   'threads': DEFAULT_THREADS,
+                                   'seconds': DEFAULT_SECONDS}
+    return 1
+
+  logging.getLogger().setLevel(logging.WARNING)
+  counter.FLUSH_SECONDS = FLUSH_SECONDS
+  rows = []
+  for name, incr_function, drain_function, read_function in APPROACHES:
+    for thread_count in sorted(set([1, threads])):
+      rate, made, stored = Run(incr_function, drain_function, read_function,
+                               thread_count, seconds)
+      rows.append([name, thread_count, '%.0f' % rate, made, stored,
+                   made - stored])
+  benchmark_util.PrintTable(
+      ['approach', 'threads', 'incr/s', 'made', 'stored', 'lost'], rows)
+  return 0
+
+
+if __name__ == '__main__':
+  sys.exit(main(sys.argv))
@@ -0,0 +1,183 @@
+#!/usr/bin/env python
+#
+# Copyright 2007 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""Compares groc schedule matching with the implementation it replaced.
+
+  %(script)s [matches]
+
+First checks that groctimespecification and groctimespecification_old, the
+version from before schedules were compiled into year calendars, give the
+same matches for a set of awkward schedules from many start times. Then
+times previewing the given number of runs (default %(matches)d) of each of
+a few hundred schedules with GetMatches(), as an admin page listing future
+cron runs would, with each implementation. Schedules limited to some months
+are timed apart from the others, since their previews span hundreds of
+years and so are dominated by building the calendar of each year.
+"""
+
+
+
+import datetime
+import os
+import sys
+
+import benchmark_util
+import groctimespecification_old
+
+from google.appengine.cron import groctimespecification
+
+DEFAULT_MATCHES = 1000
+CHECK_MATCHES = 12
+
+CHECK_SCHEDULES = [
+    'every 20 mins',
+    'every day 00:00',
+    '29 of february 12:00',
+    '5th friday of month 23:59',
+    '31 of month 06:30',
+    '1,15 of jan,jul 10:00',
+    '1st,3rd monday of month 09:00',
+    'every monday,wednesday 17:00',
+    '2nd tuesday of mar,jun,sep,dec 01:00',
+    '4th,5th saturday,sunday of feb 18:45',
+    '30,31 of month 00:01',
+]
+
+ORDINALS = ['1st', '2nd', '3rd', '4th', '5th', '1st,3rd', '2nd,4th',
+            '1st,5th']
+WEEKDAYS = ['monday', 'friday', 'saturday,sunday', 'tuesday,thursday']
+MONTHS = ['month', 'jan,apr,jul,oct', 'feb', 'dec']
+MONTHDAYS = ['1', '15', '28', '29', '30', '31', '1,15', '10,20,30']
+
+
+def BenchmarkSchedules():
+  """Returns the schedules to time, grouped by the months they run in.
+
+  Returns:
+    A list of (description, list of schedules) tuples.
+  """
+  monthly = []
+  yearly = []
+  for month in MONTHS:
+    schedules = monthly
+    if month != 'month':
+      schedules = yearly
+    for ordinal in ORDINALS:
+      for weekday in WEEKDAYS:
+        schedules.append('%s %s of %s 09:30' % (ordinal, weekday, month))
+    for monthday in MONTHDAYS:
+      if month == 'month':
+        schedules.append('%s of month 03:00' % monthday)
+      else:
+        schedules.append('%s of %s 03:00' % (monthday, month))
+  for weekday in WEEKDAYS:
+    monthly.append('every %s 12:00' % weekday)
+  monthly.append('every day 00:00')
+  return [('of every month', monthly), ('of some months', yearly)]
+
+
+def CheckStartTimes():
+  """Returns start times around month, year and leap day boundaries."""
+  starts = []
+  for year in (2008, 2009, 2011, 2012):
+    for month in xrange(1, 13):
+      first = datetime.datetime(year, month, 1)
+      starts.append(first)
+      starts.append(first - datetime.timedelta(minutes=1))
+      starts.append(first + datetime.timedelta(days=27, hours=23))
+      starts.append(first + datetime.timedelta(days=14, hours=9, minutes=30))
+  starts.append(datetime.datetime(2012, 2, 29, 12, 0))
+  starts.append(datetime.datetime(2012, 2, 29, 11, 59))
+  starts.append(datetime.datetime(2099, 12, 31, 23, 59))
+  return starts
+
+
+def Check():
+  """Returns a list of the schedules and starts the implementations differ on.
+  """
+  differences = []
+  for schedule in CHECK_SCHEDULES:
+    old = groctimespecification_old.GrocTimeSpecification(schedule)
+    new = groctimespecification.GrocTimeSpecification(schedule)
+    for start in CheckStartTimes():
+      if (old.GetMatches(start, CHECK_MATCHES) !=
+          new.GetMatches(start, CHECK_MATCHES)):
+        differences.append((schedule, start))
+  return differences
+
+
+PREVIEW_START = datetime.datetime(2010, 1, 1)
+
+
+def PreviewableSchedules(schedules, matches):
+  """Leaves out the schedules whose matches would run past datetime.MAXYEAR.
+
+  Schedules such as '29 of feb' or '5th monday of feb' match so rarely that
+  a thousand of their matches do not fit in the years a datetime can hold.
+  """
+  previewable = []
+  for schedule in schedules:
+    try:
+      groctimespecification.GrocTimeSpecification(schedule).GetMatches(
+          PREVIEW_START, matches)
+    except (ValueError, OverflowError):
+      continue
+    previewable.append(schedule)
+  groctimespecification._year_calendars.clear()
+  return previewable
+
+
+def Preview(module, schedules, matches):
+  """Gets the next matches of every schedule with a groc module."""
+  start = PREVIEW_START
+  for schedule in schedules:
+    module.GrocTimeSpecification(schedule).GetMatches(start, matches)
+
+
+def main(argv):
+  matches = DEFAULT_MATCHES
+  try:
+    if len(argv) > 1:
+      matches = int(argv[1])
+  except ValueError:
+    print >>sys.stderr, __doc__ % {'script': os.path.basename(argv[0]),
+                                   'matches': DEFAULT_MATCHES}
+    return 1
+
+  differences = Check()
+  for schedule, start in differences:
+    print >>sys.stderr, 'Matches of %r after %s differ' % (schedule, start)
+  print 'checked %d schedules from %d start times: %s' % (
+      len(CHECK_SCHEDULES), len(CheckStartTimes()),
+      differences and 'DIFFERENT' or 'same matches')
+
+  rows = []
+  for description, schedules in BenchmarkSchedules():
+    schedules = PreviewableSchedules(schedules, matches)
+    old_seconds = benchmark_util.Time(Preview, groctimespecification_old,
+                                      schedules, matches)
+    new_seconds = benchmark_util.Time(Preview, groctimespecification,
+                                      schedules, matches)
+    rows.append([description, len(schedules), matches, '%.2f' % old_seconds,
+                 '%.2f' % new_seconds, '%.1fx' % (old_seconds / new_seconds)])
+  benchmark_util.PrintTable(['schedules', 'count', 'matches', 'old seconds',
+                             'new seconds', 'speedup'], rows)
+  return differences and 1 or 0
+
+
+if __name__ == '__main__':
+  sys.exit(main(sys.argv))
@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+#
+# Copyright 2007 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""Compares compare-and-set with add()-based locking under contention.
+
+  %(script)s [threads [updates]]
+
+Each of the given number of threads (default %(threads)d) applies updates
+read-modify-write updates to one value in a MemcacheServiceStub, either with
+a gets()/cas() retry loop or by taking a lock key with add() around a
+get()/set() and releasing it with delete(). Both must keep every update.
+"""
+
+
+
+import os
+import sys
+import time
+
+import benchmark_util
+
+from google.appengine.api import memcache
+from google.appengine.api.memcache import memcache_stub
+
+DEFAULT_THREADS = 8
+DEFAULT_UPDATES = 300
+KEY = 'value'
+LOCK_KEY = 'value-lock'
+
+
+def UpdateWithCas(index, updates):
+  """Increments the value with a gets()/cas() retry loop."""
+  client = memcache.Client()
+  for _ in xrange(updates):
+    while True:
+      value = client.gets(KEY)
+      if client.cas(KEY, value + 1):
+        break
+
+
+def UpdateWithAddLock(index, updates):
+  """Increments the value while holding a lock key taken with add()."""
+  client = memcache.Client()
+  for _ in xrange(updates):
+    while not client.add(LOCK_KEY, index, time=10):
+      time.sleep(0)
+    try:
+      client.set(KEY, client.get(KEY) + 1)
+    finally:
+      client.delete(LOCK_KEY)
+
+
+def Run(update_function, threads, updates):
+  """Runs one approach on a new stub.
+
+  Returns:
+    (elapsed seconds, final value)
+  """
+  benchmark_util.SetUpStubs(memcache=memcache_stub.MemcacheServiceStub())
+  memcache.set(KEY, 0)
+  elapsed = benchmark_util.RunThreads(threads, update_function, updates)
+  return elapsed, memcache.get(KEY)
+
+
+def main(argv):
+  threads = DEFAULT_THREADS
+  updates = DEFAULT_UPDATES
+  try:
+    if len(argv) > 1:
+      threads = int(argv[1])
+    if len(argv) > 2:
+      updates = int(argv[2])
+  except ValueError:
+    print >>sys.stderr, __doc__ % {'script': os.path.basename(argv[0]),
+                                   'threads': DEFAULT_THREADS}
+    return 1
+
+  rows = []
+  failed = False
+  for name, update_function in (('gets/cas', UpdateWithCas),
+                                ('add lock', UpdateWithAddLock)):
+    elapsed, value = Run(update_function, threads, updates)
+    ok = value == threads * updates
+    failed = failed or not ok
+    rows.append([name, threads, value, '%.2f' % elapsed,
+                 '%.0f' % (threads * updates / elapsed),
+                 ok and 'ok' or 'FAIL'])
+  benchmark_util.PrintTable(
+      ['approach', 'threads', 'updates kept', 'seconds', 'updates/s',
+       'result'], rows)
+  return failed and 1 or 0
+
+
+if __name__ == '__main__':
+  sys.exit(main(sys.argv))
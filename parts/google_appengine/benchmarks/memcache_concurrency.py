@@ -0,0 +1,120 @@
+#!/usr/bin/env python
+#
+# Copyright 2007 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""Hammers a MemcacheServiceStub from several threads.
+
+  %(script)s [threads [rounds]]
+
+Each thread runs rounds of a mix of calls: incr of a counter shared by all
+threads, incr of ten counters in one offset_multi, an add of a key every
+thread tries to add, a set, a get_multi and a delete. The mix is timed on
+one thread and on the given number of threads (default %(threads)d), and
+the results are checked: every increment must be kept and each added key
+must be stored by exactly one thread.
+"""
+
+
+
+import os
+import sys
+
+import benchmark_util
+
+from google.appengine.api import memcache
+from google.appengine.api.memcache import memcache_stub
+
+DEFAULT_THREADS = 8
+DEFAULT_ROUNDS = 2000
+COUNTERS = 10
+
+
+def RunMix(index, rounds, added):
+  """Runs rounds of the call mix on one thread.
+
+  Args:
+    index: The number of the thread.
+    rounds: How many times to run the mix.
+    added: List that the keys this thread added are appended to.
+  """
+  client = memcache.Client()
+  counters = dict(('counter%d' % i, 1) for i in xrange(COUNTERS))
+  own_key = 'thread%d' % index
+  for i in xrange(rounds):
+    client.incr('shared', initial_value=0)
+    client.offset_multi(counters, initial_value=0)
+    if client.add('add%d' % i, index):
+      added.append(i)
+    client.set(own_key, i)
+    client.get_multi([own_key, 'shared', 'add%d' % i])
+    client.delete(own_key)
+
+
+def Run(threads, rounds):
+  """Runs the mix on a new stub and checks the results.
+
+  Returns:
+    (elapsed seconds, list of problems found)
+  """
+  benchmark_util.SetUpStubs(memcache=memcache_stub.MemcacheServiceStub())
+  added = []
+  elapsed = benchmark_util.RunThreads(threads, RunMix, rounds, added)
+
+  problems = []
+  expected = threads * rounds
+  client = memcache.Client()
+  shared = int(client.get('shared') or 0)
+  if shared != expected:
+    problems.append('shared counter is %s, expected %d' % (shared, expected))
+  for name, value in client.get_multi(
+      ['counter%d' % i for i in xrange(COUNTERS)]).iteritems():
+    if int(value) != expected:
+      problems.append('%s is %s, expected %d' % (name, value, expected))
+  if sorted(added) != range(rounds):
+    problems.append('%d adds succeeded, expected %d' % (len(added), rounds))
+  return elapsed, problems
+
+
+def main(argv):
+  threads = DEFAULT_THREADS
+  rounds = DEFAULT_ROUNDS
+  try:
+    if len(argv) > 1:
+      threads = int(argv[1])
+    if len(argv) > 2:
+      rounds = int(argv[2])
+  except ValueError:
+    print >>sys.stderr, __doc__ % {'script': os.path.basename(argv[0]),
+                                   'threads': DEFAULT_THREADS}
+    return 1
+
+  rows = []
+  failed = False
+  for thread_count in sorted(set([1, threads])):
+    elapsed, problems = Run(thread_count, rounds)
+    calls = thread_count * rounds * 6
+    rows.append([thread_count, rounds, '%.2f' % elapsed,
+                 '%.0f' % (calls / elapsed), problems and 'FAIL' or 'ok'])
+    for problem in problems:
+      print >>sys.stderr, '%d threads: %s' % (thread_count, problem)
+      failed = True
+  benchmark_util.PrintTable(
+      ['threads', 'rounds', 'seconds', 'calls/s', 'result'], rows)
+  return failed and 1 or 0
+
+
+if __name__ == '__main__':
+  sys.exit(main(sys.argv))
@@ -0,0 +1,177 @@
+#!/usr/bin/env python
+#
+# Copyright 2007 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""Measures how long a persistent MemcacheServiceStub takes to restart.
+
+  %(script)s [keys]
+
+Fills a stub created with a persistence_path with the given number of keys
+(default %(keys)d) holding short values that expire in an hour, writes a
+snapshot, changes a tenth of the keys so that the log has to be replayed as
+well, and then times creating a new stub from the same files. The restored
+cache is checked against the one that was written.
+
+Last, checks a restart after a process died while appending to the log: the
+end of a log is cut off, and the changes made after restarting from it must
+survive another restart.
+"""
+
+
+
+import os
+import shutil
+import sys
+import tempfile
+
+import benchmark_util
+
+from google.appengine.api import memcache
+from google.appengine.api.memcache import memcache_stub
+
+DEFAULT_KEYS = 1000000
+BATCH_SIZE = 1000
+EXPIRATION_SECONDS = 3600
+
+
+def Fill(keys):
+  """Stores keys through set_multi, in batches."""
+  client = memcache.Client()
+  for start in xrange(0, keys, BATCH_SIZE):
+    client.set_multi(dict(('key%d' % i, 'value%05d' % (i % 100000))
+                          for i in xrange(start, min(start + BATCH_SIZE, keys))),
+                     time=EXPIRATION_SECONDS)
+
+
+def ChangeSome(keys):
+  """Overwrites every tenth key and deletes every hundredth one."""
+  client = memcache.Client()
+  for start in xrange(0, keys, BATCH_SIZE * 10):
+    end = min(start + BATCH_SIZE * 10, keys)
+    client.set_multi(dict(('key%d' % i, 'changed') for i in
+                          xrange(start, end, 10)), time=EXPIRATION_SECONDS)
+    client.delete_multi(['key%d' % i for i in xrange(start, end, 100)])
+
+
+def Expected(i):
+  """Returns the value key i should have after ChangeSome(), or None."""
+  if i % 100 == 0:
+    return None
+  if i % 10 == 0:
+    return 'changed'
+  return 'value%05d' % (i % 100000)
+
+
+def Check(keys):
+  """Returns how many keys do not have the value Expected() gives."""
+  client = memcache.Client()
+  failed = 0
+  for start in xrange(0, keys, BATCH_SIZE):
+    names = ['key%d' % i for i in xrange(start, min(start + BATCH_SIZE, keys))]
+    values = client.get_multi(names)
+    for i, name in enumerate(names):
+      if values.get(name) != Expected(start + i):
+        failed += 1
+  return failed
+
+
+def CheckTornLog(path):
+  """Restarts a stub from a log whose end was cut off, twice.
+
+  Args:
+    path: The persistence_path to use; must not exist yet.
+
+  Returns:
+    A list of the problems found.
+  """
+  benchmark_util.SetUpStubs(
+      memcache=memcache_stub.MemcacheServiceStub(persistence_path=path))
+  client = memcache.Client()
+  client.set_multi(dict(('kept%d' % i, i) for i in xrange(10)))
+  client.set('torn', 'lost')
+  log_size = os.path.getsize(path + '.log')
+
+  log_file = open(path + '.log', 'r+b')
+  try:
+    log_file.truncate(log_size - 3)
+  finally:
+    log_file.close()
+  benchmark_util.SetUpStubs(
+      memcache=memcache_stub.MemcacheServiceStub(persistence_path=path))
+  client.set('after', 'restart')
+
+  benchmark_util.SetUpStubs(
+      memcache=memcache_stub.MemcacheServiceStub(persistence_path=path))
+  problems = []
+  if client.get_multi(['kept%d' % i for i in xrange(10)]) != dict(
+      ('kept%d' % i, i) for i in xrange(10)):
+    problems.append('keys written before the cut were not restored')
+  if client.get('torn') is not None:
+    problems.append('the key cut off the log was restored')
+  if client.get('after') != 'restart':
+    problems.append('the key set after restarting from a cut log was lost')
+  return problems
+
+
+def main(argv):
+  keys = DEFAULT_KEYS
+  try:
+    if len(argv) > 1:
+      keys = int(argv[1])
+  except ValueError:
+    print >>sys.stderr, __doc__ % {'script': os.path.basename(argv[0]),
+                                   'keys': DEFAULT_KEYS}
+    return 1
+
+  temp_dir = tempfile.mkdtemp()
+  try:
+    path = os.path.join(temp_dir, 'memcache')
+    stub = memcache_stub.MemcacheServiceStub(persistence_path=path)
+    benchmark_util.SetUpStubs(memcache=stub)
+    rows = [['fill through set_multi', '%.2f' % benchmark_util.Time(Fill, keys)]]
+    rows.append(['Snapshot()', '%.2f' % benchmark_util.Time(stub.Snapshot)])
+    rows.append(['change 10% of the keys',
+                 '%.2f' % benchmark_util.Time(ChangeSome, keys)])
+    snapshot_mb = os.path.getsize(path) / 1048576.0
+    log_mb = os.path.getsize(path + '.log') / 1048576.0
+    del stub
+
+    restored = []
+    restore_seconds = benchmark_util.Time(
+        lambda: restored.append(
+            memcache_stub.MemcacheServiceStub(persistence_path=path)))
+    rows.append(['restore', '%.2f' % restore_seconds])
+    benchmark_util.SetUpStubs(memcache=restored[0])
+
+    benchmark_util.PrintTable(['step', 'seconds'], rows)
+    print 'snapshot %.1f MB, log %.1f MB' % (snapshot_mb, log_mb)
+    failed = Check(keys)
+    problems = CheckTornLog(os.path.join(temp_dir, 'torn'))
+  finally:
+    shutil.rmtree(temp_dir, ignore_errors=True)
+
+  for problem in problems:
+    print >>sys.stderr, 'cut log: %s' % problem
+  if failed:
+    print >>sys.stderr, '%d keys were not restored correctly' % failed
+  if failed or problems:
+    return 1
+  print 'all %d keys restored correctly, cut log recovered' % keys
+  return 0
+
+
+if __name__ == '__main__':
+  sys.exit(main(sys.argv))
@@ -36,6 +36,7 @@ per-transaction, so they should only be used by one tx at a time.
 
 
 import datetime
+import heapq
 import logging
 import md5
 import os
@@ -43,6 +44,7 @@ import struct
 import sys
 import tempfile
 import threading
+import time
 import urllib
 import warnings
 try:
@@ -98,6 +100,12 @@ _MAX_ACTIONS_PER_TXN = 5
 _CURSOR_CONCAT_STR = '!CURSOR!'
 
 
+_MAX_OPEN_CURSORS = 100
+
+
+_CURSOR_TIMEOUT_SECONDS = 300
+
+
 class _StoredEntity(object):
   """Simple wrapper around an entity stored by the stub.
 
@@ -123,17 +131,22 @@ class _StoredEntity(object):
 class _Cursor(object):
   """A query cursor.
 
+  The cursor shares the query's sorted result list rather than copying it, and
+  only tracks its position within that list. The list is released as soon as
+  the cursor has been exhausted.
+
   Public properties:
     cursor: the integer cursor
     count: the original total number of results
     keys_only: whether the query is keys_only
     app: the app for which this cursor was created
+    last_access: time.time() when this cursor was created or last read
 
   Class attributes:
     _next_cursor: the next cursor to allocate
     _next_cursor_lock: protects _next_cursor
     _offset: the internal index for where we are in the results
-    _limit: the limit on the original query, used to track remaining results
+    _end: the index one past the last result this cursor may return
   """
   _next_cursor = 1
   _next_cursor_lock = threading.Lock()
@@ -161,23 +174,27 @@ class _Cursor(object):
     if query.has_offset():
       offset += query.offset()
 
+    offset = min(offset, len(results))
     if offset > 0:
       self.__last_result = results[offset - 1]
     else:
       self.__last_result = cursor_entity
 
     if query.has_limit():
-      self.__results = results[offset:offset + query.limit()]
+      end = min(offset + query.limit(), len(results))
     else:
-      self.__results = results[offset:]
+      end = len(results)
 
+    self.__results = results
     self.__query = query
-    self.__offset = 0
+    self.__offset = offset
+    self.__end = end
 
     self.app = query.app()
     self.keys_only = query.keys_only()
-    self.count = len(self.__results)
+    self.count = end - offset
     self.cursor = self._AcquireCursorID()
+    self.last_access = time.time()
 
   def _AcquireCursorID(self):
     """Acquires the next cursor id in a thread safe manner.
@@ -316,6 +333,21 @@ class _Cursor(object):
     elif self.__query.has_compiled_cursor:
       compiled_cursor.CopyFrom(self.__query.compiled_cursor())
 
+  @staticmethod
+  def _KeyOnlyPb(entity):
+    """Converts an entity into the key-only form returned by keys_only queries.
+
+    Args:
+      entity: datastore.Entity
+
+    Returns:
+      entity_pb.EntityProto with only the key and entity group set
+    """
+    pb = entity_pb.EntityProto()
+    pb.mutable_key().CopyFrom(entity.key()._ToPb())
+    pb.mutable_entity_group().add_element().CopyFrom(pb.key().path().element(0))
+    return pb
+
   def PopulateQueryResult(self, result, count, compile=False):
     """Populates a QueryResult with this cursor and the given number of results.
 
@@ -331,20 +363,95 @@ class _Cursor(object):
     result.mutable_cursor().set_cursor(self.cursor)
     result.set_keys_only(self.keys_only)
 
-    results = self.__results[self.__offset:self.__offset + count]
+    self.last_access = time.time()
+
+    if self.__results is not None:
+      stop = min(self.__offset + count, self.__end)
+      results = self.__results[self.__offset:stop]
+    else:
+      results = []
     count = len(results)
     if count:
       self.__offset += count
       self.__last_result = results[count - 1]
 
-    results_pbs = [r._ToPb() for r in results]
+    if self.keys_only:
+      results_pbs = [self._KeyOnlyPb(r) for r in results]
+    else:
+      results_pbs = [r._ToPb() for r in results]
     result.result_list().extend(results_pbs)
 
-    result.set_more_results(self.__offset < self.count)
+    more_results = self.__offset < self.__end
+    if not more_results:
+      self.__results = None
+    result.set_more_results(more_results)
     if compile:
       self._EncodeCompiledCursor(self.__query, result.mutable_compiled_cursor())
 
 
+class _Descending(object):
+  """Wraps a sort key so that it sorts in reverse order."""
+
+  __slots__ = ('value',)
+
+  def __init__(self, value):
+    self.value = value
+
+  def __cmp__(self, other):
+    return cmp(other.value, self.value)
+
+
+def _EntitySortKey(orders):
+  """Returns a function that gives the sort key of an entity for some orders.
+
+  Entities are ordered according to the orders, falling back to key order.
+  Values of different types are ordered by the tag numbers in the
+  PropertyValue PB, matching the type ordering used in the real datastore.
+
+  Args:
+    orders: list of datastore_pb.Query_Order, as normalized by
+      datastore_index.Normalize()
+
+  Returns:
+    A function that takes a datastore.Entity and returns its sort key.
+  """
+  order_props = [(o.property().decode('utf-8'),
+                  o.direction() is datastore_pb.Query_Order.DESCENDING)
+                 for o in orders]
+  type_tags = DatastoreFileStub._PROPERTY_TYPE_TAGS
+
+  def property_sort_key(value):
+    """Returns the sort key for a single property value."""
+    if isinstance(value, datetime.datetime):
+      value = datastore_types.DatetimeToTimestamp(value)
+    return (type_tags.get(value.__class__), value)
+
+  def entity_sort_key(entity):
+    """Returns the sort key for an entity."""
+    sort_key = []
+    for prop, descending in order_props:
+      value = datastore._GetPropertyValue(entity, prop)
+      if isinstance(value, list):
+        values = [property_sort_key(v) for v in value]
+        if descending:
+          value = max(values)
+        else:
+          value = min(values)
+      else:
+        value = property_sort_key(value)
+
+      if descending:
+        value = _Descending(value)
+      sort_key.append(value)
+
+    reference = entity.key()._Key__reference
+    sort_key.append(reference.app())
+    sort_key.extend(entity.key().to_path(_default_id=0))
+    return sort_key
+
+  return entity_sort_key
+
+
 class DatastoreFileStub(apiproxy_stub.APIProxyStub):
   """ Persistent stub for the Python datastore API.
 
@@ -445,6 +552,7 @@ class DatastoreFileStub(apiproxy_stub.APIProxyStub):
     self.__entities_lock = threading.Lock()
     self.__file_lock = threading.Lock()
     self.__indexes_lock = threading.Lock()
+    self.__cursor_lock = threading.Lock()
 
     self.Read()
 
@@ -531,17 +639,21 @@ class DatastoreFileStub(apiproxy_stub.APIProxyStub):
     return (datastore_types.EncodeAppIdNamespace(key.app(), key.name_space()),
         last_path.type())
 
-  def _StoreEntity(self, entity):
+  def _StoreEntity(self, entity, app_kind=None):
     """ Store the given entity.
 
     Args:
-      entity: entity_pb.EntityProto
+      entity: entity_pb.EntityProto, or an already wrapped _StoredEntity
+      app_kind: the (app, kind) tuple for the entity's key, if already known
     """
-    key = entity.key()
-    app_kind = self._AppIdNamespaceKindForKey(key)
+    if not isinstance(entity, _StoredEntity):
+      entity = _StoredEntity(entity)
+    key = entity.protobuf.key()
+    if app_kind is None:
+      app_kind = self._AppIdNamespaceKindForKey(key)
     if app_kind not in self.__entities:
       self.__entities[app_kind] = {}
-    self.__entities[app_kind][key] = _StoredEntity(entity)
+    self.__entities[app_kind][key] = entity
 
     if app_kind in self.__schema_cache:
       del self.__schema_cache[app_kind]
@@ -685,6 +797,8 @@ class DatastoreFileStub(apiproxy_stub.APIProxyStub):
       self.__ValidateTransaction(put_request.transaction())
 
     clones = []
+    incomplete = []
+    uids = {}
     for entity in put_request.entity_list():
       self.__ValidateKey(entity.key())
 
@@ -693,8 +807,12 @@ class DatastoreFileStub(apiproxy_stub.APIProxyStub):
 
       for property in clone.property_list() + clone.raw_property_list():
         if property.value().has_uservalue():
-          uid = md5.new(property.value().uservalue().email().lower()).digest()
-          uid = '1' + ''.join(['%02d' % ord(x) for x in uid])[:20]
+          email = property.value().uservalue().email().lower()
+          uid = uids.get(email)
+          if uid is None:
+            uid = md5.new(email).digest()
+            uid = '1' + ''.join(['%02d' % ord(x) for x in uid])[:20]
+            uids[email] = uid
           property.mutable_value().mutable_uservalue().set_obfuscated_gaiaid(
               uid)
 
@@ -705,25 +823,35 @@ class DatastoreFileStub(apiproxy_stub.APIProxyStub):
 
       last_path = clone.key().path().element_list()[-1]
       if last_path.id() == 0 and not last_path.has_name():
-        self.__id_lock.acquire()
-        last_path.set_id(self.__next_id)
-        self.__next_id += 1
+        incomplete.append(clone)
+      else:
+        assert (clone.has_entity_group() and
+                clone.entity_group().element_size() > 0)
+
+    if incomplete:
+      self.__id_lock.acquire()
+      try:
+        next_id = self.__next_id
+        self.__next_id += len(incomplete)
+      finally:
         self.__id_lock.release()
 
+      for clone in incomplete:
+        clone.key().path().element_list()[-1].set_id(next_id)
+        next_id += 1
+
         assert clone.entity_group().element_size() == 0
         group = clone.mutable_entity_group()
         root = clone.key().path().element(0)
         group.add_element().CopyFrom(root)
 
-      else:
-        assert (clone.has_entity_group() and
-                clone.entity_group().element_size() > 0)
+    stored = [(self._AppIdNamespaceKindForKey(clone.key()),
+               _StoredEntity(clone)) for clone in clones]
 
     self.__entities_lock.acquire()
-
     try:
-      for clone in clones:
-        self._StoreEntity(clone)
+      for app_kind, stored_entity in stored:
+        self._StoreEntity(stored_entity, app_kind)
     finally:
       self.__entities_lock.release()
 
@@ -758,11 +886,14 @@ class DatastoreFileStub(apiproxy_stub.APIProxyStub):
     if delete_request.has_transaction():
       self.__ValidateTransaction(delete_request.transaction())
 
+    keys = []
+    for key in delete_request.key_list():
+      self.__ValidateAppId(key.app())
+      keys.append((self._AppIdNamespaceKindForKey(key), key))
+
     self.__entities_lock.acquire()
     try:
-      for key in delete_request.key_list():
-        self.__ValidateAppId(key.app())
-        app_kind = self._AppIdNamespaceKindForKey(key)
+      for app_kind, key in keys:
         try:
           del self.__entities[app_kind][key]
           if not self.__entities[app_kind]:
@@ -771,14 +902,45 @@ class DatastoreFileStub(apiproxy_stub.APIProxyStub):
           del self.__schema_cache[app_kind]
         except KeyError:
           pass
-
-        if not delete_request.has_transaction():
-          self.__WriteDatastore()
     finally:
       self.__entities_lock.release()
 
+    if keys and not delete_request.has_transaction():
+      self.__WriteDatastore()
+
 
   def _Dynamic_RunQuery(self, query, query_result):
+    results, order_compare_entities = self.__ExecuteQuery(query)
+
+    cursor = _Cursor(query, results, order_compare_entities)
+    self.__AddCursor(cursor)
+
+    if query.has_count():
+      count = query.count()
+    elif query.has_limit():
+      count = query.limit()
+    else:
+      count = _BATCH_SIZE
+
+    cursor.PopulateQueryResult(query_result, count, compile=query.compile())
+
+    if query.compile():
+      compiled_query = query_result.mutable_compiled_query()
+      compiled_query.set_keys_only(query.keys_only())
+      compiled_query.mutable_primaryscan().set_index_name(query.Encode())
+
+  def __ExecuteQuery(self, query, sort=True):
+    """Finds the entities that match a query.
+
+    Args:
+      query: datastore_pb.Query
+      sort: boolean, whether to sort the results in query order. Callers that
+        only need the number of results can skip the sort.
+
+    Returns:
+      (results, order_compare_entities): a list of datastore.Entity and a
+      __cmp__ function for datastore.Entity that follows the query's sort order.
+    """
     if query.has_transaction():
       self.__ValidateTransaction(query.transaction())
       if not query.has_ancestor():
@@ -940,59 +1102,21 @@ class DatastoreFileStub(apiproxy_stub.APIProxyStub):
       prop = order.property().decode('utf-8')
       results = [entity for entity in results if has_prop_indexed(entity, prop)]
 
+    entity_sort_key = _EntitySortKey(orders)
+
     def order_compare_entities(a, b):
       """ Return a negative, zero or positive number depending on whether
       entity a is considered smaller than, equal to, or larger than b,
       according to the query's orderings. """
-      cmped = 0
-      for o in orders:
-        prop = o.property().decode('utf-8')
-
-        reverse = (o.direction() is datastore_pb.Query_Order.DESCENDING)
-
-        a_val = datastore._GetPropertyValue(a, prop)
-        if isinstance(a_val, list):
-          a_val = sorted(a_val, order_compare_properties, reverse=reverse)[0]
-
-        b_val = datastore._GetPropertyValue(b, prop)
-        if isinstance(b_val, list):
-          b_val = sorted(b_val, order_compare_properties, reverse=reverse)[0]
-
-        cmped = order_compare_properties(a_val, b_val)
+      return cmp(entity_sort_key(a), entity_sort_key(b))
 
-        if o.direction() is datastore_pb.Query_Order.DESCENDING:
-          cmped = -cmped
-
-        if cmped != 0:
-          return cmped
-
-      if cmped == 0:
-        return cmp(a.key(), b.key())
-
-    def order_compare_properties(x, y):
-      """Return a negative, zero or positive number depending on whether
-      property value x is considered smaller than, equal to, or larger than
-      property value y. If x and y are different types, they're compared based
-      on the type ordering used in the real datastore, which is based on the
-      tag numbers in the PropertyValue PB.
-      """
-      if isinstance(x, datetime.datetime):
-        x = datastore_types.DatetimeToTimestamp(x)
-      if isinstance(y, datetime.datetime):
-        y = datastore_types.DatetimeToTimestamp(y)
-
-      x_type = self._PROPERTY_TYPE_TAGS.get(x.__class__)
-      y_type = self._PROPERTY_TYPE_TAGS.get(y.__class__)
-
-      if x_type == y_type:
-        try:
-          return cmp(x, y)
-        except TypeError:
-          return 0
+    if sort:
+      if (query.has_limit() and not query.has_compiled_cursor() and
+          query.offset() + query.limit() < len(results)):
+        results = heapq.nsmallest(query.offset() + query.limit(), results,
+                                  key=entity_sort_key)
       else:
-        return cmp(x_type, y_type)
-
-    results.sort(order_compare_entities)
+        results.sort(key=entity_sort_key)
 
     clone = datastore_pb.Query()
     clone.CopyFrom(query)
@@ -1002,31 +1126,15 @@ class DatastoreFileStub(apiproxy_stub.APIProxyStub):
     else:
       self.__query_history[clone] = 1
 
-    cursor = _Cursor(query, results, order_compare_entities)
-    self.__queries[cursor.cursor] = cursor
-
-    if query.has_count():
-      count = query.count()
-    elif query.has_limit():
-      count = query.limit()
-    else:
-      count = _BATCH_SIZE
-
-    cursor.PopulateQueryResult(query_result, count, compile=query.compile())
-
-    if query.compile():
-      compiled_query = query_result.mutable_compiled_query()
-      compiled_query.set_keys_only(query.keys_only())
-      compiled_query.mutable_primaryscan().set_index_name(query.Encode())
+    return results, order_compare_entities
 
   def _Dynamic_Next(self, next_request, query_result):
     self.__ValidateAppId(next_request.cursor().app())
 
     cursor_handle = next_request.cursor().cursor()
 
-    try:
-      cursor = self.__queries[cursor_handle]
-    except KeyError:
+    cursor = self.__GetCursor(cursor_handle)
+    if cursor is None:
       raise apiproxy_errors.ApplicationError(
           datastore_pb.Error.BAD_REQUEST, 'Cursor %d not found' % cursor_handle)
 
@@ -1038,11 +1146,73 @@ class DatastoreFileStub(apiproxy_stub.APIProxyStub):
     cursor.PopulateQueryResult(query_result, count)
 
   def _Dynamic_Count(self, query, integer64proto):
-    query_result = datastore_pb.QueryResult()
-    self._Dynamic_RunQuery(query, query_result)
-    cursor = query_result.cursor().cursor()
-    integer64proto.set_value(min(self.__queries[cursor].count, _MAXIMUM_RESULTS))
-    del self.__queries[cursor]
+    if query.has_compiled_cursor() and query.compiled_cursor().position_list():
+      query_result = datastore_pb.QueryResult()
+      self._Dynamic_RunQuery(query, query_result)
+      cursor = self.__RemoveCursor(query_result.cursor().cursor())
+      count = cursor.count
+    else:
+      results, _ = self.__ExecuteQuery(query, sort=False)
+      count = max(len(results) - query.offset(), 0)
+      if query.has_limit():
+        count = min(count, query.limit())
+    integer64proto.set_value(min(count, _MAXIMUM_RESULTS))
+
+  def __AddCursor(self, cursor):
+    """Registers a new cursor, expiring idle and least recently used cursors.
+
+    Cursors that have not been read for _CURSOR_TIMEOUT_SECONDS are dropped,
+    and at most _MAX_OPEN_CURSORS cursors are kept open.
+
+    Args:
+      cursor: _Cursor
+    """
+    self.__cursor_lock.acquire()
+    try:
+      deadline = cursor.last_access - _CURSOR_TIMEOUT_SECONDS
+      for handle, open_cursor in self.__queries.items():
+        if open_cursor.last_access < deadline:
+          del self.__queries[handle]
+
+      excess = len(self.__queries) + 1 - _MAX_OPEN_CURSORS
+      if excess > 0:
+        by_access = sorted(self.__queries.values(),
+                           key=lambda c: (c.last_access, c.cursor))
+        for open_cursor in by_access[:excess]:
+          del self.__queries[open_cursor.cursor]
+
+      self.__queries[cursor.cursor] = cursor
+    finally:
+      self.__cursor_lock.release()
+
+  def __GetCursor(self, cursor_handle):
+    """Returns the open cursor with the given handle, or None if it has expired.
+
+    Args:
+      cursor_handle: integer cursor handle
+    """
+    self.__cursor_lock.acquire()
+    try:
+      cursor = self.__queries.get(cursor_handle)
+      if (cursor is not None and
+          time.time() - cursor.last_access > _CURSOR_TIMEOUT_SECONDS):
+        del self.__queries[cursor_handle]
+        cursor = None
+      return cursor
+    finally:
+      self.__cursor_lock.release()
+
+  def __RemoveCursor(self, cursor_handle):
+    """Closes and returns the cursor with the given handle.
+
+    Args:
+      cursor_handle: integer cursor handle
+    """
+    self.__cursor_lock.acquire()
+    try:
+      return self.__queries.pop(cursor_handle)
+    finally:
+      self.__cursor_lock.release()
 
   def _Dynamic_BeginTransaction(self, request, transaction):
     self.__ValidateAppId(request.app())
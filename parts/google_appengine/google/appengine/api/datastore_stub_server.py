@@ -0,0 +1,1190 @@
+#!/usr/bin/env python
+#
+# Copyright 2007 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""Serves the datastore to other processes over a local socket.
+
+Runs the datastore in a standalone process so that several test processes or
+dev_appserver instances can share one datastore:
+
+  %(script)s [options] <app_id>
+
+Options:
+  --help, -h                 View this helpful message.
+  --address=ADDRESS, -a ADDRESS
+                             Address to which this server should bind.
+                             (Default %(address)s)
+  --port=PORT, -p PORT       Port for the server to run on. 0 picks a free
+                             port. (Default %(port)s)
+  --datastore_path=PATH      Path to use for storing Datastore file stub data.
+                             With several shards, shard N uses PATH.N.
+                             (Default %(datastore_path)s)
+  --shards=SHARDS            Number of worker processes to shard entity groups
+                             across. (Default %(shards)s)
+  --require_indexes          Disallows queries that require composite indexes
+                             not defined in index.yaml.
+  --trusted                  Allows access to the data of other apps.
+  --worker                   Writes the port to stdout once serving, and exits
+                             when stdin is closed. Used for the shard workers.
+
+With one shard the server runs a single DatastoreFileStub. With more, it
+starts a worker process for each shard and serves a ShardedDatastoreStub,
+which splits calls between the workers by entity group so that they run on
+several cores, and merges query results.
+
+Clients register a DatastoreClientStub in place of the DatastoreFileStub:
+
+  apiproxy_stub_map.apiproxy.RegisterStub(
+      'datastore_v3', datastore_stub_server.DatastoreClientStub(
+          ('localhost', 8079)))
+
+Each call is sent as a remote_api_pb.Request and answered with a
+remote_api_pb.Response, both prefixed with their length as a 4 byte
+big-endian integer. Every client thread uses its own connection, so a thread
+blocked waiting for a transaction does not hold up the other threads.
+
+Transactional tasks (AddAction) never reach the server, which has no taskqueue
+stub. The client buffers them per transaction and adds them to its own
+taskqueue stub once the transaction commits. If a client disconnects with a
+transaction still open, the server rolls it back so that other processes are
+not locked out.
+"""
+
+
+
+
+
+import SocketServer
+import getopt
+import logging
+import os
+import pickle
+import socket
+import struct
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import zlib
+
+from google.appengine.api import api_base_pb
+from google.appengine.api import apiproxy_rpc
+from google.appengine.api import apiproxy_stub
+from google.appengine.api import apiproxy_stub_map
+from google.appengine.api import datastore
+from google.appengine.api import datastore_file_stub
+from google.appengine.api import datastore_types
+from google.appengine.datastore import datastore_index
+from google.appengine.datastore import datastore_pb
+from google.appengine.datastore import entity_pb
+from google.appengine.ext.remote_api import remote_api_pb
+from google.appengine.runtime import apiproxy_errors
+
+try:
+  __import__('google.appengine.api.labs.taskqueue.taskqueue_service_pb')
+  taskqueue_service_pb = sys.modules.get(
+      'google.appengine.api.labs.taskqueue.taskqueue_service_pb')
+except ImportError:
+  from google.appengine.api.taskqueue import taskqueue_service_pb
+
+
+_SERVER_SERVICE = 'datastore_stub_server'
+
+_LENGTH_FORMAT = '>I'
+_LENGTH_SIZE = struct.calcsize(_LENGTH_FORMAT)
+
+_MAX_ACTIONS_PER_TXN = datastore_file_stub._MAX_ACTIONS_PER_TXN
+_MAXIMUM_RESULTS = datastore_file_stub._MAXIMUM_RESULTS
+_MAX_QUERY_OFFSET = datastore_file_stub._MAX_QUERY_OFFSET
+_BATCH_SIZE = datastore_file_stub._BATCH_SIZE
+_MAX_OPEN_CURSORS = datastore_file_stub._MAX_OPEN_CURSORS
+_CURSOR_TIMEOUT_SECONDS = datastore_file_stub._CURSOR_TIMEOUT_SECONDS
+
+DATASTORE_PB_MAP = {
+    'Get':              (datastore_pb.GetRequest, datastore_pb.GetResponse),
+    'Put':              (datastore_pb.PutRequest, datastore_pb.PutResponse),
+    'Delete':           (datastore_pb.DeleteRequest,
+                         datastore_pb.DeleteResponse),
+    'RunQuery':         (datastore_pb.Query, datastore_pb.QueryResult),
+    'Next':             (datastore_pb.NextRequest, datastore_pb.QueryResult),
+    'Count':            (datastore_pb.Query, api_base_pb.Integer64Proto),
+    'BeginTransaction': (datastore_pb.BeginTransactionRequest,
+                         datastore_pb.Transaction),
+    'Commit':           (datastore_pb.Transaction,
+                         datastore_pb.CommitResponse),
+    'Rollback':         (datastore_pb.Transaction, api_base_pb.VoidProto),
+    'GetSchema':        (datastore_pb.GetSchemaRequest, datastore_pb.Schema),
+    'AllocateIds':      (datastore_pb.AllocateIdsRequest,
+                         datastore_pb.AllocateIdsResponse),
+    'CreateIndex':      (entity_pb.CompositeIndex, api_base_pb.Integer64Proto),
+    'GetIndices':       (api_base_pb.StringProto,
+                         datastore_pb.CompositeIndices),
+    'UpdateIndex':      (entity_pb.CompositeIndex, api_base_pb.VoidProto),
+    'DeleteIndex':      (entity_pb.CompositeIndex, api_base_pb.VoidProto),
+}
+
+
+def _SendMessage(sock, message):
+  """Writes a length prefixed protocol buffer to a socket.
+
+  Args:
+    sock: a connected socket.socket
+    message: ProtocolBuffer.ProtocolMessage to send
+  """
+  encoded = message.Encode()
+  sock.sendall(struct.pack(_LENGTH_FORMAT, len(encoded)) + encoded)
+
+
+def _ReadExactly(sock, size):
+  """Reads size bytes from a socket.
+
+  Returns:
+    The bytes read, or None if the peer closed the connection first.
+  """
+  chunks = []
+  while size > 0:
+    chunk = sock.recv(min(size, 65536))
+    if not chunk:
+      return None
+    chunks.append(chunk)
+    size -= len(chunk)
+  return ''.join(chunks)
+
+
+def _ReceiveMessage(sock, message):
+  """Reads a length prefixed protocol buffer from a socket.
+
+  Args:
+    sock: a connected socket.socket
+    message: ProtocolBuffer.ProtocolMessage to parse into
+
+  Returns:
+    True if a message was read, False if the peer closed the connection.
+  """
+  header = _ReadExactly(sock, _LENGTH_SIZE)
+  if header is None:
+    return False
+  (size,) = struct.unpack(_LENGTH_FORMAT, header)
+  encoded = _ReadExactly(sock, size)
+  if encoded is None:
+    return False
+  message.ParseFromString(encoded)
+  return True
+
+
+class _StubRequestHandler(SocketServer.BaseRequestHandler):
+  """Answers datastore calls from one client connection until it closes.
+
+  Transactions begun on the connection are tracked so that any still open
+  when the connection goes away are rolled back, releasing the file stub's
+  transaction lock.
+  """
+
+  def handle(self):
+    open_transactions = {}
+    try:
+      while True:
+        request = remote_api_pb.Request()
+        if not _ReceiveMessage(self.request, request):
+          return
+        response = self.server.ExecuteRequest(request)
+        self.__TrackTransaction(request, response, open_transactions)
+        _SendMessage(self.request, response)
+    finally:
+      for transaction in open_transactions.values():
+        logging.warning('Rolling back transaction %d abandoned by %s',
+                        transaction.handle(), self.client_address)
+        try:
+          self.server.datastore_stub.MakeSyncCall(
+              'datastore_v3', 'Rollback', transaction, api_base_pb.VoidProto())
+        except Exception:
+          logging.exception('Failed to roll back abandoned transaction %d',
+                            transaction.handle())
+
+  def __TrackTransaction(self, request, response, open_transactions):
+    """Records transactions begun or finished by a call.
+
+    Args:
+      request: the remote_api_pb.Request that was executed.
+      response: the remote_api_pb.Response it produced.
+      open_transactions: dict of transaction handle to datastore_pb.Transaction
+        for the transactions this connection has open; updated in place.
+    """
+    if request.service_name() != 'datastore_v3':
+      return
+    method = request.method()
+    if method == 'BeginTransaction':
+      if response.has_response():
+        transaction = datastore_pb.Transaction(
+            response.response().contents())
+        open_transactions[transaction.handle()] = transaction
+    elif method in ('Commit', 'Rollback'):
+      transaction = datastore_pb.Transaction()
+      try:
+        transaction.ParseFromString(request.request().contents())
+      except Exception:
+        return
+      open_transactions.pop(transaction.handle(), None)
+
+
+class DatastoreStubServer(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
+  """A TCP server that executes datastore_v3 calls against a datastore stub.
+
+  Each client connection is served by its own thread, so the stub's own locks
+  serialize transactions across every connected process.
+  """
+
+  allow_reuse_address = True
+  daemon_threads = True
+
+  def __init__(self, server_address, datastore_stub):
+    """Constructor.
+
+    Args:
+      server_address: (host, port) tuple to listen on.
+      datastore_stub: the DatastoreFileStub or ShardedDatastoreStub to serve.
+    """
+    SocketServer.TCPServer.__init__(self, server_address, _StubRequestHandler)
+    self.datastore_stub = datastore_stub
+
+  def ExecuteRequest(self, request):
+    """Executes a single call and returns its remote_api_pb.Response."""
+    response = remote_api_pb.Response()
+    try:
+      service = request.service_name()
+      method = request.method()
+      if service == _SERVER_SERVICE and method == 'QueryHistory':
+        history = [(query.Encode(), count) for query, count
+                   in self.datastore_stub.QueryHistory().items()]
+        response.mutable_response().set_contents(pickle.dumps(history))
+        return response
+
+      if service != 'datastore_v3' or method not in DATASTORE_PB_MAP:
+        raise apiproxy_errors.CallNotFoundError()
+
+      request_class, response_class = DATASTORE_PB_MAP[method]
+      request_data = request_class()
+      request_data.ParseFromString(request.request().contents())
+      response_data = response_class()
+      self.datastore_stub.MakeSyncCall(service, method, request_data,
+                                       response_data)
+      response.mutable_response().set_contents(response_data.Encode())
+    except Exception, e:
+      if isinstance(e, apiproxy_errors.ApplicationError):
+        application_error = response.mutable_application_error()
+        application_error.set_code(e.application_error)
+        application_error.set_detail(e.error_detail)
+      else:
+        logging.exception('Exception while handling %s', request)
+      response.mutable_exception().set_contents(pickle.dumps(e))
+    return response
+
+
+class DatastoreClientStub(object):
+  """An apiproxy stub that forwards datastore_v3 calls to a DatastoreStubServer.
+
+  AddAction calls are kept in this process: the tasks are buffered per
+  transaction and added to the local taskqueue stub after a successful
+  Commit, or dropped on Rollback.
+  """
+
+  def __init__(self, server_address, timeout=None):
+    """Constructor.
+
+    Args:
+      server_address: (host, port) tuple of the DatastoreStubServer.
+      timeout: socket timeout in seconds, or None to block indefinitely.
+    """
+    self.__server_address = server_address
+    self.__timeout = timeout
+    self.__local = threading.local()
+    self.__tx_actions = {}
+    self.__tx_actions_lock = threading.Lock()
+
+  def __GetSocket(self):
+    """Returns this thread's connection to the server, opening it if needed."""
+    sock = getattr(self.__local, 'sock', None)
+    if sock is None:
+      sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+      sock.settimeout(self.__timeout)
+      sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+      sock.connect(self.__server_address)
+      self.__local.sock = sock
+    return sock
+
+  def Close(self):
+    """Closes this thread's connection to the server."""
+    sock = getattr(self.__local, 'sock', None)
+    if sock is not None:
+      self.__local.sock = None
+      sock.close()
+
+  def _SendCall(self, service, call, request_contents):
+    """Sends one call to the server without waiting for its response.
+
+    The response must then be read with _ReceiveResponse() on the same thread
+    before another call is sent.
+    """
+    request_pb = remote_api_pb.Request()
+    request_pb.set_service_name(service)
+    request_pb.set_method(call)
+    request_pb.mutable_request().set_contents(request_contents)
+
+    try:
+      _SendMessage(self.__GetSocket(), request_pb)
+    except socket.error:
+      self.Close()
+      raise
+
+  def _ReceiveResponse(self):
+    """Reads the response to the call this thread last sent.
+
+    Returns:
+      The remote_api_pb.Response of the call.
+
+    Raises:
+      The error the call raised on the server.
+    """
+    response_pb = remote_api_pb.Response()
+    try:
+      if not _ReceiveMessage(self.__GetSocket(), response_pb):
+        raise apiproxy_errors.Error(
+            'Datastore server %s:%d closed the connection.' %
+            self.__server_address)
+    except (socket.error, apiproxy_errors.Error):
+      self.Close()
+      raise
+
+    if response_pb.has_application_error():
+      error_pb = response_pb.application_error()
+      raise apiproxy_errors.ApplicationError(error_pb.code(),
+                                             error_pb.detail())
+    elif response_pb.has_exception():
+      raise pickle.loads(response_pb.exception().contents())
+    return response_pb
+
+  def __Call(self, service, call, request_contents):
+    """Sends one call to the server and returns its remote_api_pb.Response."""
+    self._SendCall(service, call, request_contents)
+    return self._ReceiveResponse()
+
+  def MakeSyncCall(self, service, call, request, response):
+    assert service == 'datastore_v3'
+
+    explanation = []
+    assert request.IsInitialized(explanation), explanation
+
+    if call == 'AddAction':
+      self.__AddAction(request)
+      return
+
+    try:
+      response_pb = self.__Call(service, call, request.Encode())
+    finally:
+      if call in ('Commit', 'Rollback'):
+        actions = self.__PopActions(request)
+    response.ParseFromString(response_pb.response().contents())
+
+    if call == 'Commit':
+      for action in actions:
+        try:
+          apiproxy_stub_map.MakeSyncCall(
+              'taskqueue', 'Add', action, api_base_pb.VoidProto())
+        except apiproxy_errors.ApplicationError, e:
+          logging.warning('Transactional task %s has been dropped, %s',
+                          action, e)
+
+    assert response.IsInitialized(explanation), explanation
+
+  def __AddAction(self, request):
+    """Buffers a transactional task until its transaction commits.
+
+    Args:
+      request: taskqueue_service_pb.TaskQueueAddRequest with a transaction.
+    """
+    transaction = request.transaction()
+    clone = taskqueue_service_pb.TaskQueueAddRequest()
+    clone.CopyFrom(request)
+    clone.clear_transaction()
+
+    self.__tx_actions_lock.acquire()
+    try:
+      actions = self.__tx_actions.setdefault(
+          (transaction.app(), transaction.handle()), [])
+      if len(actions) >= _MAX_ACTIONS_PER_TXN:
+        raise apiproxy_errors.ApplicationError(
+            datastore_pb.Error.BAD_REQUEST,
+            'Too many messages, maximum allowed %s' % _MAX_ACTIONS_PER_TXN)
+      actions.append(clone)
+    finally:
+      self.__tx_actions_lock.release()
+
+  def __PopActions(self, transaction):
+    """Removes and returns the tasks buffered for a transaction.
+
+    Args:
+      transaction: datastore_pb.Transaction
+
+    Returns:
+      A list of taskqueue_service_pb.TaskQueueAddRequest, possibly empty.
+    """
+    self.__tx_actions_lock.acquire()
+    try:
+      return self.__tx_actions.pop(
+          (transaction.app(), transaction.handle()), [])
+    finally:
+      self.__tx_actions_lock.release()
+
+  def CreateRPC(self):
+    return apiproxy_rpc.RPC(stub=self)
+
+  def QueryHistory(self):
+    """Returns a dict that maps Query PBs to times they've been run."""
+    response_pb = self.__Call(_SERVER_SERVICE, 'QueryHistory', '')
+    history = {}
+    for encoded, count in pickle.loads(response_pb.response().contents()):
+      history[datastore_pb.Query(encoded)] = count
+    return history
+
+
+def _StartWorker(app_id, datastore_path, require_indexes, trusted):
+  """Starts a datastore_stub_server process that serves one shard.
+
+  The worker listens on a free local port, which it writes to its stdout, and
+  exits once its stdin is closed.
+
+  Args:
+    app_id: the app the worker serves.
+    datastore_path: path of the file the worker stores its entities in.
+    require_indexes: bool, passed on as --require_indexes.
+    trusted: bool, passed on as --trusted.
+
+  Returns:
+    (subprocess.Popen, port the worker listens on)
+  """
+  script = os.path.splitext(os.path.abspath(__file__))[0] + '.py'
+  args = [sys.executable, script, '--worker', '--address=localhost',
+          '--port=0', '--datastore_path=%s' % datastore_path]
+  if require_indexes:
+    args.append('--require_indexes')
+  if trusted:
+    args.append('--trusted')
+  args.append(app_id)
+
+  env = dict(os.environ)
+  env['PYTHONPATH'] = os.pathsep.join(sys.path)
+  worker = subprocess.Popen(args, stdin=subprocess.PIPE,
+                            stdout=subprocess.PIPE, env=env)
+  try:
+    port = int(worker.stdout.readline())
+  except ValueError:
+    worker.stdin.close()
+    worker.wait()
+    raise apiproxy_errors.Error(
+        'Datastore worker for %s failed to start.' % datastore_path)
+  return worker, port
+
+
+class ShardedDatastoreStub(apiproxy_stub.APIProxyStub):
+  """A datastore stub that shards entity groups across worker processes.
+
+  Each worker is a datastore_stub_server process with its own
+  DatastoreFileStub, holding the entity groups whose root key hashes to it, so
+  calls for different entity groups run on different cores. This stub is the
+  coordinator in front of them:
+
+  - Gets, puts and deletes are split by entity group and sent to the workers
+    in parallel.
+  - Ancestor queries run on the ancestor's worker, other queries on every
+    worker, and the results are merged here into query order. Cursors over
+    the merged results are kept here.
+  - IDs are allocated here, so that they stay unique across workers.
+  - A transaction is begun on the worker of the first entity group it uses.
+    Using an entity group held by another worker in the same transaction is
+    an error, as cross-group transactions are in the real datastore.
+  """
+
+  def __init__(self,
+               app_id,
+               datastore_file,
+               shards,
+               require_indexes=False,
+               trusted=False,
+               service_name='datastore_v3'):
+    """Constructor.
+
+    Starts a worker process for each shard and waits until they are serving.
+
+    Args:
+      app_id: string
+      datastore_file: string, shard N stores its entities in datastore_file.N
+      shards: number of worker processes to start.
+      require_indexes: bool, default False.  If True, composite indexes must
+          exist in index.yaml for queries that need them.
+      trusted: bool, default False.  If True, this stub allows an app to
+        access the data of another app.
+      service_name: Service name expected for all calls.
+    """
+    super(ShardedDatastoreStub, self).__init__(service_name)
+    assert shards > 0
+    self.__app_id = app_id
+
+    self.__workers = []
+    self.__shards = []
+
+    self.__queries = {}
+    self.__query_history = {}
+    self.__transactions = {}
+
+    self.__next_tx_handle = 1
+    self.__id_lock = threading.Lock()
+    self.__tx_lock = threading.Lock()
+    self.__cursor_lock = threading.Lock()
+    self.__history_lock = threading.Lock()
+    self.__indexes_lock = threading.Lock()
+
+    try:
+      for index in xrange(shards):
+        worker, port = _StartWorker(app_id, '%s.%d' % (datastore_file, index),
+                                    require_indexes, trusted)
+        self.__workers.append(worker)
+        self.__shards.append(DatastoreClientStub(('localhost', port)))
+      self.__next_id = self.__ReadNextId()
+    except:
+      self.Close()
+      raise
+
+  def Close(self):
+    """Stops the worker processes and waits for them to exit."""
+    for shard in self.__shards:
+      shard.Close()
+    for worker in self.__workers:
+      worker.stdin.close()
+    for worker in self.__workers:
+      worker.wait()
+    self.__shards = []
+    self.__workers = []
+
+  def __ReadNextId(self):
+    """Returns the first ID above every ID the workers have stored."""
+    request = datastore_pb.AllocateIdsRequest()
+    request.mutable_model_key().set_app(self.__app_id)
+    request.mutable_model_key().mutable_path()
+    request.set_size(1)
+    responses = self.__CallAllShards('AllocateIds', request,
+                                     datastore_pb.AllocateIdsResponse)
+    return max(response.end() for response in responses) + 1
+
+  def __CallShards(self, calls):
+    """Makes calls to several shards in parallel.
+
+    Every call is sent before any response is read, and every response is
+    read even if one of the calls fails.
+
+    Args:
+      calls: list of (shard index, method, request, response) tuples. The
+        responses are filled in place.
+
+    Raises:
+      The first error any of the calls raised.
+    """
+    error = None
+    sent = []
+    for shard, method, request, response in calls:
+      try:
+        self.__shards[shard]._SendCall('datastore_v3', method,
+                                       request.Encode())
+        sent.append((shard, response))
+      except Exception:
+        if error is None:
+          error = sys.exc_info()
+
+    for shard, response in sent:
+      try:
+        response_pb = self.__shards[shard]._ReceiveResponse()
+        response.ParseFromString(response_pb.response().contents())
+      except Exception:
+        if error is None:
+          error = sys.exc_info()
+
+    if error is not None:
+      raise error[0], error[1], error[2]
+
+  def __CallAllShards(self, method, request, response_class):
+    """Makes the same call to every shard in parallel.
+
+    Returns:
+      A list of the response of each shard, in shard order.
+    """
+    calls = [(shard, method, request, response_class())
+             for shard in xrange(len(self.__shards))]
+    self.__CallShards(calls)
+    return [response for _, _, _, response in calls]
+
+  def __ShardForKey(self, key):
+    """Returns the index of the shard that holds a key's entity group.
+
+    Args:
+      key: entity_pb.Reference
+    """
+    group = '\0'.join((key.app(), key.name_space(),
+                       key.path().element(0).Encode()))
+    return (zlib.crc32(group) & 0xffffffff) % len(self.__shards)
+
+  def __SplitRequest(self, request, list_name):
+    """Splits a Get, Put or Delete request into one request per shard.
+
+    Args:
+      request: the datastore_pb request to split.
+      list_name: 'key' or 'entity', the repeated field of the request to split.
+
+    Returns:
+      A list of (shard index, request for that shard, positions of its items
+      in the original request) tuples.
+    """
+    items = getattr(request, '%s_list' % list_name)()
+    positions = {}
+    for position, item in enumerate(items):
+      if list_name == 'entity':
+        key = item.key()
+      else:
+        key = item
+      positions.setdefault(self.__ShardForKey(key), []).append(position)
+
+    template = request.__class__()
+    template.CopyFrom(request)
+    del getattr(template, '%s_list' % list_name)()[:]
+
+    split = []
+    for shard, shard_positions in sorted(positions.items()):
+      shard_request = request.__class__()
+      shard_request.CopyFrom(template)
+      getattr(shard_request, '%s_list' % list_name)().extend(
+          [items[position] for position in shard_positions])
+      if request.has_transaction():
+        shard_request.mutable_transaction().CopyFrom(
+            self.__ShardTransaction(request.transaction(), shard))
+      split.append((shard, shard_request, shard_positions))
+    return split
+
+  def __AllocateIds(self, size):
+    """Reserves size consecutive IDs and returns the first one."""
+    self.__id_lock.acquire()
+    try:
+      start = self.__next_id
+      self.__next_id += size
+    finally:
+      self.__id_lock.release()
+    return start
+
+  def _Dynamic_Put(self, put_request, put_response):
+    clone = datastore_pb.PutRequest()
+    clone.CopyFrom(put_request)
+
+    incomplete = []
+    for entity in clone.entity_list():
+      last_path = entity.key().path().element_list()[-1]
+      if last_path.id() == 0 and not last_path.has_name():
+        incomplete.append(entity)
+
+    if incomplete:
+      next_id = self.__AllocateIds(len(incomplete))
+      for entity in incomplete:
+        entity.key().path().element_list()[-1].set_id(next_id)
+        next_id += 1
+
+        assert entity.entity_group().element_size() == 0
+        entity.mutable_entity_group().add_element().CopyFrom(
+            entity.key().path().element(0))
+
+    split = self.__SplitRequest(clone, 'entity')
+    calls = [(shard, 'Put', request, datastore_pb.PutResponse())
+             for shard, request, _ in split]
+    self.__CallShards(calls)
+
+    keys = [None] * clone.entity_size()
+    for (_, _, positions), (_, _, _, response) in zip(split, calls):
+      for position, key in zip(positions, response.key_list()):
+        keys[position] = key
+    put_response.key_list().extend(keys)
+
+  def _Dynamic_Get(self, get_request, get_response):
+    split = self.__SplitRequest(get_request, 'key')
+    calls = [(shard, 'Get', request, datastore_pb.GetResponse())
+             for shard, request, _ in split]
+    self.__CallShards(calls)
+
+    groups = [None] * get_request.key_size()
+    for (_, _, positions), (_, _, _, response) in zip(split, calls):
+      for position, group in zip(positions, response.entity_list()):
+        groups[position] = group
+    get_response.entity_list().extend(groups)
+
+  def _Dynamic_Delete(self, delete_request, delete_response):
+    self.__CallShards([(shard, 'Delete', request, datastore_pb.DeleteResponse())
+                       for shard, request, _
+                       in self.__SplitRequest(delete_request, 'key')])
+
+  def __ShardQuery(self, query):
+    """Works out which shards a query has to run on.
+
+    Args:
+      query: datastore_pb.Query
+
+    Returns:
+      (list of shard indexes, datastore_pb.Query to send to them)
+    """
+    shard_query = datastore_pb.Query()
+    shard_query.CopyFrom(query)
+    if query.has_ancestor():
+      shard = self.__ShardForKey(query.ancestor())
+      if query.has_transaction():
+        shard_query.mutable_transaction().CopyFrom(
+            self.__ShardTransaction(query.transaction(), shard))
+      return [shard], shard_query
+
+    if query.has_transaction():
+      raise apiproxy_errors.ApplicationError(
+          datastore_pb.Error.BAD_REQUEST,
+          'Only ancestor queries are allowed inside transactions.')
+    return range(len(self.__shards)), shard_query
+
+  def __FetchResults(self, query, shards, shard_query):
+    """Runs a query on some shards and merges their results.
+
+    The shards skip nothing, so that the query's offset can be applied to the
+    merged results, and each returns up to offset + limit results.
+
+    Args:
+      query: the datastore_pb.Query being run.
+      shards: list of the indexes of the shards to run it on.
+      shard_query: the datastore_pb.Query to send them; changed in place.
+
+    Returns:
+      (results, order_compare_entities): a list of datastore.Entity in query
+      order and a __cmp__ function for datastore.Entity that follows it.
+    """
+    if query.has_offset() and query.offset() > _MAX_QUERY_OFFSET:
+      raise apiproxy_errors.ApplicationError(
+          datastore_pb.Error.BAD_REQUEST, 'Too big query offset.')
+
+    (filters, orders) = datastore_index.Normalize(query.filter_list(),
+                                                  query.order_list())
+    for order in orders:
+      if order.property() != datastore_types._KEY_SPECIAL_PROPERTY:
+        shard_query.clear_keys_only()
+    shard_query.clear_offset()
+    if query.has_limit():
+      shard_query.set_limit(query.offset() + query.limit())
+    shard_query.clear_compile()
+    shard_query.set_count(_MAXIMUM_RESULTS)
+
+    results = []
+    calls = [(shard, 'RunQuery', shard_query, datastore_pb.QueryResult())
+             for shard in shards]
+    while calls:
+      self.__CallShards(calls)
+      next_calls = []
+      for shard, _, _, query_result in calls:
+        results.extend([datastore.Entity._FromPb(entity)
+                        for entity in query_result.result_list()])
+        if query_result.more_results():
+          next_request = datastore_pb.NextRequest()
+          next_request.mutable_cursor().CopyFrom(query_result.cursor())
+          next_request.set_count(_MAXIMUM_RESULTS)
+          next_calls.append(
+              (shard, 'Next', next_request, datastore_pb.QueryResult()))
+      calls = next_calls
+
+    entity_sort_key = datastore_file_stub._EntitySortKey(orders)
+    results.sort(key=entity_sort_key)
+
+    def order_compare_entities(a, b):
+      """Compares two entities in query order."""
+      return cmp(entity_sort_key(a), entity_sort_key(b))
+
+    return results, order_compare_entities
+
+  def __RecordQuery(self, query):
+    """Counts a query in the query history."""
+    clone = datastore_pb.Query()
+    clone.CopyFrom(query)
+    clone.clear_hint()
+    self.__history_lock.acquire()
+    try:
+      self.__query_history[clone] = self.__query_history.get(clone, 0) + 1
+    finally:
+      self.__history_lock.release()
+
+  def QueryHistory(self):
+    """Returns a dict that maps Query PBs to times they've been run."""
+    self.__history_lock.acquire()
+    try:
+      return dict((pb, times) for pb, times in self.__query_history.items()
+                  if pb.app() == self.__app_id)
+    finally:
+      self.__history_lock.release()
+
+  def _Dynamic_RunQuery(self, query, query_result):
+    self.__RecordQuery(query)
+    shards, shard_query = self.__ShardQuery(query)
+    results, order_compare_entities = self.__FetchResults(query, shards,
+                                                          shard_query)
+
+    cursor = datastore_file_stub._Cursor(query, results,
+                                         order_compare_entities)
+    self.__AddCursor(cursor)
+
+    if query.has_count():
+      count = query.count()
+    elif query.has_limit():
+      count = query.limit()
+    else:
+      count = _BATCH_SIZE
+
+    cursor.PopulateQueryResult(query_result, count, compile=query.compile())
+
+    if query.compile():
+      compiled_query = query_result.mutable_compiled_query()
+      compiled_query.set_keys_only(query.keys_only())
+      compiled_query.mutable_primaryscan().set_index_name(query.Encode())
+
+  def _Dynamic_Next(self, next_request, query_result):
+    cursor_handle = next_request.cursor().cursor()
+
+    cursor = self.__GetCursor(cursor_handle)
+    if cursor is None:
+      raise apiproxy_errors.ApplicationError(
+          datastore_pb.Error.BAD_REQUEST, 'Cursor %d not found' % cursor_handle)
+
+    assert cursor.app == next_request.cursor().app()
+
+    count = _BATCH_SIZE
+    if next_request.has_count():
+      count = next_request.count()
+    cursor.PopulateQueryResult(query_result, count)
+
+  def _Dynamic_Count(self, query, integer64proto):
+    self.__RecordQuery(query)
+    shards, shard_query = self.__ShardQuery(query)
+    if len(shards) > 1 and query.offset():
+      results, _ = self.__FetchResults(query, shards, shard_query)
+      count = max(len(results) - query.offset(), 0)
+    else:
+      calls = [(shard, 'Count', shard_query, api_base_pb.Integer64Proto())
+               for shard in shards]
+      self.__CallShards(calls)
+      count = sum([response.value() for _, _, _, response in calls])
+    if query.has_limit():
+      count = min(count, query.limit())
+    integer64proto.set_value(min(count, _MAXIMUM_RESULTS))
+
+  def __AddCursor(self, cursor):
+    """Registers a new cursor, expiring idle and least recently used cursors.
+
+    Args:
+      cursor: datastore_file_stub._Cursor
+    """
+    self.__cursor_lock.acquire()
+    try:
+      deadline = cursor.last_access - _CURSOR_TIMEOUT_SECONDS
+      for handle, open_cursor in self.__queries.items():
+        if open_cursor.last_access < deadline:
+          del self.__queries[handle]
+
+      excess = len(self.__queries) + 1 - _MAX_OPEN_CURSORS
+      if excess > 0:
+        by_access = sorted(self.__queries.values(),
+                           key=lambda c: (c.last_access, c.cursor))
+        for open_cursor in by_access[:excess]:
+          del self.__queries[open_cursor.cursor]
+
+      self.__queries[cursor.cursor] = cursor
+    finally:
+      self.__cursor_lock.release()
+
+  def __GetCursor(self, cursor_handle):
+    """Returns the open cursor with the given handle, or None if it has expired.
+
+    Args:
+      cursor_handle: integer cursor handle
+    """
+    self.__cursor_lock.acquire()
+    try:
+      cursor = self.__queries.get(cursor_handle)
+      if (cursor is not None and
+          time.time() - cursor.last_access > _CURSOR_TIMEOUT_SECONDS):
+        del self.__queries[cursor_handle]
+        cursor = None
+      return cursor
+    finally:
+      self.__cursor_lock.release()
+
+  def _Dynamic_BeginTransaction(self, request, transaction):
+    self.__tx_lock.acquire()
+    try:
+      handle = self.__next_tx_handle
+      self.__next_tx_handle += 1
+      self.__transactions[handle] = None
+    finally:
+      self.__tx_lock.release()
+
+    transaction.set_app(request.app())
+    transaction.set_handle(handle)
+
+  def __ShardTransaction(self, transaction, shard):
+    """Returns the transaction on a shard that backs a transaction.
+
+    The shard's transaction is begun the first time the transaction is used.
+
+    Args:
+      transaction: datastore_pb.Transaction handed out by this stub.
+      shard: index of the shard the transaction is used on.
+
+    Returns:
+      The datastore_pb.Transaction to send to the shard.
+    """
+    handle = transaction.handle()
+    self.__tx_lock.acquire()
+    try:
+      if handle not in self.__transactions:
+        raise apiproxy_errors.ApplicationError(
+            datastore_pb.Error.BAD_REQUEST,
+            'Transaction %s not found' % transaction)
+      bound = self.__transactions[handle]
+    finally:
+      self.__tx_lock.release()
+
+    if bound is None:
+      request = datastore_pb.BeginTransactionRequest()
+      request.set_app(transaction.app())
+      shard_transaction = datastore_pb.Transaction()
+      self.__CallShards([(shard, 'BeginTransaction', request,
+                          shard_transaction)])
+      bound = (shard, shard_transaction)
+      self.__tx_lock.acquire()
+      try:
+        self.__transactions[handle] = bound
+      finally:
+        self.__tx_lock.release()
+    elif bound[0] != shard:
+      raise apiproxy_errors.ApplicationError(
+          datastore_pb.Error.BAD_REQUEST,
+          'Cannot operate on different entity groups in a transaction.')
+    return bound[1]
+
+  def __EndTransaction(self, transaction, method, response):
+    """Commits or rolls back a transaction on the shard it was begun on.
+
+    Args:
+      transaction: datastore_pb.Transaction handed out by this stub.
+      method: 'Commit' or 'Rollback'.
+      response: the response PB of the call, filled in place.
+    """
+    self.__tx_lock.acquire()
+    try:
+      if transaction.handle() not in self.__transactions:
+        raise apiproxy_errors.ApplicationError(
+            datastore_pb.Error.BAD_REQUEST,
+            'Transaction %s not found' % transaction)
+      bound = self.__transactions.pop(transaction.handle())
+    finally:
+      self.__tx_lock.release()
+
+    if bound is not None:
+      shard, shard_transaction = bound
+      self.__CallShards([(shard, method, shard_transaction, response)])
+
+  def _Dynamic_Commit(self, transaction, transaction_response):
+    self.__EndTransaction(transaction, 'Commit', transaction_response)
+
+  def _Dynamic_Rollback(self, transaction, transaction_response):
+    self.__EndTransaction(transaction, 'Rollback', transaction_response)
+
+  def _Dynamic_GetSchema(self, req, schema):
+    kinds = {}
+    properties = {}
+    for shard_schema in self.__CallAllShards('GetSchema', req,
+                                             datastore_pb.Schema):
+      for kind_pb in shard_schema.kind_list():
+        kind = kind_pb.key().path().element(0).type()
+        if kind not in kinds:
+          kinds[kind] = kind_pb
+          properties[kind] = dict((prop.name(), prop)
+                                  for prop in kind_pb.property_list())
+          continue
+        for prop in kind_pb.property_list():
+          if prop.name() in properties[kind]:
+            properties[kind][prop.name()].mutable_value().MergeFrom(
+                prop.value())
+          else:
+            properties[kind][prop.name()] = kinds[kind].add_property()
+            properties[kind][prop.name()].CopyFrom(prop)
+
+    for kind in sorted(kinds):
+      schema.add_kind().CopyFrom(kinds[kind])
+    schema.set_more_results(False)
+
+  def _Dynamic_AllocateIds(self, allocate_ids_request, allocate_ids_response):
+    size = allocate_ids_request.size()
+    start = self.__AllocateIds(size)
+    allocate_ids_response.set_start(start)
+    allocate_ids_response.set_end(start + size - 1)
+
+  def _Dynamic_CreateIndex(self, index, id_response):
+    self.__indexes_lock.acquire()
+    try:
+      responses = self.__CallAllShards('CreateIndex', index,
+                                       api_base_pb.Integer64Proto)
+    finally:
+      self.__indexes_lock.release()
+    id_response.set_value(responses[0].value())
+
+  def _Dynamic_GetIndices(self, app_str, composite_indices):
+    self.__CallShards([(0, 'GetIndices', app_str, composite_indices)])
+
+  def _Dynamic_UpdateIndex(self, index, void):
+    self.__indexes_lock.acquire()
+    try:
+      self.__CallAllShards('UpdateIndex', index, api_base_pb.VoidProto)
+    finally:
+      self.__indexes_lock.release()
+
+  def _Dynamic_DeleteIndex(self, index, void):
+    self.__indexes_lock.acquire()
+    try:
+      self.__CallAllShards('DeleteIndex', index, api_base_pb.VoidProto)
+    finally:
+      self.__indexes_lock.release()
+
+
+DEFAULT_ARGS = {
+    'address': 'localhost',
+    'port': 8079,
+    'datastore_path': os.path.join(tempfile.gettempdir(),
+                                   'dev_appserver.datastore'),
+    'shards': 1,
+    'require_indexes': False,
+    'trusted': False,
+    'worker': False,
+}
+
+
+def PrintUsageExit(code):
+  """Prints usage information and exits with a status code.
+
+  Args:
+    code: Status code to pass to sys.exit() after displaying usage information.
+  """
+  render_dict = DEFAULT_ARGS.copy()
+  render_dict['script'] = os.path.basename(sys.argv[0])
+  print __doc__ % render_dict
+  sys.stdout.flush()
+  sys.exit(code)
+
+
+def _ShutdownOnEOF(server):
+  """Stops a worker's server once the process that started it closes stdin."""
+  sys.stdin.read()
+  server.shutdown()
+
+
+def main(argv):
+  """Runs a DatastoreStubServer until interrupted."""
+  option_dict = DEFAULT_ARGS.copy()
+  try:
+    opts, args = getopt.gnu_getopt(
+        argv[1:], 'a:hp:',
+        ['address=', 'datastore_path=', 'help', 'port=', 'require_indexes',
+         'shards=', 'trusted', 'worker'])
+  except getopt.GetoptError, e:
+    print >>sys.stderr, 'Error: %s' % e
+    PrintUsageExit(1)
+
+  for option, value in opts:
+    if option in ('-h', '--help'):
+      PrintUsageExit(0)
+    if option in ('-a', '--address'):
+      option_dict['address'] = value
+    if option in ('-p', '--port'):
+      try:
+        option_dict['port'] = int(value)
+        if not (65535 > option_dict['port'] >= 0):
+          raise ValueError
+      except ValueError:
+        print >>sys.stderr, 'Invalid value supplied for port'
+        PrintUsageExit(1)
+    if option == '--datastore_path':
+      option_dict['datastore_path'] = os.path.abspath(value)
+    if option == '--shards':
+      try:
+        option_dict['shards'] = int(value)
+        if option_dict['shards'] < 1:
+          raise ValueError
+      except ValueError:
+        print >>sys.stderr, 'Invalid value supplied for shards'
+        PrintUsageExit(1)
+    if option == '--require_indexes':
+      option_dict['require_indexes'] = True
+    if option == '--trusted':
+      option_dict['trusted'] = True
+    if option == '--worker':
+      option_dict['worker'] = True
+
+  if len(args) != 1:
+    print >>sys.stderr, 'Invalid arguments'
+    PrintUsageExit(1)
+
+  logging.basicConfig(level=logging.INFO)
+  if option_dict['shards'] > 1:
+    datastore_stub = ShardedDatastoreStub(
+        args[0], option_dict['datastore_path'], option_dict['shards'],
+        require_indexes=option_dict['require_indexes'],
+        trusted=option_dict['trusted'])
+  else:
+    datastore_stub = datastore_file_stub.DatastoreFileStub(
+        args[0], option_dict['datastore_path'],
+        require_indexes=option_dict['require_indexes'],
+        trusted=option_dict['trusted'])
+  try:
+    server = DatastoreStubServer(
+        (option_dict['address'], option_dict['port']), datastore_stub)
+    try:
+      port = server.server_address[1]
+      if option_dict['worker']:
+        print port
+        sys.stdout.flush()
+        watcher = threading.Thread(target=_ShutdownOnEOF, args=(server,))
+        watcher.setDaemon(True)
+        watcher.start()
+
+      logging.info('Serving datastore for %s on %s:%d', args[0],
+                   option_dict['address'], port)
+      try:
+        server.serve_forever()
+      except KeyboardInterrupt:
+        logging.info('Server interrupted by user, terminating')
+    finally:
+      server.server_close()
+  finally:
+    if isinstance(datastore_stub, ShardedDatastoreStub):
+      datastore_stub.Close()
+  return 0
+
+
+if __name__ == '__main__':
+  sys.exit(main(sys.argv))
@@ -113,6 +113,29 @@ class DatastoreError(Error):
   """There was a datastore error while accessing the queue."""
 
 
+class TooManyTasksError(Error):
+  """Too many tasks were passed to a single asynchronous add."""
+
+
+class BulkAddError(Error):
+  """Some of the tasks passed to Queue.add() could not be added.
+
+  The tasks that were added have been marked as enqueued as usual.
+
+  Attributes:
+    tasks: The list of tasks that was passed to Queue.add().
+    errors: A list with one entry per task: None if the task was added, or
+      the exception, e.g. a TaskAlreadyExistsError, explaining why not.
+  """
+
+  def __init__(self, tasks, errors):
+    failed = len([error for error in errors if error is not None])
+    Error.__init__(self, '%d of %d tasks could not be added' %
+                   (failed, len(tasks)))
+    self.tasks = tasks
+    self.errors = errors
+
+
 MAX_QUEUE_NAME_LENGTH = 100
 
 MAX_TASK_NAME_LENGTH = 500
@@ -121,6 +144,8 @@ MAX_TASK_SIZE_BYTES = 10 * (2 ** 10)
 
 MAX_URL_LENGTH = 2083
 
+MAX_TASKS_PER_ADD = 100
+
 _DEFAULT_QUEUE = 'default'
 
 _DEFAULT_QUEUE_PATH = '/_ah/queue'
@@ -509,26 +534,95 @@ class Queue(object):
     self.__url = '%s/%s' % (_DEFAULT_QUEUE_PATH, self.__name)
 
   def add(self, task, transactional=False):
-    """Adds a Task to this Queue.
+    """Adds a Task or a list of Tasks to this Queue.
+
+    A list of tasks is sent in BulkAdd calls of up to MAX_TASKS_PER_ADD tasks
+    each, which are all started before any is waited for.
 
     Args:
-      task: The Task to add.
+      task: The Task to add, or a list of Tasks.
       transactional: If false adds the task to a queue irrespectively to the
         enclosing transaction success or failure. (optional)
 
     Returns:
-      The Task that was supplied to this method.
+      The Task or list of Tasks that was supplied to this method.
 
     Raises:
       BadTaskStateError if the Task has already been added to a queue.
+      BulkAddError if some of a list of Tasks could not be added.
       Error-subclass on application errors.
     """
-    if task.was_enqueued:
-      raise BadTaskStateError('Task has already been enqueued')
+    if not isinstance(task, (list, tuple)):
+      if task.was_enqueued:
+        raise BadTaskStateError('Task has already been enqueued')
+
+      request = taskqueue_service_pb.TaskQueueAddRequest()
+      response = taskqueue_service_pb.TaskQueueAddResponse()
+      self.__FillAddRequest(task, request, transactional)
 
-    request = taskqueue_service_pb.TaskQueueAddRequest()
-    response = taskqueue_service_pb.TaskQueueAddResponse()
+      call_tuple = ('taskqueue', 'Add', request, response)
+      try:
+        apiproxy_stub_map.MakeSyncCall(*call_tuple)
+      except apiproxy_errors.ApplicationError, e:
+        self.__TranslateError(e)
+
+      if response.has_chosen_task_name():
+        task._Task__name = response.chosen_task_name()
+      task._Task__enqueued = True
+      return task
+
+    tasks = list(task)
+    for each_task in tasks:
+      if each_task.was_enqueued:
+        raise BadTaskStateError('Task has already been enqueued')
+    rpcs = []
+    for i in xrange(0, len(tasks), MAX_TASKS_PER_ADD):
+      rpcs.append(self.__MakeBulkAddCall(
+          create_rpc(), tasks[i:i + MAX_TASKS_PER_ADD], transactional))
+    errors = []
+    for rpc in rpcs:
+      rpc.wait()
+      errors.extend(self.__GetBulkAddErrors(rpc))
+    if [error for error in errors if error is not None]:
+      raise BulkAddError(tasks, errors)
+    return task
+
+  def add_async(self, tasks, transactional=False, rpc=None):
+    """Starts adding a list of Tasks to this Queue in one BulkAdd call.
+
+    Args:
+      tasks: A list of at most MAX_TASKS_PER_ADD Tasks.
+      transactional: As for add().
+      rpc: Optional UserRPC created by create_rpc().
+
+    Returns:
+      A UserRPC whose get_result() returns the list of tasks, or raises what
+      add() would.
+
+    Raises:
+      TooManyTasksError if more than MAX_TASKS_PER_ADD tasks are given.
+      BadTaskStateError if a Task has already been added to a queue.
+    """
+    tasks = list(tasks)
+    if len(tasks) > MAX_TASKS_PER_ADD:
+      raise TooManyTasksError(
+          'No more than %d tasks can be added in one call; found %d' %
+          (MAX_TASKS_PER_ADD, len(tasks)))
+    if rpc is None:
+      rpc = create_rpc()
+    return self.__MakeBulkAddCall(rpc, tasks, transactional)
+
+  def __FillAddRequest(self, task, request, transactional):
+    """Fills in a TaskQueueAddRequest for a Task.
+
+    Args:
+      task: The Task to add.
+      request: The taskqueue_service_pb.TaskQueueAddRequest to fill in.
+      transactional: True to add the task with the enclosing transaction.
 
+    Raises:
+      InvalidTaskNameError if a named Task is bound to a transaction.
+    """
     adjusted_url = task.url
     if task.on_queue_url:
       adjusted_url = self.__url + task.url
@@ -558,16 +652,71 @@ class Queue(object):
     if request.has_transaction() and task.name:
       raise InvalidTaskNameError('Task bound to a transaction cannot be named.')
 
-    call_tuple = ('taskqueue', 'Add', request, response)
+  def __MakeBulkAddCall(self, rpc, tasks, transactional):
+    """Starts a BulkAdd call for a list of Tasks.
+
+    Args:
+      rpc: The UserRPC to make the call with.
+      tasks: The list of Tasks to add.
+      transactional: True to add the tasks with the enclosing transaction.
+
+    Returns:
+      The UserRPC.
+
+    Raises:
+      BadTaskStateError if a Task has already been added to a queue.
+    """
+    assert rpc.service == 'taskqueue', repr(rpc.service)
+    request = taskqueue_service_pb.TaskQueueBulkAddRequest()
+    response = taskqueue_service_pb.TaskQueueBulkAddResponse()
+    for task in tasks:
+      if task.was_enqueued:
+        raise BadTaskStateError('Task has already been enqueued')
+      self.__FillAddRequest(task, request.add_add_request(), transactional)
+    rpc.make_call('BulkAdd', request, response, self.__GetBulkAddResult,
+                  tasks)
+    return rpc
+
+  def __GetBulkAddErrors(self, rpc):
+    """Marks the added tasks of a BulkAdd call as enqueued.
+
+    Args:
+      rpc: A finished BulkAdd UserRPC, with the list of tasks as its
+        user_data.
+
+    Returns:
+      A list with one entry per task: None if it was added, otherwise the
+      exception for its error.
+
+    Raises:
+      Error-subclass if the whole call failed.
+    """
     try:
-      apiproxy_stub_map.MakeSyncCall(*call_tuple)
+      rpc.check_success()
     except apiproxy_errors.ApplicationError, e:
       self.__TranslateError(e)
 
-    if response.has_chosen_task_name():
-      task._Task__name = response.chosen_task_name()
-    task._Task__enqueued = True
-    return task
+    errors = []
+    for task, task_result in zip(rpc.user_data, rpc.response.taskresult_list()):
+      if task_result.result() == taskqueue_service_pb.TaskQueueServiceError.OK:
+        if task_result.has_chosen_task_name():
+          task._Task__name = task_result.chosen_task_name()
+        task._Task__enqueued = True
+        errors.append(None)
+      else:
+        try:
+          self.__TranslateError(
+              apiproxy_errors.ApplicationError(task_result.result()))
+        except Error, e:
+          errors.append(e)
+    return errors
+
+  def __GetBulkAddResult(self, rpc):
+    """Get-result hook for add_async()."""
+    errors = self.__GetBulkAddErrors(rpc)
+    if [error for error in errors if error is not None]:
+      raise BulkAddError(rpc.user_data, errors)
+    return rpc.user_data
 
   @property
   def name(self):
@@ -641,6 +790,20 @@ class Queue(object):
                   (error.application_error, error.error_detail))
 
 
+def create_rpc(deadline=None, callback=None):
+  """Creates an RPC object for use with the task queue API.
+
+  Args:
+    deadline: Optional deadline in seconds for the operation; the default
+      is a system-specific deadline (typically 5 seconds).
+    callback: Optional callable to invoke on completion.
+
+  Returns:
+    An apiproxy_stub_map.UserRPC object specialized for this service.
+  """
+  return apiproxy_stub_map.UserRPC('taskqueue', deadline, callback)
+
+
 def add(*args, **kwargs):
   """Convenience method will create a Task and add it to the default queue.
 
@@ -0,0 +1,553 @@
+#!/usr/bin/env python
+#
+# Copyright 2007 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""Runs the tasks stored in a TaskQueueServiceStub.
+
+A TaskExecutor leases due tasks from the stub, in ETA order, and runs each
+one on a new daemon thread, at most a fixed number at a time, which passes
+it to a dispatcher:
+
+  stub = apiproxy_stub_map.apiproxy.GetStub('taskqueue')
+  executor = taskqueue_executor.TaskExecutor(
+      stub, taskqueue_executor.WsgiDispatcher(application))
+  executor.Start()
+  ...
+  executor.Stop()
+  print executor.GetQueueMetrics()
+
+WsgiDispatcher calls a WSGI application directly, and HttpDispatcher sends
+the task to a running server such as the dev_appserver. Each queue is rate
+limited by a token bucket using the rate and bucket_size from queue.yaml. A
+task whose handler does not return a 2xx status is retried with exponential
+backoff.
+"""
+
+
+
+import cStringIO
+import httplib
+import logging
+import threading
+import time
+import urlparse
+
+from google.appengine.api import queueinfo
+from google.appengine.api.labs.taskqueue import taskqueue_service_pb
+from google.appengine.api.labs.taskqueue import taskqueue_stub
+
+DEFAULT_WORKERS = 4
+DEFAULT_LEASE_SECONDS = 60
+DEFAULT_MIN_BACKOFF_SECONDS = 0.1
+DEFAULT_MAX_BACKOFF_SECONDS = 3600
+DEFAULT_POLL_SECONDS = 0.1
+DEFAULT_STOP_SECONDS = 10
+QUEUE_REFRESH_SECONDS = 5
+
+_METHOD_NAMES = {
+    taskqueue_service_pb.TaskQueueAddRequest.GET: 'GET',
+    taskqueue_service_pb.TaskQueueAddRequest.POST: 'POST',
+    taskqueue_service_pb.TaskQueueAddRequest.HEAD: 'HEAD',
+    taskqueue_service_pb.TaskQueueAddRequest.PUT: 'PUT',
+    taskqueue_service_pb.TaskQueueAddRequest.DELETE: 'DELETE',
+}
+
+
+class WsgiDispatcher(object):
+  """Runs tasks by calling a WSGI application in the worker thread."""
+
+  def __init__(self, application, server_name='localhost', server_port='80'):
+    """Constructor.
+
+    Args:
+      application: The WSGI application to call.
+      server_name: Value of SERVER_NAME in the WSGI environment.
+      server_port: Value of SERVER_PORT in the WSGI environment.
+    """
+    self._application = application
+    self._server_name = server_name
+    self._server_port = server_port
+
+  def __call__(self, method, url, headers, body):
+    """Runs one task.
+
+    Args:
+      method: The HTTP method, e.g. 'POST'.
+      url: The relative URL of the task, possibly with a query string.
+      headers: List of (name, value) tuples.
+      body: The body of the request.
+
+    Returns:
+      The HTTP status code returned by the application.
+    """
+    path, _, query = url.partition('?')
+    environ = {
+        'REQUEST_METHOD': method,
+        'SCRIPT_NAME': '',
+        'PATH_INFO': path,
+        'QUERY_STRING': query,
+        'SERVER_NAME': self._server_name,
+        'SERVER_PORT': self._server_port,
+        'SERVER_PROTOCOL': 'HTTP/1.1',
+        'CONTENT_LENGTH': str(len(body)),
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': 'http',
+        'wsgi.input': cStringIO.StringIO(body),
+        'wsgi.errors': cStringIO.StringIO(),
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': False,
+        'wsgi.run_once': False,
+    }
+    for name, value in headers:
+      name = name.upper().replace('-', '_')
+      if name == 'CONTENT_TYPE':
+        environ['CONTENT_TYPE'] = value
+      else:
+        environ['HTTP_' + name] = value
+
+    status = []
+
+    def StartResponse(response_status, unused_headers, exc_info=None):
+      status[:] = [response_status]
+      return lambda unused_data: None
+
+    result = self._application(environ, StartResponse)
+    try:
+      for _ in result:
+        pass
+    finally:
+      if hasattr(result, 'close'):
+        result.close()
+    return int(status[0].split(' ', 1)[0])
+
+
+class HttpDispatcher(object):
+  """Runs tasks by sending them to a running server over HTTP."""
+
+  def __init__(self, host, port, extra_headers=None, timeout=None):
+    """Constructor.
+
+    Args:
+      host: The host name of the server.
+      port: The port of the server.
+      extra_headers: Optional list of (name, value) tuples to send with every
+        task, e.g. a cookie that makes the dev_appserver treat the request as
+        coming from an administrator.
+      timeout: Optional timeout in seconds for each request.
+    """
+    self._host = host
+    self._port = port
+    self._extra_headers = extra_headers or []
+    self._timeout = timeout
+
+  def __call__(self, method, url, headers, body):
+    """Runs one task. See WsgiDispatcher.__call__()."""
+    if self._timeout is None:
+      connection = httplib.HTTPConnection(self._host, self._port)
+    else:
+      connection = httplib.HTTPConnection(self._host, self._port,
+                                          timeout=self._timeout)
+    try:
+      connection.request(method, url, body,
+                         dict(list(headers) + list(self._extra_headers)))
+      response = connection.getresponse()
+      response.read()
+      return response.status
+    finally:
+      connection.close()
+
+
+class _TokenBucket(object):
+  """Limits the rate at which a queue's tasks are started."""
+
+  def __init__(self, rate, size, now):
+    """Constructor.
+
+    Args:
+      rate: Tokens added per second.
+      size: The most tokens the bucket holds.
+      now: The current time in seconds.
+    """
+    self.rate = rate
+    self.size = max(size, 1)
+    self._tokens = float(self.size)
+    self._last_refill = now
+
+  def _Refill(self, now):
+    """Adds the tokens accumulated since the last refill."""
+    if now > self._last_refill:
+      self._tokens = min(self.size,
+                         self._tokens + (now - self._last_refill) * self.rate)
+      self._last_refill = now
+
+  def TryTake(self, now):
+    """Takes a token if one is available; returns True if it did."""
+    self._Refill(now)
+    if self._tokens >= 1:
+      self._tokens -= 1
+      return True
+    return False
+
+  def PutBack(self):
+    """Returns a token taken by TryTake() that was not used."""
+    self._tokens = min(self.size, self._tokens + 1)
+
+  def SecondsUntilToken(self, now):
+    """Returns how long until a token is available, or None if never."""
+    self._Refill(now)
+    if self._tokens >= 1:
+      return 0
+    if not self.rate:
+      return None
+    return (1 - self._tokens) / self.rate
+
+
+class _QueueMetrics(object):
+  """Counters for the tasks a TaskExecutor has run from one queue."""
+
+  def __init__(self):
+    self.succeeded = 0
+    self.failed = 0
+    self.run_seconds = 0.0
+    self.max_run_seconds = 0.0
+    self.wait_seconds = 0.0
+    self.max_wait_seconds = 0.0
+
+  def Record(self, succeeded, run_seconds, wait_seconds):
+    """Records one attempt to run a task.
+
+    Args:
+      succeeded: True if the task succeeded.
+      run_seconds: How long the dispatcher took.
+      wait_seconds: How long after its ETA the task was started.
+    """
+    if succeeded:
+      self.succeeded += 1
+    else:
+      self.failed += 1
+    self.run_seconds += run_seconds
+    self.max_run_seconds = max(self.max_run_seconds, run_seconds)
+    self.wait_seconds += wait_seconds
+    self.max_wait_seconds = max(self.max_wait_seconds, wait_seconds)
+
+  def ToDict(self, elapsed_seconds):
+    """Returns the metrics as a dictionary; see GetQueueMetrics()."""
+    attempts = self.succeeded + self.failed
+    result = {
+        'succeeded': self.succeeded,
+        'failed': self.failed,
+        'tasks_per_second': None,
+        'mean_run_seconds': None,
+        'max_run_seconds': self.max_run_seconds,
+        'mean_wait_seconds': None,
+        'max_wait_seconds': self.max_wait_seconds,
+    }
+    if elapsed_seconds > 0:
+      result['tasks_per_second'] = self.succeeded / elapsed_seconds
+    if attempts:
+      result['mean_run_seconds'] = self.run_seconds / attempts
+      result['mean_wait_seconds'] = self.wait_seconds / attempts
+    return result
+
+
+class TaskExecutor(object):
+  """Leases tasks from a TaskQueueServiceStub and runs them on worker threads.
+
+  A task is leased when it is due and its queue's token bucket has a token.
+  It is deleted from the stub once the dispatcher returns a 2xx status.
+  Otherwise, or if the dispatcher raises an exception, it is rescheduled
+  after a backoff that doubles with every failed attempt. A task that is
+  still running when its lease expires may be started again.
+  """
+
+  def __init__(self, stub, dispatcher, workers=DEFAULT_WORKERS,
+               lease_seconds=DEFAULT_LEASE_SECONDS,
+               min_backoff_seconds=DEFAULT_MIN_BACKOFF_SECONDS,
+               max_backoff_seconds=DEFAULT_MAX_BACKOFF_SECONDS,
+               poll_seconds=DEFAULT_POLL_SECONDS, gettime=time.time):
+    """Constructor.
+
+    Args:
+      stub: The TaskQueueServiceStub whose tasks to run.
+      dispatcher: Callable taking the HTTP method, relative URL, list of
+        (name, value) header tuples and body of a task, and returning the
+        HTTP status code; e.g. a WsgiDispatcher or HttpDispatcher.
+      workers: The most tasks to run at once, each on its own thread.
+      lease_seconds: How long a task may run before it is run again.
+      min_backoff_seconds: Delay before the first retry of a failed task.
+      max_backoff_seconds: The longest delay between retries.
+      poll_seconds: The longest the scheduler sleeps before checking for
+        newly added tasks.
+      gettime: time.time()-like function used for testing.
+    """
+    self._stub = stub
+    self._dispatcher = dispatcher
+    self._workers = workers
+    self._lease_seconds = lease_seconds
+    self._min_backoff_seconds = min_backoff_seconds
+    self._max_backoff_seconds = max_backoff_seconds
+    self._poll_seconds = poll_seconds
+    self._gettime = gettime
+
+    self._lock = threading.Lock()
+    self._wakeup = threading.Event()
+    self._idle_workers = threading.Semaphore(workers)
+    self._running = False
+    self._threads = []
+    self._buckets = {}
+    self._buckets_refreshed = None
+    self._retry_counts = {}
+    self._metrics = {}
+    self._start_time = None
+
+  def Start(self):
+    """Starts running tasks in a background thread."""
+    if self._running:
+      return
+    self._running = True
+    self._start_time = self._gettime()
+    thread = threading.Thread(target=self._Schedule,
+                              name='TaskExecutor scheduler')
+    thread.setDaemon(True)
+    thread.start()
+    self._threads = [thread]
+
+  def Stop(self, timeout=DEFAULT_STOP_SECONDS):
+    """Stops leasing tasks and waits for the running ones to finish.
+
+    Args:
+      timeout: The longest to wait, in seconds, or None to wait for every
+        running task. Tasks still running after that are left to finish on
+        their daemon threads; if they do not, their leases expire and they
+        are run again the next time the executor is started.
+    """
+    self._running = False
+    self._wakeup.set()
+    deadline = None
+    if timeout is not None:
+      deadline = time.time() + timeout
+    for thread in self._threads:
+      if deadline is None:
+        thread.join()
+      else:
+        thread.join(max(0, deadline - time.time()))
+    idle = 0
+    while idle < self._workers:
+      if deadline is None:
+        self._idle_workers.acquire()
+      elif not self._idle_workers.acquire(False):
+        remaining = deadline - time.time()
+        if remaining <= 0:
+          logging.warning('Stopped with %d tasks still running',
+                          self._workers - idle)
+          break
+        time.sleep(min(self._poll_seconds, remaining))
+        continue
+      idle += 1
+    for _ in xrange(idle):
+      self._idle_workers.release()
+    self._threads = []
+
+  def RunDueTasks(self):
+    """Runs every task that is due now in the calling thread.
+
+    Ignores the rate limits, so that tests can run a fan-out to completion
+    without a background thread. Tasks rescheduled for a retry are not run
+    again by the same call.
+
+    Returns:
+      The number of tasks run.
+    """
+    if self._start_time is None:
+      self._start_time = self._gettime()
+    count = 0
+    for queue_name in self._QueueNames():
+      now = self._gettime()
+      while True:
+        task = self._stub.LeaseTask(queue_name, int(now * 1e6),
+                                    self._lease_seconds)
+        if task is None:
+          break
+        self._Run(queue_name, task)
+        count += 1
+    self._PruneRetryCounts()
+    return count
+
+  def GetQueueMetrics(self):
+    """Gets throughput and latency metrics for each queue.
+
+    Returns:
+      A dictionary mapping each queue name that has had tasks run to a
+      dictionary with the number of attempts that 'succeeded' and 'failed';
+      'tasks_per_second', the tasks completed per second since the executor
+      started; 'mean_run_seconds' and 'max_run_seconds', the time spent in
+      the dispatcher; and 'mean_wait_seconds' and 'max_wait_seconds', how
+      long after their ETA tasks were started.
+    """
+    elapsed_seconds = 0
+    if self._start_time is not None:
+      elapsed_seconds = self._gettime() - self._start_time
+    self._lock.acquire()
+    try:
+      return dict((queue_name, metrics.ToDict(elapsed_seconds))
+                  for queue_name, metrics in self._metrics.iteritems())
+    finally:
+      self._lock.release()
+
+  def _QueueNames(self):
+    """Returns the names of the queues configured in the stub."""
+    return [queue['name'] for queue in self._stub.GetQueues()]
+
+  def _RefreshBuckets(self, now):
+    """Rereads the queues' rates and bucket sizes from the stub."""
+    buckets = {}
+    for queue in self._stub.GetQueues():
+      rate = queueinfo.ParseRate(queue['max_rate'])
+      size = queue['bucket_size']
+      bucket = self._buckets.get(queue['name'])
+      if bucket is None or bucket.rate != rate or bucket.size != max(size, 1):
+        bucket = _TokenBucket(rate, size, now)
+      buckets[queue['name']] = bucket
+    self._buckets = buckets
+    self._buckets_refreshed = now
+
+  def _PruneRetryCounts(self):
+    """Forgets the retry counts of tasks that are no longer in the stub.
+
+    A task that failed keeps its retry count until it succeeds, so the count
+    of a task deleted or flushed while waiting for its retry would otherwise
+    be kept forever.
+    """
+    self._lock.acquire()
+    try:
+      task_keys = self._retry_counts.keys()
+    finally:
+      self._lock.release()
+
+    gone = [task_key for task_key in task_keys
+            if not self._stub.HasTask(*task_key)]
+    if gone:
+      self._lock.acquire()
+      try:
+        for task_key in gone:
+          self._retry_counts.pop(task_key, None)
+      finally:
+        self._lock.release()
+
+  def _Schedule(self):
+    """Body of the scheduler thread."""
+    while self._running:
+      now = self._gettime()
+      if (self._buckets_refreshed is None or
+          now - self._buckets_refreshed >= QUEUE_REFRESH_SECONDS):
+        self._RefreshBuckets(now)
+        self._PruneRetryCounts()
+
+      sleep_seconds = self._poll_seconds
+      for queue_name, bucket in self._buckets.iteritems():
+        while self._running:
+          if not self._idle_workers.acquire(False):
+            break
+          if not bucket.TryTake(now):
+            self._idle_workers.release()
+            token_seconds = bucket.SecondsUntilToken(now)
+            if token_seconds is not None:
+              sleep_seconds = min(sleep_seconds, token_seconds)
+            break
+          task = self._stub.LeaseTask(queue_name, int(now * 1e6),
+                                      self._lease_seconds)
+          if task is None:
+            bucket.PutBack()
+            self._idle_workers.release()
+            break
+          thread = threading.Thread(target=self._Work,
+                                    args=(queue_name, task),
+                                    name='TaskExecutor worker')
+          thread.setDaemon(True)
+          thread.start()
+
+      self._wakeup.wait(sleep_seconds)
+      self._wakeup.clear()
+
+  def _Work(self, queue_name, task):
+    """Body of a worker thread, which runs a single task."""
+    try:
+      self._Run(queue_name, task)
+    finally:
+      self._idle_workers.release()
+      self._wakeup.set()
+
+  def _Run(self, queue_name, task):
+    """Runs a leased task and deletes or reschedules it.
+
+    Args:
+      queue_name: The name of the queue the task was leased from.
+      task: The leased taskqueue_service_pb.TaskQueueAddRequest.
+    """
+    task_key = (queue_name, task.task_name())
+    self._lock.acquire()
+    try:
+      retry_count = self._retry_counts.get(task_key, 0)
+    finally:
+      self._lock.release()
+
+    headers = [(header.key(), header.value())
+               for header in task.header_list()
+               if header.key().lower() not in taskqueue_stub.BUILT_IN_HEADERS]
+    headers.append(('X-AppEngine-QueueName', queue_name))
+    headers.append(('X-AppEngine-TaskName', task.task_name()))
+    headers.append(('X-AppEngine-TaskRetryCount', str(retry_count)))
+
+    start = self._gettime()
+    wait_seconds = max(0, start - task.eta_usec() / 1e6)
+    try:
+      status = self._dispatcher(_METHOD_NAMES[task.method()], task.url(),
+                                headers, task.body())
+    except Exception:
+      logging.exception('Task %s in queue %s raised an exception',
+                        task.task_name(), queue_name)
+      status = None
+    end = self._gettime()
+    succeeded = status is not None and 200 <= status < 300
+
+    self._lock.acquire()
+    try:
+      metrics = self._metrics.get(queue_name)
+      if metrics is None:
+        metrics = self._metrics[queue_name] = _QueueMetrics()
+      metrics.Record(succeeded, end - start, wait_seconds)
+      if succeeded:
+        self._retry_counts.pop(task_key, None)
+      else:
+        self._retry_counts[task_key] = retry_count + 1
+    finally:
+      self._lock.release()
+
+    if succeeded:
+      self._stub.DeleteTask(queue_name, task.task_name())
+    else:
+      backoff_seconds = min(self._min_backoff_seconds * 2 ** retry_count,
+                            self._max_backoff_seconds)
+      logging.info('Task %s in queue %s failed with status %s; retrying in '
+                   '%.1f seconds', task.task_name(), queue_name, status,
+                   backoff_seconds)
+      if not self._stub.RescheduleTask(queue_name, task.task_name(),
+                                       int((end + backoff_seconds) * 1e6)):
+        self._lock.acquire()
+        try:
+          self._retry_counts.pop(task_key, None)
+        finally:
+          self._lock.release()
@@ -853,6 +853,299 @@ class TaskQueueAddResponse(ProtocolBuffer.ProtocolMessage):
     1: ProtocolBuffer.Encoder.STRING,
   }, 1, ProtocolBuffer.Encoder.MAX_TYPE)
 
+  _STYLE = """"""
+  _STYLE_CONTENT_TYPE = """"""
+class TaskQueueBulkAddRequest(ProtocolBuffer.ProtocolMessage):
+
+  def __init__(self, contents=None):
+    self.add_request_ = []
+    if contents is not None: self.MergeFromString(contents)
+
+  def add_request_size(self): return len(self.add_request_)
+  def add_request_list(self): return self.add_request_
+
+  def add_request(self, i):
+    return self.add_request_[i]
+
+  def mutable_add_request(self, i):
+    return self.add_request_[i]
+
+  def add_add_request(self):
+    x = TaskQueueAddRequest()
+    self.add_request_.append(x)
+    return x
+
+  def clear_add_request(self):
+    self.add_request_ = []
+
+  def MergeFrom(self, x):
+    assert x is not self
+    for i in xrange(x.add_request_size()): self.add_add_request().CopyFrom(x.add_request(i))
+
+  def Equals(self, x):
+    if x is self: return 1
+    if len(self.add_request_) != len(x.add_request_): return 0
+    for e1, e2 in zip(self.add_request_, x.add_request_):
+      if e1 != e2: return 0
+    return 1
+
+  def IsInitialized(self, debug_strs=None):
+    initialized = 1
+    for p in self.add_request_:
+      if not p.IsInitialized(debug_strs): initialized=0
+    return initialized
+
+  def ByteSize(self):
+    n = 0
+    n += 1 * len(self.add_request_)
+    for i in xrange(len(self.add_request_)): n += self.lengthString(self.add_request_[i].ByteSize())
+    return n + 0
+
+  def Clear(self):
+    self.clear_add_request()
+
+  def OutputUnchecked(self, out):
+    for i in xrange(len(self.add_request_)):
+      out.putVarInt32(10)
+      out.putVarInt32(self.add_request_[i].ByteSize())
+      self.add_request_[i].OutputUnchecked(out)
+
+  def TryMerge(self, d):
+    while d.avail() > 0:
+      tt = d.getVarInt32()
+      if tt == 10:
+        length = d.getVarInt32()
+        tmp = ProtocolBuffer.Decoder(d.buffer(), d.pos(), d.pos() + length)
+        d.skip(length)
+        self.add_add_request().TryMerge(tmp)
+        continue
+      if (tt == 0): raise ProtocolBuffer.ProtocolBufferDecodeError
+      d.skipData(tt)
+
+
+  def __str__(self, prefix="", printElemNumber=0):
+    res=""
+    cnt=0
+    for e in self.add_request_:
+      elm=""
+      if printElemNumber: elm="(%d)" % cnt
+      res+=prefix+("add_request%s <\n" % elm)
+      res+=e.__str__(prefix + "  ", printElemNumber)
+      res+=prefix+">\n"
+      cnt+=1
+    return res
+
+
+  def _BuildTagLookupTable(sparse, maxtag, default=None):
+    return tuple([sparse.get(i, default) for i in xrange(0, 1+maxtag)])
+
+  kadd_request = 1
+
+  _TEXT = _BuildTagLookupTable({
+    0: "ErrorCode",
+    1: "add_request",
+  }, 1)
+
+  _TYPES = _BuildTagLookupTable({
+    0: ProtocolBuffer.Encoder.NUMERIC,
+    1: ProtocolBuffer.Encoder.STRING,
+  }, 1, ProtocolBuffer.Encoder.MAX_TYPE)
+
+  _STYLE = """"""
+  _STYLE_CONTENT_TYPE = """"""
+class TaskQueueBulkAddResponse_TaskResult(ProtocolBuffer.ProtocolMessage):
+  has_result_ = 0
+  result_ = 0
+  has_chosen_task_name_ = 0
+  chosen_task_name_ = ""
+
+  def __init__(self, contents=None):
+    if contents is not None: self.MergeFromString(contents)
+
+  def result(self): return self.result_
+
+  def set_result(self, x):
+    self.has_result_ = 1
+    self.result_ = x
+
+  def clear_result(self):
+    if self.has_result_:
+      self.has_result_ = 0
+      self.result_ = 0
+
+  def has_result(self): return self.has_result_
+
+  def chosen_task_name(self): return self.chosen_task_name_
+
+  def set_chosen_task_name(self, x):
+    self.has_chosen_task_name_ = 1
+    self.chosen_task_name_ = x
+
+  def clear_chosen_task_name(self):
+    if self.has_chosen_task_name_:
+      self.has_chosen_task_name_ = 0
+      self.chosen_task_name_ = ""
+
+  def has_chosen_task_name(self): return self.has_chosen_task_name_
+
+
+  def MergeFrom(self, x):
+    assert x is not self
+    if (x.has_result()): self.set_result(x.result())
+    if (x.has_chosen_task_name()): self.set_chosen_task_name(x.chosen_task_name())
+
+  def Equals(self, x):
+    if x is self: return 1
+    if self.has_result_ != x.has_result_: return 0
+    if self.has_result_ and self.result_ != x.result_: return 0
+    if self.has_chosen_task_name_ != x.has_chosen_task_name_: return 0
+    if self.has_chosen_task_name_ and self.chosen_task_name_ != x.chosen_task_name_: return 0
+    return 1
+
+  def IsInitialized(self, debug_strs=None):
+    initialized = 1
+    if (not self.has_result_):
+      initialized = 0
+      if debug_strs is not None:
+        debug_strs.append('Required field: result not set.')
+    return initialized
+
+  def ByteSize(self):
+    n = 0
+    n += self.lengthVarInt64(self.result_)
+    if (self.has_chosen_task_name_): n += 1 + self.lengthString(len(self.chosen_task_name_))
+    return n + 1
+
+  def Clear(self):
+    self.clear_result()
+    self.clear_chosen_task_name()
+
+  def OutputUnchecked(self, out):
+    out.putVarInt32(16)
+    out.putVarInt32(self.result_)
+    if (self.has_chosen_task_name_):
+      out.putVarInt32(26)
+      out.putPrefixedString(self.chosen_task_name_)
+
+  def TryMerge(self, d):
+    while 1:
+      tt = d.getVarInt32()
+      if tt == 12: break
+      if tt == 16:
+        self.set_result(d.getVarInt32())
+        continue
+      if tt == 26:
+        self.set_chosen_task_name(d.getPrefixedString())
+        continue
+      if (tt == 0): raise ProtocolBuffer.ProtocolBufferDecodeError
+      d.skipData(tt)
+
+
+  def __str__(self, prefix="", printElemNumber=0):
+    res=""
+    if self.has_result_: res+=prefix+("result: %s\n" % self.DebugFormatInt32(self.result_))
+    if self.has_chosen_task_name_: res+=prefix+("chosen_task_name: %s\n" % self.DebugFormatString(self.chosen_task_name_))
+    return res
+
+class TaskQueueBulkAddResponse(ProtocolBuffer.ProtocolMessage):
+
+  def __init__(self, contents=None):
+    self.taskresult_ = []
+    if contents is not None: self.MergeFromString(contents)
+
+  def taskresult_size(self): return len(self.taskresult_)
+  def taskresult_list(self): return self.taskresult_
+
+  def taskresult(self, i):
+    return self.taskresult_[i]
+
+  def mutable_taskresult(self, i):
+    return self.taskresult_[i]
+
+  def add_taskresult(self):
+    x = TaskQueueBulkAddResponse_TaskResult()
+    self.taskresult_.append(x)
+    return x
+
+  def clear_taskresult(self):
+    self.taskresult_ = []
+
+  def MergeFrom(self, x):
+    assert x is not self
+    for i in xrange(x.taskresult_size()): self.add_taskresult().CopyFrom(x.taskresult(i))
+
+  def Equals(self, x):
+    if x is self: return 1
+    if len(self.taskresult_) != len(x.taskresult_): return 0
+    for e1, e2 in zip(self.taskresult_, x.taskresult_):
+      if e1 != e2: return 0
+    return 1
+
+  def IsInitialized(self, debug_strs=None):
+    initialized = 1
+    for p in self.taskresult_:
+      if not p.IsInitialized(debug_strs): initialized=0
+    return initialized
+
+  def ByteSize(self):
+    n = 0
+    n += 2 * len(self.taskresult_)
+    for i in xrange(len(self.taskresult_)): n += self.taskresult_[i].ByteSize()
+    return n + 0
+
+  def Clear(self):
+    self.clear_taskresult()
+
+  def OutputUnchecked(self, out):
+    for i in xrange(len(self.taskresult_)):
+      out.putVarInt32(11)
+      self.taskresult_[i].OutputUnchecked(out)
+      out.putVarInt32(12)
+
+  def TryMerge(self, d):
+    while d.avail() > 0:
+      tt = d.getVarInt32()
+      if tt == 11:
+        self.add_taskresult().TryMerge(d)
+        continue
+      if (tt == 0): raise ProtocolBuffer.ProtocolBufferDecodeError
+      d.skipData(tt)
+
+
+  def __str__(self, prefix="", printElemNumber=0):
+    res=""
+    cnt=0
+    for e in self.taskresult_:
+      elm=""
+      if printElemNumber: elm="(%d)" % cnt
+      res+=prefix+("TaskResult%s {\n" % elm)
+      res+=e.__str__(prefix + "  ", printElemNumber)
+      res+=prefix+"}\n"
+      cnt+=1
+    return res
+
+
+  def _BuildTagLookupTable(sparse, maxtag, default=None):
+    return tuple([sparse.get(i, default) for i in xrange(0, 1+maxtag)])
+
+  kTaskResultGroup = 1
+  kTaskResultresult = 2
+  kTaskResultchosen_task_name = 3
+
+  _TEXT = _BuildTagLookupTable({
+    0: "ErrorCode",
+    1: "TaskResult",
+    2: "result",
+    3: "chosen_task_name",
+  }, 3)
+
+  _TYPES = _BuildTagLookupTable({
+    0: ProtocolBuffer.Encoder.NUMERIC,
+    1: ProtocolBuffer.Encoder.STARTGROUP,
+    2: ProtocolBuffer.Encoder.NUMERIC,
+    3: ProtocolBuffer.Encoder.STRING,
+  }, 3, ProtocolBuffer.Encoder.MAX_TYPE)
+
   _STYLE = """"""
   _STYLE_CONTENT_TYPE = """"""
 class TaskQueueDeleteRequest(ProtocolBuffer.ProtocolMessage):
@@ -1900,6 +2193,8 @@ class TaskQueueScannerQueueInfo(ProtocolBuffer.ProtocolMessage):
   executed_last_hour_ = 0
   has_sampling_duration_seconds_ = 0
   sampling_duration_seconds_ = 0.0
+  has_requests_in_flight_ = 0
+  requests_in_flight_ = 0
 
   def __init__(self, contents=None):
     if contents is not None: self.MergeFromString(contents)
@@ -1943,12 +2238,26 @@ class TaskQueueScannerQueueInfo(ProtocolBuffer.ProtocolMessage):
 
   def has_sampling_duration_seconds(self): return self.has_sampling_duration_seconds_
 
+  def requests_in_flight(self): return self.requests_in_flight_
+
+  def set_requests_in_flight(self, x):
+    self.has_requests_in_flight_ = 1
+    self.requests_in_flight_ = x
+
+  def clear_requests_in_flight(self):
+    if self.has_requests_in_flight_:
+      self.has_requests_in_flight_ = 0
+      self.requests_in_flight_ = 0
+
+  def has_requests_in_flight(self): return self.has_requests_in_flight_
+
 
   def MergeFrom(self, x):
     assert x is not self
     if (x.has_executed_last_minute()): self.set_executed_last_minute(x.executed_last_minute())
     if (x.has_executed_last_hour()): self.set_executed_last_hour(x.executed_last_hour())
     if (x.has_sampling_duration_seconds()): self.set_sampling_duration_seconds(x.sampling_duration_seconds())
+    if (x.has_requests_in_flight()): self.set_requests_in_flight(x.requests_in_flight())
 
   def Equals(self, x):
     if x is self: return 1
@@ -1958,6 +2267,8 @@ class TaskQueueScannerQueueInfo(ProtocolBuffer.ProtocolMessage):
     if self.has_executed_last_hour_ and self.executed_last_hour_ != x.executed_last_hour_: return 0
     if self.has_sampling_duration_seconds_ != x.has_sampling_duration_seconds_: return 0
     if self.has_sampling_duration_seconds_ and self.sampling_duration_seconds_ != x.sampling_duration_seconds_: return 0
+    if self.has_requests_in_flight_ != x.has_requests_in_flight_: return 0
+    if self.has_requests_in_flight_ and self.requests_in_flight_ != x.requests_in_flight_: return 0
     return 1
 
   def IsInitialized(self, debug_strs=None):
@@ -1980,12 +2291,14 @@ class TaskQueueScannerQueueInfo(ProtocolBuffer.ProtocolMessage):
     n = 0
     n += self.lengthVarInt64(self.executed_last_minute_)
     n += self.lengthVarInt64(self.executed_last_hour_)
+    if (self.has_requests_in_flight_): n += 1 + self.lengthVarInt64(self.requests_in_flight_)
     return n + 11
 
   def Clear(self):
     self.clear_executed_last_minute()
     self.clear_executed_last_hour()
     self.clear_sampling_duration_seconds()
+    self.clear_requests_in_flight()
 
   def OutputUnchecked(self, out):
     out.putVarInt32(8)
@@ -1994,6 +2307,9 @@ class TaskQueueScannerQueueInfo(ProtocolBuffer.ProtocolMessage):
     out.putVarInt64(self.executed_last_hour_)
     out.putVarInt32(25)
     out.putDouble(self.sampling_duration_seconds_)
+    if (self.has_requests_in_flight_):
+      out.putVarInt32(32)
+      out.putVarInt32(self.requests_in_flight_)
 
   def TryMerge(self, d):
     while d.avail() > 0:
@@ -2007,6 +2323,9 @@ class TaskQueueScannerQueueInfo(ProtocolBuffer.ProtocolMessage):
       if tt == 25:
         self.set_sampling_duration_seconds(d.getDouble())
         continue
+      if tt == 32:
+        self.set_requests_in_flight(d.getVarInt32())
+        continue
       if (tt == 0): raise ProtocolBuffer.ProtocolBufferDecodeError
       d.skipData(tt)
 
@@ -2016,6 +2335,7 @@ class TaskQueueScannerQueueInfo(ProtocolBuffer.ProtocolMessage):
     if self.has_executed_last_minute_: res+=prefix+("executed_last_minute: %s\n" % self.DebugFormatInt64(self.executed_last_minute_))
     if self.has_executed_last_hour_: res+=prefix+("executed_last_hour: %s\n" % self.DebugFormatInt64(self.executed_last_hour_))
     if self.has_sampling_duration_seconds_: res+=prefix+("sampling_duration_seconds: %s\n" % self.DebugFormat(self.sampling_duration_seconds_))
+    if self.has_requests_in_flight_: res+=prefix+("requests_in_flight: %s\n" % self.DebugFormatInt32(self.requests_in_flight_))
     return res
 
 
@@ -2025,20 +2345,23 @@ class TaskQueueScannerQueueInfo(ProtocolBuffer.ProtocolMessage):
   kexecuted_last_minute = 1
   kexecuted_last_hour = 2
   ksampling_duration_seconds = 3
+  krequests_in_flight = 4
 
   _TEXT = _BuildTagLookupTable({
     0: "ErrorCode",
     1: "executed_last_minute",
     2: "executed_last_hour",
     3: "sampling_duration_seconds",
-  }, 3)
+    4: "requests_in_flight",
+  }, 4)
 
   _TYPES = _BuildTagLookupTable({
     0: ProtocolBuffer.Encoder.NUMERIC,
     1: ProtocolBuffer.Encoder.NUMERIC,
     2: ProtocolBuffer.Encoder.NUMERIC,
     3: ProtocolBuffer.Encoder.DOUBLE,
-  }, 3, ProtocolBuffer.Encoder.MAX_TYPE)
+    4: ProtocolBuffer.Encoder.NUMERIC,
+  }, 4, ProtocolBuffer.Encoder.MAX_TYPE)
 
   _STYLE = """"""
   _STYLE_CONTENT_TYPE = """"""
@@ -3766,4 +4089,4 @@ class TaskQueueQueryTasksResponse(ProtocolBuffer.ProtocolMessage):
   _STYLE = """"""
   _STYLE_CONTENT_TYPE = """"""
 
-__all__ = ['TaskQueueServiceError','TaskQueueAddRequest','TaskQueueAddRequest_Header','TaskQueueAddRequest_CronTimetable','TaskQueueAddResponse','TaskQueueDeleteRequest','TaskQueueDeleteResponse','TaskQueueUpdateQueueRequest','TaskQueueUpdateQueueResponse','TaskQueueFetchQueuesRequest','TaskQueueFetchQueuesResponse','TaskQueueFetchQueuesResponse_Queue','TaskQueueFetchQueueStatsRequest','TaskQueueScannerQueueInfo','TaskQueueFetchQueueStatsResponse','TaskQueueFetchQueueStatsResponse_QueueStats','TaskQueuePurgeQueueRequest','TaskQueuePurgeQueueResponse','TaskQueueDeleteQueueRequest','TaskQueueDeleteQueueResponse','TaskQueueQueryTasksRequest','TaskQueueQueryTasksResponse','TaskQueueQueryTasksResponse_TaskHeader','TaskQueueQueryTasksResponse_TaskCronTimetable','TaskQueueQueryTasksResponse_TaskRunLog','TaskQueueQueryTasksResponse_Task']
+__all__ = ['TaskQueueServiceError','TaskQueueAddRequest','TaskQueueAddRequest_Header','TaskQueueAddRequest_CronTimetable','TaskQueueAddResponse','TaskQueueBulkAddRequest','TaskQueueBulkAddResponse','TaskQueueBulkAddResponse_TaskResult','TaskQueueDeleteRequest','TaskQueueDeleteResponse','TaskQueueUpdateQueueRequest','TaskQueueUpdateQueueResponse','TaskQueueFetchQueuesRequest','TaskQueueFetchQueuesResponse','TaskQueueFetchQueuesResponse_Queue','TaskQueueFetchQueueStatsRequest','TaskQueueScannerQueueInfo','TaskQueueFetchQueueStatsResponse','TaskQueueFetchQueueStatsResponse_QueueStats','TaskQueuePurgeQueueRequest','TaskQueuePurgeQueueResponse','TaskQueueDeleteQueueRequest','TaskQueueDeleteQueueResponse','TaskQueueQueryTasksRequest','TaskQueueQueryTasksResponse','TaskQueueQueryTasksResponse_TaskHeader','TaskQueueQueryTasksResponse_TaskCronTimetable','TaskQueueQueryTasksResponse_TaskRunLog','TaskQueueQueryTasksResponse_Task']
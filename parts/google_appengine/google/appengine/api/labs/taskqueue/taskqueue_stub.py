@@ -17,12 +17,20 @@
 
 """Stub version of the Task Queue API.
 
-This stub only stores tasks; it doesn't actually run them. It also validates
+This stub only stores tasks; it doesn't actually run them, although a
+taskqueue_executor.TaskExecutor can lease and run them. It also validates
 the tasks by checking their queue name against the queue.yaml.
 
 As well as implementing Task Queue API functions, the stub exposes various other
 functions that are used by the dev_appserver's admin console to display the
 application's queues and tasks.
+
+The stub keeps running statistics of each queue, such as its enqueue and
+execution rates and how late its tasks start, which GetQueueStats() returns.
+
+If the stub is given a persistence_path, its tasks survive restarts: the stub
+keeps a snapshot of its queues in that file and a journal of the tasks added,
+deleted, leased and rescheduled since the snapshot next to it.
 """
 
 
@@ -31,10 +39,13 @@ application's queues and tasks.
 import base64
 import bisect
 import datetime
+import gc
+import heapq
 import logging
 import os
 import random
 import string
+import threading
 import time
 
 import taskqueue_service_pb
@@ -43,6 +54,7 @@ from google.appengine.api import api_base_pb
 from google.appengine.api import apiproxy_stub
 from google.appengine.api import apiproxy_stub_map
 from google.appengine.api import queueinfo
+from google.appengine.api import stub_persistence
 from google.appengine.runtime import apiproxy_errors
 
 
@@ -64,6 +76,17 @@ DEFAULT_QUEUE_NAME = 'default'
 
 CRON_QUEUE_NAME = '__cron'
 
+_LOG_ADD = 0
+_LOG_DELETE = 1
+_LOG_ETA = 2
+_LOG_FLUSH = 3
+_LOG_TOMBSTONE = 4
+
+LATENESS_BUCKET_SECONDS = (0.01, 0.1, 1, 10, 60, 600, 3600)
+
+DEPTH_SAMPLE_SECONDS = 10
+DEPTH_SAMPLES = 360
+
 
 class _DummyTaskStore(object):
   """A class that encapsulates a sorted store of tasks.
@@ -253,21 +276,347 @@ def _ParseQueueYaml(unused_self, root_path):
   return None
 
 
-def _CompareTasksByEta(a, b):
-  """Python sort comparator for tasks by estimated time of arrival (ETA).
+class _TaskQueue(object):
+  """The tasks of one queue, indexed by ETA and by name.
 
-  Args:
-    a: A taskqueue_service_pb.TaskQueueAddRequest.
-    b: A taskqueue_service_pb.TaskQueueAddRequest.
+  Tasks are kept in a min-heap of (ETA, sequence number, task) entries, and
+  in a dictionary mapping each name to the current entry for its task.
+  Deleting or rescheduling a task only replaces its dictionary entry; the old
+  heap entry is skipped when it reaches the top of the heap, and the heap is
+  rebuilt once most of its entries are stale. The names of deleted tasks are
+  remembered as tombstones so that they cannot be reused, as in production,
+  until the queue is flushed.
+  """
 
-  Returns:
-    Standard 1/0/-1 comparison result.
+  def __init__(self):
+    """Constructor."""
+    self._heap = []
+    self._tasks = {}
+    self._tombstones = set()
+    self._next_sequence = 0
+
+  def _Push(self, task):
+    """Makes a heap entry for a task and records it as the current one."""
+    entry = (task.eta_usec(), self._next_sequence, task)
+    self._next_sequence += 1
+    self._tasks[task.task_name()] = entry
+    heapq.heappush(self._heap, entry)
+
+  def _IsCurrent(self, entry):
+    """Returns True if a heap entry is the current entry of a live task."""
+    return self._tasks.get(entry[2].task_name()) is entry
+
+  def _Compact(self):
+    """Drops stale heap entries once they make up most of the heap."""
+    if len(self._heap) > 2 * len(self._tasks) + 16:
+      self._heap = [entry for entry in self._heap if self._IsCurrent(entry)]
+      heapq.heapify(self._heap)
+
+  def Add(self, request):
+    """Adds a task.
+
+    Args:
+      request: A taskqueue_service_pb.TaskQueueAddRequest with a task name.
+
+    Raises:
+      apiproxy_errors.ApplicationError: If a task with the same name is in the
+      queue or was deleted from it.
+    """
+    name = request.task_name()
+    if name in self._tasks:
+      raise apiproxy_errors.ApplicationError(
+          taskqueue_service_pb.TaskQueueServiceError.TASK_ALREADY_EXISTS)
+    if name in self._tombstones:
+      raise apiproxy_errors.ApplicationError(
+          taskqueue_service_pb.TaskQueueServiceError.TOMBSTONED_TASK)
+    self._Push(request)
+
+  def Delete(self, name):
+    """Deletes a task by name, leaving a tombstone for its name.
+
+    Args:
+      name: The name of the task to delete.
+
+    Returns:
+      The deleted taskqueue_service_pb.TaskQueueAddRequest, or None if there
+      is no task with that name.
+    """
+    entry = self._tasks.pop(name, None)
+    if entry is None:
+      return None
+    self._tombstones.add(name)
+    self._Compact()
+    return entry[2]
+
+  def Reschedule(self, name, eta_usec):
+    """Changes the ETA of a task.
+
+    Args:
+      name: The name of the task.
+      eta_usec: The new ETA, in microseconds since the epoch.
+
+    Returns:
+      True if the task was found, False otherwise.
+    """
+    entry = self._tasks.get(name)
+    if entry is None:
+      return False
+    task = entry[2]
+    task.set_eta_usec(eta_usec)
+    self._Push(task)
+    self._Compact()
+    return True
+
+  def Peek(self):
+    """Returns the task with the earliest ETA, or None if the queue is empty."""
+    heap = self._heap
+    while heap and not self._IsCurrent(heap[0]):
+      heapq.heappop(heap)
+    if heap:
+      return heap[0][2]
+    return None
+
+  def Lease(self, now_usec, lease_usec):
+    """Leases the task with the earliest ETA, if it is due.
+
+    The task stays in the queue with its ETA moved to the end of the lease,
+    so that it runs again if it is not deleted before then.
+
+    Args:
+      now_usec: The current time, in microseconds since the epoch.
+      lease_usec: The length of the lease, in microseconds.
+
+    Returns:
+      A copy of the taskqueue_service_pb.TaskQueueAddRequest as it was before
+      it was leased, or None if no task is due.
+    """
+    task = self.Peek()
+    if task is None or task.eta_usec() > now_usec:
+      return None
+    leased = taskqueue_service_pb.TaskQueueAddRequest()
+    leased.CopyFrom(task)
+    self.Reschedule(task.task_name(), now_usec + lease_usec)
+    return leased
+
+  def Get(self, name):
+    """Returns the task with the given name, or None."""
+    entry = self._tasks.get(name)
+    if entry is None:
+      return None
+    return entry[2]
+
+  def Tasks(self):
+    """Returns all tasks, ordered by ETA."""
+    return [entry[2] for entry in sorted(self._tasks.itervalues())]
+
+  def Count(self):
+    """Returns the number of tasks in the queue."""
+    return len(self._tasks)
+
+  def Flush(self):
+    """Removes all tasks and forgets the names of deleted tasks."""
+    self._heap = []
+    self._tasks = {}
+    self._tombstones = set()
+
+  def Load(self, tasks):
+    """Adds tasks known to have distinct names to an empty queue at once.
+
+    Args:
+      tasks: List of named taskqueue_service_pb.TaskQueueAddRequests.
+    """
+    for task in tasks:
+      entry = (task.eta_usec(), self._next_sequence, task)
+      self._next_sequence += 1
+      self._tasks[task.task_name()] = entry
+      self._heap.append(entry)
+    heapq.heapify(self._heap)
+
+  def Tombstone(self, name):
+    """Remembers the name of a deleted task."""
+    self._tombstones.add(name)
+
+  def Tombstones(self):
+    """Returns the names of the deleted tasks."""
+    return list(self._tombstones)
+
+  def TombstoneCount(self):
+    """Returns the number of deleted task names remembered."""
+    return len(self._tombstones)
+
+
+class _RollingCounter(object):
+  """Counts events over a sliding window of fixed-size time buckets."""
+
+  def __init__(self, bucket_seconds, bucket_count):
+    """Constructor.
+
+    Args:
+      bucket_seconds: The length of each bucket.
+      bucket_count: The number of buckets in the window.
+    """
+    self._bucket_seconds = bucket_seconds
+    self._counts = [0] * bucket_count
+    self._current = None
+    self._total = 0
+
+  def _Advance(self, now):
+    """Empties the buckets that have left the window since the last call."""
+    index = int(now // self._bucket_seconds)
+    if self._current is None:
+      self._current = index
+    elif index > self._current:
+      counts = self._counts
+      for i in xrange(self._current + 1,
+                      self._current + 1 + min(index - self._current,
+                                              len(counts))):
+        self._total -= counts[i % len(counts)]
+        counts[i % len(counts)] = 0
+      self._current = index
+
+  def Add(self, now, count=1):
+    """Counts events that happened at a time in seconds since the epoch."""
+    self._Advance(now)
+    self._counts[self._current % len(self._counts)] += count
+    self._total += count
+
+  def Total(self, now):
+    """Returns the number of events in the window ending at a time."""
+    self._Advance(now)
+    return self._total
+
+
+class _QueueStats(object):
+  """Running statistics of one queue, updated as its tasks change.
+
+  A task counts as executed when it is deleted after being leased, and as
+  retried when it is rescheduled after being leased or leased again after
+  its lease expired.
   """
-  if a.eta_usec() > b.eta_usec():
-    return 1
-  if a.eta_usec() < b.eta_usec():
-    return -1
-  return 0
+
+  def __init__(self, now, depth):
+    """Constructor.
+
+    Args:
+      now: The time the statistics start, in seconds since the epoch.
+      depth: The number of tasks in the queue at that time.
+    """
+    self.start_time = now
+    self.enqueued = 0
+    self.executed = 0
+    self.retries = 0
+    self.leased = set()
+    self.enqueued_last_minute = _RollingCounter(1, 60)
+    self.enqueued_last_hour = _RollingCounter(60, 60)
+    self.executed_last_minute = _RollingCounter(1, 60)
+    self.executed_last_hour = _RollingCounter(60, 60)
+    self.lateness_counts = [0] * (len(LATENESS_BUCKET_SECONDS) + 1)
+    self.lateness_seconds = 0.0
+    self.max_lateness_seconds = 0.0
+    self.max_depth = depth
+    self._depth = depth
+    self._depth_samples = [depth] * DEPTH_SAMPLES
+    self._depth_sample = int(now // DEPTH_SAMPLE_SECONDS)
+
+  def _SetDepth(self, now, depth):
+    """Records the number of tasks in the queue after a change.
+
+    Each depth sample holds the largest depth of its interval. Samples for
+    intervals without changes get the depth the queue had during them.
+    """
+    index = int(now // DEPTH_SAMPLE_SECONDS)
+    samples = self._depth_samples
+    if index > self._depth_sample:
+      for i in xrange(self._depth_sample + 1,
+                      self._depth_sample + 1 + min(index - self._depth_sample,
+                                                   len(samples))):
+        samples[i % len(samples)] = self._depth
+      self._depth_sample = index
+    slot = index % len(samples)
+    samples[slot] = max(samples[slot], depth)
+    self._depth = depth
+    self.max_depth = max(self.max_depth, depth)
+
+  def RecordAdd(self, now, depth):
+    """Records that a task was added."""
+    self.enqueued += 1
+    self.enqueued_last_minute.Add(now)
+    self.enqueued_last_hour.Add(now)
+    self._SetDepth(now, depth)
+
+  def RecordLease(self, now, name, lateness_seconds):
+    """Records that a task was leased.
+
+    Args:
+      now: The current time in seconds since the epoch.
+      name: The name of the task.
+      lateness_seconds: How long after its ETA the task was leased.
+    """
+    if name in self.leased:
+      self.retries += 1
+    self.leased.add(name)
+    lateness_seconds = max(0.0, lateness_seconds)
+    self.lateness_counts[bisect.bisect_left(LATENESS_BUCKET_SECONDS,
+                                            lateness_seconds)] += 1
+    self.lateness_seconds += lateness_seconds
+    self.max_lateness_seconds = max(self.max_lateness_seconds,
+                                    lateness_seconds)
+
+  def RecordDelete(self, now, name, depth):
+    """Records that a task was deleted."""
+    if name in self.leased:
+      self.leased.remove(name)
+      self.executed += 1
+      self.executed_last_minute.Add(now)
+      self.executed_last_hour.Add(now)
+    self._SetDepth(now, depth)
+
+  def RecordReschedule(self, name):
+    """Records that a task was rescheduled."""
+    if name in self.leased:
+      self.leased.remove(name)
+      self.retries += 1
+
+  def RecordFlush(self, now):
+    """Records that all tasks were removed."""
+    self.leased.clear()
+    self._SetDepth(now, 0)
+
+  def ToDict(self, now):
+    """Returns the statistics as a dictionary; see GetQueueStats()."""
+    self._SetDepth(now, self._depth)
+    sampling_seconds = now - self.start_time
+    leases = sum(self.lateness_counts)
+    result = {
+        'sampling_seconds': sampling_seconds,
+        'enqueued': self.enqueued,
+        'enqueued_last_minute': self.enqueued_last_minute.Total(now),
+        'enqueued_last_hour': self.enqueued_last_hour.Total(now),
+        'executed': self.executed,
+        'executed_last_minute': self.executed_last_minute.Total(now),
+        'executed_last_hour': self.executed_last_hour.Total(now),
+        'in_flight': len(self.leased),
+        'retries': self.retries,
+        'mean_lateness_seconds': None,
+        'max_lateness_seconds': self.max_lateness_seconds,
+        'lateness_histogram': [],
+        'max_depth': self.max_depth,
+        'depth_history': [],
+    }
+    if leases:
+      result['mean_lateness_seconds'] = self.lateness_seconds / leases
+    bounds = list(LATENESS_BUCKET_SECONDS) + [None]
+    for bound, count in zip(bounds, self.lateness_counts):
+      result['lateness_histogram'].append({'le': bound, 'count': count})
+
+    samples = min(DEPTH_SAMPLES,
+                  int(sampling_seconds // DEPTH_SAMPLE_SECONDS) + 1)
+    for index in xrange(self._depth_sample - samples + 1,
+                        self._depth_sample + 1):
+      result['depth_history'].append(
+          (index * DEPTH_SAMPLE_SECONDS,
+           self._depth_samples[index % DEPTH_SAMPLES]))
+    return result
 
 
 def _FormatEta(eta_usec):
@@ -291,12 +640,25 @@ class TaskQueueServiceStub(apiproxy_stub.APIProxyStub):
 
   This stub does not attempt to automatically execute tasks.  Instead, it
   stores them for display on a console.  The user may manually execute the
-  tasks from the console.
+  tasks from the console, or have a taskqueue_executor.TaskExecutor lease
+  and run them.  The stored tasks are guarded by a lock, so the executor's
+  threads can use the stub while the application adds tasks.
+
+  If persistence_path is given, the stored tasks survive restarts. Every
+  change to them is appended to a journal next to that file, flushed before
+  the call that made it returns, and replayed on top of the snapshot in that
+  file when the stub is created. The journal is folded into a new snapshot
+  once it has grown larger than the snapshot would be. Leasing a task is
+  journaled as a change of its ETA, so a task that was running when the
+  process died runs again once its lease expires. The tasks of the admin
+  console's dummy task store and the queues set with UpdateQueue are not
+  persisted.
   """
 
   queue_yaml_parser = _ParseQueueYaml
 
-  def __init__(self, service_name='taskqueue', root_path=None):
+  def __init__(self, service_name='taskqueue', root_path=None,
+               persistence_path=None, gettime=time.time):
     """Constructor.
 
     Args:
@@ -304,14 +666,157 @@ class TaskQueueServiceStub(apiproxy_stub.APIProxyStub):
       root_path: Root path to the directory of the application which may contain
         a queue.yaml file. If None, then it's assumed no queue.yaml file is
         available.
+      persistence_path: Path of the file to keep the tasks in across
+        restarts, or None to keep them only in memory. The journal of
+        changes is kept in the same path with '.log' appended.
+      gettime: time.time()-like function used for testing.
     """
     super(TaskQueueServiceStub, self).__init__(service_name)
     self._taskqueues = {}
+    self._queue_stats = {}
+    self._gettime = gettime
+    self._start_time = gettime()
     self._next_task_id = 1
     self._root_path = root_path
+    self._lock = threading.Lock()
 
     self._app_queues = {}
 
+    self._persistence = None
+    if persistence_path is not None:
+      self._persistence = stub_persistence.SnapshotLog(persistence_path)
+      self._Restore()
+      self._persistence.Open()
+
+  def _Restore(self):
+    """Loads the snapshot and replays the journal into the empty queues."""
+    start = time.time()
+    gc_was_enabled = gc.isenabled()
+    gc.disable()
+    self._lock.acquire()
+    try:
+      self._LoadSnapshot(self._persistence.ReadSnapshot())
+      for records in self._persistence.ReadLog():
+        for record in records:
+          self._Replay(record)
+      count = sum(tasks.Count() for tasks in self._taskqueues.itervalues())
+    finally:
+      self._lock.release()
+      if gc_was_enabled:
+        gc.enable()
+    logging.info('Restored %d tasks from %s in %.2f seconds', count,
+                 self._persistence.path, time.time() - start)
+
+  def _LoadSnapshot(self, batches):
+    """Stores the tasks and tombstones of a snapshot in the empty queues.
+
+    The caller must hold self._lock.
+
+    Args:
+      batches: Iterable of lists of _LOG_ADD and _LOG_TOMBSTONE records.
+    """
+    queue_tasks = {}
+    for records in batches:
+      for operation, queue_name, value in records:
+        if operation == _LOG_ADD:
+          task = taskqueue_service_pb.TaskQueueAddRequest(value)
+          self._NoteTaskName(task.task_name())
+          queue_tasks.setdefault(queue_name, []).append(task)
+        else:
+          self._NoteTaskName(value)
+          self._GetTaskQueue(queue_name).Tombstone(value)
+    for queue_name, tasks in queue_tasks.iteritems():
+      self._GetTaskQueue(queue_name).Load(tasks)
+
+  def _Replay(self, record):
+    """Applies one journal record to the queues.
+
+    If the process died while compacting the journal, the journal can repeat
+    changes that are already in the new snapshot. Replaying it still gives
+    the right result, since tasks that already exist or were deleted are not
+    added again and the other changes can be applied twice. The caller must
+    hold self._lock.
+
+    Args:
+      record: A tuple of one of the _LOG_* constants, the queue name and the
+        arguments of the change.
+    """
+    operation, queue_name = record[:2]
+    tasks = self._GetTaskQueue(queue_name)
+    if operation == _LOG_ADD:
+      task = taskqueue_service_pb.TaskQueueAddRequest(record[2])
+      self._NoteTaskName(task.task_name())
+      try:
+        tasks.Add(task)
+      except apiproxy_errors.ApplicationError:
+        pass
+    elif operation == _LOG_DELETE:
+      tasks.Delete(record[2])
+    elif operation == _LOG_ETA:
+      tasks.Reschedule(record[2], record[3])
+    elif operation == _LOG_FLUSH:
+      tasks.Flush()
+    elif operation == _LOG_TOMBSTONE:
+      self._NoteTaskName(record[2])
+      tasks.Tombstone(record[2])
+
+  def _NoteTaskName(self, name):
+    """Keeps automatic task names from reusing a restored task's name.
+
+    The caller must hold self._lock.
+    """
+    if name.startswith('task') and name[4:].isdigit():
+      self._next_task_id = max(self._next_task_id, int(name[4:]) + 1)
+
+  def _Log(self, record):
+    """Queues a record of a change for the journal, if persistence is enabled.
+
+    The caller must hold self._lock.
+    """
+    if self._persistence is not None:
+      self._persistence.Append(record)
+
+  def _FlushLog(self):
+    """Writes the queued journal records, compacting it if it is too long."""
+    if self._persistence is None:
+      return
+    self._lock.acquire()
+    try:
+      if not self._persistence.Flush():
+        return
+      snapshot_records = 0
+      for tasks in self._taskqueues.itervalues():
+        snapshot_records += tasks.Count() + tasks.TombstoneCount()
+      if self._persistence.NeedsCompaction(snapshot_records):
+        self._WriteSnapshot()
+    finally:
+      self._lock.release()
+
+  def Snapshot(self):
+    """Writes all tasks to the snapshot file and empties the journal.
+
+    Does nothing if the stub was created without a persistence_path.
+    """
+    if self._persistence is None:
+      return
+    self._lock.acquire()
+    try:
+      self._WriteSnapshot()
+    finally:
+      self._lock.release()
+
+  def _SnapshotRecords(self):
+    """Yields the records of a snapshot of all tasks and tombstones."""
+    for queue_name, tasks in self._taskqueues.iteritems():
+      for task in tasks.Tasks():
+        yield (_LOG_ADD, queue_name, task.Encode())
+      for name in tasks.Tombstones():
+        yield (_LOG_TOMBSTONE, queue_name, name)
+
+  def _WriteSnapshot(self):
+    """Implementation of Snapshot(). The caller must hold self._lock."""
+    self._persistence.WriteSnapshot(self._SnapshotRecords())
+
   def _Dynamic_Add(self, request, response):
     """Local implementation of the Add RPC in TaskQueueService.
 
@@ -322,6 +827,100 @@ class TaskQueueServiceStub(apiproxy_stub.APIProxyStub):
       request: A taskqueue_service_pb.TaskQueueAddRequest.
       response: A taskqueue_service_pb.TaskQueueAddResponse.
     """
+    self._ValidateAddRequest(request, {})
+
+    if not request.task_name():
+      self._lock.acquire()
+      try:
+        request.set_task_name(self._NewTaskName())
+      finally:
+        self._lock.release()
+      response.set_chosen_task_name(request.task_name())
+
+    if request.has_transaction() or request.has_app_id():
+      self._StoreTask(request)
+    else:
+      self._lock.acquire()
+      try:
+        tasks = self._GetTaskQueue(request.queue_name())
+        tasks.Add(request)
+        self._GetQueueStats(request.queue_name()).RecordAdd(self._gettime(),
+                                                            tasks.Count())
+        self._Log((_LOG_ADD, request.queue_name(), request.Encode()))
+      finally:
+        self._lock.release()
+      self._FlushLog()
+
+  def _Dynamic_BulkAdd(self, request, response):
+    """Local implementation of the BulkAdd RPC in TaskQueueService.
+
+    Adds each task as the Add RPC would, but validates each queue once and
+    inserts all the tasks that are not transactional under a single
+    acquisition of the lock. A task that cannot be added does not stop the
+    others; its error is returned as its result instead.
+
+    Args:
+      request: A taskqueue_service_pb.TaskQueueBulkAddRequest.
+      response: A taskqueue_service_pb.TaskQueueBulkAddResponse, which gets
+        one TaskResult per task, in the order of the request.
+    """
+    valid_queues = {}
+    local_tasks = []
+    for add_request in request.add_request_list():
+      task_result = response.add_taskresult()
+      task_result.set_result(taskqueue_service_pb.TaskQueueServiceError.OK)
+      try:
+        self._ValidateAddRequest(add_request, valid_queues)
+      except apiproxy_errors.ApplicationError, e:
+        task_result.set_result(e.application_error)
+        continue
+      if add_request.has_transaction() or add_request.has_app_id():
+        if not add_request.task_name():
+          self._lock.acquire()
+          try:
+            add_request.set_task_name(self._NewTaskName())
+          finally:
+            self._lock.release()
+          task_result.set_chosen_task_name(add_request.task_name())
+        try:
+          self._StoreTask(add_request)
+        except apiproxy_errors.ApplicationError, e:
+          task_result.set_result(e.application_error)
+      else:
+        local_tasks.append((add_request, task_result))
+
+    self._lock.acquire()
+    try:
+      now = self._gettime()
+      for add_request, task_result in local_tasks:
+        if not add_request.task_name():
+          add_request.set_task_name(self._NewTaskName())
+          task_result.set_chosen_task_name(add_request.task_name())
+        tasks = self._GetTaskQueue(add_request.queue_name())
+        try:
+          tasks.Add(add_request)
+        except apiproxy_errors.ApplicationError, e:
+          task_result.set_result(e.application_error)
+          continue
+        self._GetQueueStats(add_request.queue_name()).RecordAdd(now,
+                                                                tasks.Count())
+        self._Log((_LOG_ADD, add_request.queue_name(), add_request.Encode()))
+    finally:
+      self._lock.release()
+    self._FlushLog()
+
+  def _ValidateAddRequest(self, request, valid_queues):
+    """Checks the ETA and the queue of a task being added.
+
+    Args:
+      request: A taskqueue_service_pb.TaskQueueAddRequest.
+      valid_queues: Dictionary caching the result of _IsValidQueue() for each
+        queue name, so that queue.yaml is read once per call.
+
+    Raises:
+      apiproxy_errors.ApplicationError: If the ETA is invalid or the queue
+      does not exist.
+    """
     if request.eta_usec() < 0:
       raise apiproxy_errors.ApplicationError(
           taskqueue_service_pb.TaskQueueServiceError.INVALID_ETA)
@@ -333,15 +932,29 @@ class TaskQueueServiceStub(apiproxy_stub.APIProxyStub):
       raise apiproxy_errors.ApplicationError(
           taskqueue_service_pb.TaskQueueServiceError.INVALID_ETA)
 
-    if not self._IsValidQueue(request.queue_name()):
+    queue_name = request.queue_name()
+    if queue_name not in valid_queues:
+      valid_queues[queue_name] = self._IsValidQueue(queue_name)
+    if not valid_queues[queue_name]:
       raise apiproxy_errors.ApplicationError(
           taskqueue_service_pb.TaskQueueServiceError.UNKNOWN_QUEUE)
 
-    if not request.task_name():
-      request.set_task_name('task%d' % self._next_task_id)
-      response.set_chosen_task_name(request.task_name())
-      self._next_task_id += 1
+  def _NewTaskName(self):
+    """Returns a new automatic task name. The caller must hold self._lock."""
+    name = 'task%d' % self._next_task_id
+    self._next_task_id += 1
+    return name
+
+  def _StoreTask(self, request):
+    """Stores a transactional task or one for the dummy admin console store.
+
+    Args:
+      request: A named taskqueue_service_pb.TaskQueueAddRequest that has a
+        transaction or an app_id.
 
+    Raises:
+      apiproxy_errors.ApplicationError: If the datastore rejects the task.
+    """
     if request.has_transaction():
       try:
         apiproxy_stub_map.MakeSyncCall(
@@ -350,17 +963,30 @@ class TaskQueueServiceStub(apiproxy_stub.APIProxyStub):
         e.application_error = (e.application_error +
             taskqueue_service_pb.TaskQueueServiceError.DATASTORE_ERROR)
         raise e
-    elif request.has_app_id():
+    else:
       store = self.GetDummyTaskStore(request.app_id(), request.queue_name())
       store.Add(request)
-    else:
-      tasks = self._taskqueues.setdefault(request.queue_name(), [])
-      for task in tasks:
-        if task.task_name() == request.task_name():
-          raise apiproxy_errors.ApplicationError(
-              taskqueue_service_pb.TaskQueueServiceError.TASK_ALREADY_EXISTS)
-      tasks.append(request)
-      tasks.sort(_CompareTasksByEta)
+
+  def _GetTaskQueue(self, queue_name):
+    """Returns the _TaskQueue holding a queue's tasks, creating it if needed.
+
+    The caller must hold self._lock.
+    """
+    tasks = self._taskqueues.get(queue_name)
+    if tasks is None:
+      tasks = self._taskqueues[queue_name] = _TaskQueue()
+    return tasks
+
+  def _GetQueueStats(self, queue_name):
+    """Returns the _QueueStats of a queue, creating it if needed.
+
+    The caller must hold self._lock.
+    """
+    stats = self._queue_stats.get(queue_name)
+    if stats is None:
+      stats = self._queue_stats[queue_name] = _QueueStats(
+          self._start_time, self._GetTaskQueue(queue_name).Count())
+    return stats
 
   def _IsValidQueue(self, queue_name):
     """Determines whether a queue is valid, i.e. tasks can be added to it.
@@ -413,13 +1039,7 @@ class TaskQueueServiceStub(apiproxy_stub.APIProxyStub):
         else:
           queue['bucket_size'] = DEFAULT_BUCKET_SIZE
 
-        tasks = self._taskqueues.setdefault(entry.name, [])
-        if tasks:
-          queue['oldest_task'] = _FormatEta(tasks[0].eta_usec())
-          queue['eta_delta'] = _EtaDelta(tasks[0].eta_usec())
-        else:
-          queue['oldest_task'] = ''
-        queue['tasks_in_queue'] = len(tasks)
+        self._AddQueueTaskStats(queue, entry.name)
 
     if not has_default:
       queue = {}
@@ -428,13 +1048,68 @@ class TaskQueueServiceStub(apiproxy_stub.APIProxyStub):
       queue['max_rate'] = DEFAULT_RATE
       queue['bucket_size'] = DEFAULT_BUCKET_SIZE
 
-      tasks = self._taskqueues.get(DEFAULT_QUEUE_NAME, [])
-      if tasks:
-        queue['oldest_task'] = _FormatEta(tasks[0].eta_usec())
-        queue['eta_delta'] = _EtaDelta(tasks[0].eta_usec())
+      self._AddQueueTaskStats(queue, DEFAULT_QUEUE_NAME)
+    return queues
+
+  def _AddQueueTaskStats(self, queue, queue_name):
+    """Adds the oldest task and number of tasks to a GetQueues() dictionary.
+
+    Args:
+      queue: The dictionary describing the queue.
+      queue_name: The name of the queue.
+    """
+    self._lock.acquire()
+    try:
+      tasks = self._GetTaskQueue(queue_name)
+      oldest = tasks.Peek()
+      if oldest is not None:
+        queue['oldest_task'] = _FormatEta(oldest.eta_usec())
+        queue['eta_delta'] = _EtaDelta(oldest.eta_usec())
       else:
         queue['oldest_task'] = ''
-      queue['tasks_in_queue'] = len(tasks)
+      queue['tasks_in_queue'] = tasks.Count()
+    finally:
+      self._lock.release()
+
+  def GetQueueStats(self):
+    """Gets the running statistics of all the applications's queues.
+
+    The statistics cover the time since the stub was created. Tasks
+    restored from a persistence_path count towards the queue depth only.
+
+    Returns:
+      A list with a dictionary for each queue that GetQueues() returns,
+      containing the queue's 'name', 'max_rate', 'bucket_size' and
+      'tasks_in_queue', as well as:
+        sampling_seconds: How long the statistics cover.
+        enqueued, enqueued_last_minute, enqueued_last_hour: The number of
+          tasks added in total, in the last minute and in the last hour.
+        executed, executed_last_minute, executed_last_hour: The same for the
+          tasks that were leased and then deleted, i.e. ran successfully.
+        in_flight: The number of tasks leased but not yet deleted or
+          rescheduled.
+        retries: The number of runs that failed or whose lease expired.
+        mean_lateness_seconds, max_lateness_seconds: How long after their
+          ETA tasks were leased.
+        lateness_histogram: List of {'le': seconds, 'count': leases}
+          dictionaries, one per bound in LATENESS_BUCKET_SECONDS and a last
+          one with a bound of None, counting the leases at most that late
+          and later than the previous bound.
+        max_depth: The most tasks the queue has held.
+        depth_history: List of (seconds since the epoch, depth) tuples, the
+          most tasks the queue held in each DEPTH_SAMPLE_SECONDS interval of
+          up to the last DEPTH_SAMPLES intervals, oldest first.
+    """
+    queues = self.GetQueues()
+    self._lock.acquire()
+    try:
+      now = self._gettime()
+      for queue in queues:
+        queue.pop('oldest_task', None)
+        queue.pop('eta_delta', None)
+        queue.update(self._GetQueueStats(queue['name']).ToDict(now))
+    finally:
+      self._lock.release()
     return queues
 
   def GetTasks(self, queue_name):
@@ -463,7 +1138,11 @@ class TaskQueueServiceStub(apiproxy_stub.APIProxyStub):
     Raises:
       ValueError: A task request contains an unknown HTTP method type.
     """
-    tasks = self._taskqueues.get(queue_name, [])
+    self._lock.acquire()
+    try:
+      tasks = self._GetTaskQueue(queue_name).Tasks()
+    finally:
+      self._lock.release()
     result_tasks = []
     for task_request in tasks:
       task = {}
@@ -510,11 +1189,83 @@ class TaskQueueServiceStub(apiproxy_stub.APIProxyStub):
       queue_name: the name of the queue to delete the task from.
       task_name: the name of the task to delete.
     """
-    tasks = self._taskqueues.get(queue_name, [])
-    for task in tasks:
-      if task.task_name() == task_name:
-        tasks.remove(task)
-        return
+    self._lock.acquire()
+    try:
+      tasks = self._GetTaskQueue(queue_name)
+      if tasks.Delete(task_name) is not None:
+        self._GetQueueStats(queue_name).RecordDelete(self._gettime(),
+                                                     task_name, tasks.Count())
+        self._Log((_LOG_DELETE, queue_name, task_name))
+    finally:
+      self._lock.release()
+    self._FlushLog()
+
+  def HasTask(self, queue_name, task_name):
+    """Returns True if a queue holds a task with the given name.
+
+    Args:
+      queue_name: The name of the queue.
+      task_name: The name of the task.
+    """
+    self._lock.acquire()
+    try:
+      tasks = self._taskqueues.get(queue_name)
+      return tasks is not None and tasks.Get(task_name) is not None
+    finally:
+      self._lock.release()
+
+  def LeaseTask(self, queue_name, now_usec, lease_seconds):
+    """Leases the due task with the earliest ETA from a queue.
+
+    The task is not removed from the queue. Instead its ETA is moved to the
+    end of the lease, so it runs again unless it is deleted with DeleteTask()
+    or rescheduled with RescheduleTask() before then.
+
+    Args:
+      queue_name: The name of the queue to lease a task from.
+      now_usec: The current time, in microseconds since the epoch.
+      lease_seconds: How long the task is leased for.
+
+    Returns:
+      A copy of the leased taskqueue_service_pb.TaskQueueAddRequest, with its
+      ETA before the lease, or None if no task in the queue is due.
+    """
+    lease_usec = int(lease_seconds * 1e6)
+    self._lock.acquire()
+    try:
+      task = self._GetTaskQueue(queue_name).Lease(now_usec, lease_usec)
+      if task is not None:
+        self._GetQueueStats(queue_name).RecordLease(
+            self._gettime(), task.task_name(),
+            (now_usec - task.eta_usec()) / 1e6)
+        self._Log((_LOG_ETA, queue_name, task.task_name(),
+                   now_usec + lease_usec))
+    finally:
+      self._lock.release()
+    self._FlushLog()
+    return task
+
+  def RescheduleTask(self, queue_name, task_name, eta_usec):
+    """Changes the ETA of a task, e.g. to retry it after it failed.
+
+    Args:
+      queue_name: The name of the queue holding the task.
+      task_name: The name of the task.
+      eta_usec: The new ETA, in microseconds since the epoch.
+
+    Returns:
+      True if the task was found, False if it has been deleted.
+    """
+    self._lock.acquire()
+    try:
+      found = self._GetTaskQueue(queue_name).Reschedule(task_name, eta_usec)
+      if found:
+        self._GetQueueStats(queue_name).RecordReschedule(task_name)
+        self._Log((_LOG_ETA, queue_name, task_name, eta_usec))
+    finally:
+      self._lock.release()
+    self._FlushLog()
+    return found
 
   def FlushQueue(self, queue_name):
     """Removes all tasks from a queue.
@@ -522,7 +1273,14 @@ class TaskQueueServiceStub(apiproxy_stub.APIProxyStub):
     Args:
       queue_name: the name of the queue to remove tasks from.
     """
-    self._taskqueues[queue_name] = []
+    self._lock.acquire()
+    try:
+      self._GetTaskQueue(queue_name).Flush()
+      self._GetQueueStats(queue_name).RecordFlush(self._gettime())
+      self._Log((_LOG_FLUSH, queue_name))
+    finally:
+      self._lock.release()
+    self._FlushLog()
 
   def _Dynamic_UpdateQueue(self, request, unused_response):
     """Local implementation of the UpdateQueue RPC in TaskQueueService.
@@ -560,10 +1318,11 @@ class TaskQueueServiceStub(apiproxy_stub.APIProxyStub):
       response_queue.set_user_specified_rate(queue.user_specified_rate())
 
   def _Dynamic_FetchQueueStats(self, request, response):
-    """Local 'random' implementation of the TaskQueueService.FetchQueueStats.
+    """Local implementation of the TaskQueueService.FetchQueueStats.
 
-    This implementation loads some stats from the dummy store,
-    the rest with random numbers.
+    For the application being served, returns the statistics of the stub's
+    own queues. For other app_ids, loads some stats from the dummy store, the
+    rest with random numbers.
     Must adhere to the '_Dynamic_' naming convention for stubbing to work.
     See taskqueue_service.proto for a full description of the RPC.
 
@@ -571,6 +1330,32 @@ class TaskQueueServiceStub(apiproxy_stub.APIProxyStub):
       request: A taskqueue_service_pb.TaskQueueFetchQueueStatsRequest.
       response: A taskqueue_service_pb.TaskQueueFetchQueueStatsResponse.
     """
+    if request.app_id() == os.environ.get('APPLICATION_ID'):
+      self._lock.acquire()
+      try:
+        now = self._gettime()
+        for queue in request.queue_name_list():
+          tasks = self._GetTaskQueue(queue)
+          queue_stats = self._GetQueueStats(queue)
+          stats = response.add_queuestats()
+          stats.set_num_tasks(tasks.Count())
+          oldest = tasks.Peek()
+          if oldest is None:
+            stats.set_oldest_eta_usec(-1)
+          else:
+            stats.set_oldest_eta_usec(oldest.eta_usec())
+          scanner_info = stats.mutable_scanner_info()
+          scanner_info.set_executed_last_minute(
+              queue_stats.executed_last_minute.Total(now))
+          scanner_info.set_executed_last_hour(
+              queue_stats.executed_last_hour.Total(now))
+          scanner_info.set_sampling_duration_seconds(
+              min(now - queue_stats.start_time, 3600.0))
+          scanner_info.set_requests_in_flight(len(queue_stats.leased))
+      finally:
+        self._lock.release()
+      return
+
     for queue in request.queue_name_list():
       store = self.GetDummyTaskStore(request.app_id(), queue)
       stats = response.add_queuestats()
@@ -27,8 +27,12 @@ required and higher performance is desired.
 import cStringIO
 import math
 import pickle
+import random
+import sys
+import threading
 import types
 import sha
+import zlib
 
 from google.appengine.api import api_base_pb
 from google.appengine.api import apiproxy_stub_map
@@ -71,9 +75,11 @@ STAT_BYTE_HITS = 'byte_hits'
 STAT_ITEMS = 'items'
 STAT_BYTES = 'bytes'
 STAT_OLDEST_ITEM_AGES = 'oldest_item_age'
+STAT_EVICTIONS = 'evictions'
 
 FLAG_TYPE_MASK = 7
 FLAG_COMPRESSED = 1 << 3
+FLAG_CHUNKED = 1 << 4
 
 TYPE_STR = 0
 TYPE_UNICODE = 1
@@ -84,6 +90,8 @@ TYPE_BOOL = 5
 
 CAPABILITY = capabilities.CapabilitySet('memcache')
 
+_CHUNK_KEY_FORMAT = '__memcache_chunk__:%s:%d'
+
 
 def _key_string(key, key_prefix='', server_to_user_dict=None):
   """Utility function to handle different ways of requesting keys.
@@ -131,7 +139,32 @@ def _key_string(key, key_prefix='', server_to_user_dict=None):
   return server_key
 
 
-def _validate_encode_value(value, do_pickle):
+class _LocalCache(threading.local):
+  """Per-thread store of values already read from memcache."""
+
+  def __init__(self):
+    self.Clear()
+
+  def Clear(self):
+    """Forgets all values and resets the hit and miss counters."""
+    self.values = {}
+    self.hits = 0
+    self.misses = 0
+
+
+class _CasIds(threading.local):
+  """Per-thread store of the CAS IDs of the values read for cas()."""
+
+  def __init__(self):
+    self.Clear()
+
+  def Clear(self):
+    """Forgets all CAS IDs."""
+    self.ids = {}
+
+
+def _validate_encode_value(value, do_pickle, min_compress_len=0,
+                           check_size=True):
   """Utility function to validate and encode server keys and values.
 
   Args:
@@ -142,6 +175,9 @@ def _validate_encode_value(value, do_pickle):
       serialized result, unpickling it upon retrieval.
     do_pickle: Callable that takes an object and returns a non-unicode
       string containing the pickled object.
+    min_compress_len: If non-zero, encoded values at least this many bytes
+      long are compressed with zlib when that makes them smaller.
+    check_size: If False, do not reject values over MAX_VALUE_SIZE.
 
   Returns:
     Tuple (stored_value, flags) where:
@@ -177,8 +213,13 @@ def _validate_encode_value(value, do_pickle):
     stored_value = do_pickle(value)
     flags |= TYPE_PICKLED
 
+  if min_compress_len and len(stored_value) >= min_compress_len:
+    compressed_value = zlib.compress(stored_value)
+    if len(compressed_value) < len(stored_value):
+      stored_value = compressed_value
+      flags |= FLAG_COMPRESSED
 
-  if len(stored_value) > MAX_VALUE_SIZE:
+  if check_size and len(stored_value) > MAX_VALUE_SIZE:
     raise ValueError('Values may not be more than %d bytes in length; '
                      'received %d bytes' % (MAX_VALUE_SIZE, len(stored_value)))
 
@@ -207,6 +248,8 @@ def _decode_value(stored_value, flags, do_unpickle):
 
   type_number = flags & FLAG_TYPE_MASK
   value = stored_value
+  if flags & FLAG_COMPRESSED:
+    value = zlib.decompress(value)
 
 
   if type_number == TYPE_STR:
@@ -243,6 +286,29 @@ class Client(object):
   string (unicode or not), int, long, or pickle-able Python object, including
   all native types.  You'll get back from the cache the same type that you
   originally put in.
+
+  The Client remembers, per thread, the CAS IDs of values fetched with gets()
+  or get_multi(..., for_cas=True), so that cas() and cas_multi() can later
+  store a new value only if nobody else has changed it in the meantime.  Call
+  cas_reset() to forget them at the end of each request; see
+  local_cache_wsgi_middleware().
+
+  Values of min_compress_len bytes or more, once encoded, are compressed
+  before being stored.  If the Client is created with chunk_large_values,
+  values too large for a single memcache item are split across several
+  items and reassembled on retrieval.
+
+  If the Client is created with local_cache, get() and get_multi() first
+  look in a per-thread cache of the values this thread has already read, and
+  only ask memcache for the rest.  Writes made through the Client drop the
+  affected keys from the cache, but changes made elsewhere are not seen
+  until clear_local_cache() is called, which should happen at the end of
+  each request; see local_cache_wsgi_middleware().
+
+  The *_async() methods start an operation without waiting for it and return
+  an apiproxy_stub_map.UserRPC.  Its get_result() method waits for the call
+  and returns what the corresponding synchronous method would have returned.
+  This lets a handler overlap memcache round trips with other API calls.
   """
 
   def __init__(self, servers=None, debug=0,
@@ -251,7 +317,10 @@ class Client(object):
                unpickler=pickle.Unpickler,
                pload=None,
                pid=None,
-               make_sync_call=apiproxy_stub_map.MakeSyncCall):
+               make_sync_call=apiproxy_stub_map.MakeSyncCall,
+               serializer=None,
+               chunk_large_values=False,
+               local_cache=False):
     """Create a new Client object.
 
     No parameters are required.
@@ -266,6 +335,15 @@ class Client(object):
       pid: Callable to use for determine the persistent id for objects, if any.
       make_sync_call: Function to use to make an App Engine service call.
         Used for testing.
+      serializer: Optional object with dumps() and loads() functions, e.g.
+        the marshal module, used instead of pickling to store values that
+        are not strings or numbers.  Every Client sharing keys must use the
+        same serializer.
+      chunk_large_values: If True, values larger than MAX_VALUE_SIZE once
+        encoded are split across several memcache items instead of being
+        rejected with ValueError.  Each chunk is written with its own call.
+      local_cache: If True, keep a per-thread cache of values read, so that
+        reading them again does not need a call.
     """
     self._pickle_data = cStringIO.StringIO()
     self._pickler_instance = pickler(self._pickle_data,
@@ -291,7 +369,132 @@ class Client(object):
       return self._unpickler_instance.load()
     self._do_unpickle = DoUnpickle
 
+    if serializer is not None:
+      self._do_pickle = serializer.dumps
+      self._do_unpickle = serializer.loads
+
     self._make_sync_call = make_sync_call
+    self._chunk_large_values = chunk_large_values
+    if local_cache:
+      self._local_cache = _LocalCache()
+    else:
+      self._local_cache = None
+    self._cas_ids = _CasIds()
+
+  def cas_reset(self):
+    """Clears the CAS IDs this thread has remembered."""
+    self._cas_ids.Clear()
+
+  def clear_local_cache(self):
+    """Empties this thread's local cache and resets its counters.
+
+    Does nothing if the Client was not created with local_cache.
+    """
+    if self._local_cache is not None:
+      self._local_cache.Clear()
+
+  def get_local_cache_stats(self):
+    """Gets statistics for this thread's local cache.
+
+    Returns:
+      Dictionary with the number of local cache hits (STAT_HITS) and misses
+      (STAT_MISSES) since the last clear_local_cache(), and the number of
+      values currently cached (STAT_ITEMS).  None if the Client was not
+      created with local_cache.
+    """
+    if self._local_cache is None:
+      return None
+    return {
+      STAT_HITS: self._local_cache.hits,
+      STAT_MISSES: self._local_cache.misses,
+      STAT_ITEMS: len(self._local_cache.values),
+    }
+
+  def _get_local(self, request, user_key):
+    """Answers what it can of a MemcacheGetRequest from the local cache.
+
+    Keys found locally are removed from the request.
+
+    Args:
+      request: A MemcacheGetRequest.
+      user_key: Dictionary mapping server keys to the caller's keys.
+
+    Returns:
+      A dictionary of the caller's keys and values found locally.
+    """
+    local_cache = self._local_cache
+    namespace = request.name_space()
+    found = {}
+    remaining_keys = []
+    for server_key in request.key_list():
+      cached = local_cache.values.get((namespace, server_key))
+      if cached is None:
+        local_cache.misses += 1
+        remaining_keys.append(server_key)
+      else:
+        local_cache.hits += 1
+        found[user_key[server_key]] = _decode_value(cached[0], cached[1],
+                                                    self._do_unpickle)
+    if found:
+      request.clear_key()
+      for server_key in remaining_keys:
+        request.add_key(server_key)
+    return found
+
+  def _invalidate_local(self, namespace, server_keys):
+    """Drops keys from the local cache, e.g. because they are being written.
+
+    Args:
+      namespace: The namespace of the keys, as set on the request.
+      server_keys: The keys as sent to the server.
+    """
+    if self._local_cache is not None:
+      values = self._local_cache.values
+      for server_key in server_keys:
+        values.pop((namespace, server_key), None)
+
+  def create_rpc(self, deadline=None, callback=None):
+    """Creates an RPC object for use with the memcache API.
+
+    Args:
+      deadline: Optional deadline in seconds for the operation; the default
+        is a system-specific deadline (typically 5 seconds).
+      callback: Optional callable to invoke on completion.
+
+    Returns:
+      An apiproxy_stub_map.UserRPC object specialized for this service.
+    """
+    return apiproxy_stub_map.UserRPC('memcache', deadline, callback)
+
+  def batch(self):
+    """Creates a Batcher that sends its calls through this Client.
+
+    Returns:
+      A new Batcher.
+    """
+    return Batcher(self)
+
+  def _make_async_call(self, rpc, method, request, response,
+                       get_result_hook, user_data):
+    """Starts an asynchronous memcache call.
+
+    Args:
+      rpc: A UserRPC created by create_rpc(), or None to create one.
+      method: The memcache method to call, e.g. 'Get'.
+      request: The request protocol buffer.
+      response: The response protocol buffer.
+      get_result_hook: Function converting the finished RPC to the result of
+        the corresponding synchronous method.
+      user_data: Additional data for get_result_hook, as rpc.user_data.
+
+    Returns:
+      The UserRPC.
+    """
+    if rpc is None:
+      rpc = self.create_rpc()
+    assert rpc.service == 'memcache', repr(rpc.service)
+    rpc.make_call(method, request, response, get_result_hook, user_data)
+    return rpc
 
   def set_servers(self, servers):
     """Sets the pool of memcache servers used by the client.
@@ -342,6 +545,8 @@ class Client(object):
           item will survive in the cache without being accessed. This is
           _not_ the amount of time that has elapsed since the item was
           created.
+        evictions: Number of items removed from the cache to make room for
+          new ones.
 
       On error, returns None.
     """
@@ -351,7 +556,28 @@ class Client(object):
       self._make_sync_call('memcache', 'Stats', request, response)
     except apiproxy_errors.Error:
       return None
+    return self._get_stats_result(response)
+
+  def get_stats_async(self, rpc=None):
+    """Asynchronous version of get_stats().
+
+    Returns:
+      A UserRPC whose get_result() returns what get_stats() would.
+    """
+    return self._make_async_call(rpc, 'Stats', MemcacheStatsRequest(),
+                                 MemcacheStatsResponse(),
+                                 self._get_stats_hook, None)
+
+  def _get_stats_hook(self, rpc):
+    """Get-result hook for get_stats_async()."""
+    try:
+      rpc.check_success()
+    except apiproxy_errors.Error:
+      return None
+    return self._get_stats_result(rpc.response)
 
+  def _get_stats_result(self, response):
+    """Converts a MemcacheStatsResponse to the get_stats() dictionary."""
     if not response.has_stats():
       return {
         STAT_HITS: 0,
@@ -360,6 +586,7 @@ class Client(object):
         STAT_ITEMS: 0,
         STAT_BYTES: 0,
         STAT_OLDEST_ITEM_AGES: 0,
+        STAT_EVICTIONS: 0,
       }
 
     stats = response.stats()
@@ -370,6 +597,7 @@ class Client(object):
       STAT_ITEMS: stats.items(),
       STAT_BYTES: stats.bytes(),
       STAT_OLDEST_ITEM_AGES: stats.oldest_item_age(),
+      STAT_EVICTIONS: stats.evictions(),
     }
 
   def flush_all(self):
@@ -380,12 +608,32 @@ class Client(object):
     """
     request = MemcacheFlushRequest()
     response = MemcacheFlushResponse()
+    self.clear_local_cache()
     try:
       self._make_sync_call('memcache', 'FlushAll', request, response)
     except apiproxy_errors.Error:
       return False
     return True
 
+  def flush_all_async(self, rpc=None):
+    """Asynchronous version of flush_all().
+
+    Returns:
+      A UserRPC whose get_result() returns what flush_all() would.
+    """
+    self.clear_local_cache()
+    return self._make_async_call(rpc, 'FlushAll', MemcacheFlushRequest(),
+                                 MemcacheFlushResponse(),
+                                 self._flush_all_hook, None)
+
+  def _flush_all_hook(self, rpc):
+    """Get-result hook for flush_all_async()."""
+    try:
+      rpc.check_success()
+    except apiproxy_errors.Error:
+      return False
+    return True
+
   def get(self, key, namespace=None):
     """Looks up a single key in memcache.
 
@@ -403,6 +651,9 @@ class Client(object):
     Returns:
       The value of the key, if found in memcache, else None.
     """
+    if self._local_cache is not None:
+      return self.get_multi([key], namespace=namespace).get(key)
+
     request = MemcacheGetRequest()
     request.add_key(_key_string(key))
     namespace_manager._add_name_space(request, namespace)
@@ -415,11 +666,29 @@ class Client(object):
     if not response.item_size():
       return None
 
-    return _decode_value(response.item(0).value(),
-                         response.item(0).flags(),
-                         self._do_unpickle)
+    item = response.item(0)
+    if item.flags() & FLAG_CHUNKED:
+      return self._get_multi_result(request, response,
+                                    {item.key(): key}).get(key)
+    return _decode_value(item.value(), item.flags(), self._do_unpickle)
+
+  def gets(self, key, namespace=None):
+    """Looks up a single key in memcache and remembers its CAS ID.
+
+    Use this instead of get() when you intend to update the value with cas().
+
+    Args:
+      key: The key in memcache to look up.  See docs on Client
+        for details of format.
+      namespace: a string specifying an optional namespace to use in
+        the request.
 
-  def get_multi(self, keys, key_prefix='', namespace=None):
+    Returns:
+      The value of the key, if found in memcache, else None.
+    """
+    return self.get_multi([key], namespace=namespace, for_cas=True).get(key)
+
+  def get_multi(self, keys, key_prefix='', namespace=None, for_cas=False):
     """Looks up multiple keys from memcache in one operation.
 
     This is the recommended way to do bulk loads.
@@ -434,28 +703,98 @@ class Client(object):
         not included in the returned dictionary.
       namespace: a string specifying an optional namespace to use in
         the request.
+      for_cas: If True, remember the CAS IDs of the returned values for use
+        by cas() and cas_multi().
 
     Returns:
       A dictionary of the keys and values that were present in memcache.
       Even if the key_prefix was specified, that key_prefix won't be on
       the keys in the returned dictionary.
     """
+    request, user_key = self._make_get_request(keys, key_prefix, namespace,
+                                               for_cas)
+    local_values = {}
+    if self._local_cache is not None and not for_cas:
+      local_values = self._get_local(request, user_key)
+      if not request.key_size():
+        return local_values
+
+    response = MemcacheGetResponse()
+    try:
+      self._make_sync_call('memcache', 'Get', request, response)
+    except apiproxy_errors.Error:
+      return local_values
+    return_value = self._get_multi_result(request, response, user_key)
+    return_value.update(local_values)
+    return return_value
+
+  def get_multi_async(self, keys, key_prefix='', namespace=None,
+                      for_cas=False, rpc=None):
+    """Asynchronous version of get_multi().
+
+    Args:
+      See get_multi().
+      rpc: Optional UserRPC created by create_rpc().
+
+    Returns:
+      A UserRPC whose get_result() returns what get_multi() would.
+    """
+    request, user_key = self._make_get_request(keys, key_prefix, namespace,
+                                               for_cas)
+    return self._make_async_call(rpc, 'Get', request, MemcacheGetResponse(),
+                                 self._get_multi_hook, user_key)
+
+  def _make_get_request(self, keys, key_prefix, namespace, for_cas):
+    """Builds the request for get_multi() and get_multi_async().
+
+    Returns:
+      A (MemcacheGetRequest, user_key) tuple, where user_key maps server keys
+      back to the keys the caller passed in.  Each server key is requested
+      only once, even if the caller listed it several times.
+    """
     request = MemcacheGetRequest()
     namespace_manager._add_name_space(request, namespace)
-    response = MemcacheGetResponse()
+    if for_cas:
+      request.set_for_cas(True)
     user_key = {}
     for key in keys:
-      request.add_key(_key_string(key, key_prefix, user_key))
+      server_key = _key_string(key, key_prefix, user_key)
+      if len(user_key) > request.key_size():
+        request.add_key(server_key)
+    return request, user_key
+
+  def _get_multi_hook(self, rpc):
+    """Get-result hook for get_multi_async()."""
     try:
-      self._make_sync_call('memcache', 'Get', request, response)
+      rpc.check_success()
     except apiproxy_errors.Error:
       return {}
+    return self._get_multi_result(rpc.request, rpc.response, rpc.user_data)
+
+  def _get_multi_result(self, request, response, user_key):
+    """Decodes a MemcacheGetResponse into the get_multi() dictionary.
 
+    Also remembers the returned CAS IDs if the request asked for them.
+    """
+    for_cas = request.for_cas()
+    chunks = self._get_chunks(request, response)
     return_value = {}
     for returned_item in response.item_list():
-      value = _decode_value(returned_item.value(), returned_item.flags(),
-                            self._do_unpickle)
+      stored_value = returned_item.value()
+      flags = returned_item.flags()
+      if flags & FLAG_CHUNKED:
+        stored_value = chunks.get(stored_value)
+        if stored_value is None:
+          continue
+        flags &= ~FLAG_CHUNKED
+      if self._local_cache is not None:
+        self._local_cache.values[(request.name_space(),
+                                  returned_item.key())] = (stored_value, flags)
+      value = _decode_value(stored_value, flags, self._do_unpickle)
       return_value[user_key[returned_item.key()]] = value
+      if for_cas:
+        self._cas_ids.ids[(request.name_space(), returned_item.key())] = (
+            returned_item.cas_id())
     return return_value
 
   def delete(self, key, seconds=0, namespace=None):
@@ -492,6 +831,7 @@ class Client(object):
     delete_item = request.add_item()
     delete_item.set_key(_key_string(key))
     delete_item.set_delete_time(int(math.ceil(seconds)))
+    self._invalidate_local(request.name_space(), [delete_item.key()])
     try:
       self._make_sync_call('memcache', 'Delete', request, response)
     except apiproxy_errors.Error:
@@ -524,6 +864,111 @@ class Client(object):
       True if all operations completed successfully.  False if one
       or more failed to complete.
     """
+    request = self._make_delete_request(keys, seconds, key_prefix, namespace)
+    response = MemcacheDeleteResponse()
+    try:
+      self._make_sync_call('memcache', 'Delete', request, response)
+    except apiproxy_errors.Error:
+      return False
+    return True
+
+  def delete_multi_async(self, keys, seconds=0, key_prefix='',
+                         namespace=None, rpc=None):
+    """Asynchronous version of delete_multi().
+
+    Args:
+      See delete_multi().
+      rpc: Optional UserRPC created by create_rpc().
+
+    Returns:
+      A UserRPC whose get_result() returns what delete_multi() would.
+    """
+    request = self._make_delete_request(keys, seconds, key_prefix, namespace)
+    return self._make_async_call(rpc, 'Delete', request,
+                                 MemcacheDeleteResponse(),
+                                 self._delete_multi_hook, None)
+
+  def _get_chunks(self, request, response):
+    """Fetches the chunks of the chunked values in a MemcacheGetResponse.
+
+    Args:
+      request: The MemcacheGetRequest that was sent.
+      response: The MemcacheGetResponse it produced.
+
+    Returns:
+      A dictionary mapping the stored value of each chunked item to the
+      reassembled value.  Items missing any of their chunks are left out.
+    """
+    manifests = [item.value() for item in response.item_list()
+                 if item.flags() & FLAG_CHUNKED]
+    if not manifests:
+      return {}
+
+    chunk_request = MemcacheGetRequest()
+    if request.has_name_space():
+      chunk_request.set_name_space(request.name_space())
+    for manifest in manifests:
+      token, count = manifest.rsplit(':', 1)
+      for i in xrange(int(count)):
+        chunk_request.add_key(_CHUNK_KEY_FORMAT % (token, i))
+    chunk_response = MemcacheGetResponse()
+    try:
+      self._make_sync_call('memcache', 'Get', chunk_request, chunk_response)
+    except apiproxy_errors.Error:
+      return {}
+
+    chunk_values = dict((item.key(), item.value())
+                        for item in chunk_response.item_list())
+    chunks = {}
+    for manifest in manifests:
+      token, count = manifest.rsplit(':', 1)
+      parts = [chunk_values.get(_CHUNK_KEY_FORMAT % (token, i))
+               for i in xrange(int(count))]
+      if None not in parts:
+        chunks[manifest] = ''.join(parts)
+    return chunks
+
+  def _encode_value(self, value, min_compress_len, time, namespace):
+    """Encodes a value for storage, writing chunks for very large values.
+
+    Args:
+      value: Value to store.
+      min_compress_len: See _validate_encode_value().
+      time: Expiration time to give any chunks.
+      namespace: Namespace to store any chunks in.
+
+    Returns:
+      Tuple (stored_value, flags) as from _validate_encode_value(), or
+      (None, None) if the chunks of a large value could not be stored.
+    """
+    stored_value, flags = _validate_encode_value(
+        value, self._do_pickle, min_compress_len=min_compress_len,
+        check_size=not self._chunk_large_values)
+    if len(stored_value) <= MAX_VALUE_SIZE:
+      return stored_value, flags
+
+    token = '%016x' % random.getrandbits(64)
+    count = 0
+    for start in xrange(0, len(stored_value), MAX_VALUE_SIZE):
+      request = MemcacheSetRequest()
+      namespace_manager._add_name_space(request, namespace)
+      item = request.add_item()
+      item.set_key(_CHUNK_KEY_FORMAT % (token, count))
+      item.set_value(stored_value[start:start + MAX_VALUE_SIZE])
+      item.set_set_policy(MemcacheSetRequest.SET)
+      item.set_expiration_time(int(math.ceil(time)))
+      response = MemcacheSetResponse()
+      try:
+        self._make_sync_call('memcache', 'Set', request, response)
+      except apiproxy_errors.Error:
+        return None, None
+      if response.set_status_list() != [MemcacheSetResponse.STORED]:
+        return None, None
+      count += 1
+    return '%s:%d' % (token, count), flags | FLAG_CHUNKED
+
+  def _make_delete_request(self, keys, seconds, key_prefix, namespace):
+    """Builds the request for delete_multi() and delete_multi_async()."""
     if not isinstance(seconds, (int, long, float)):
       raise TypeError('Delete timeout must be a number.')
     if seconds < 0:
@@ -531,14 +976,18 @@ class Client(object):
 
     request = MemcacheDeleteRequest()
     namespace_manager._add_name_space(request, namespace)
-    response = MemcacheDeleteResponse()
-
     for key in keys:
       delete_item = request.add_item()
       delete_item.set_key(_key_string(key, key_prefix=key_prefix))
       delete_item.set_delete_time(int(math.ceil(seconds)))
+    self._invalidate_local(request.name_space(),
+                           [item.key() for item in request.item_list()])
+    return request
+
+  def _delete_multi_hook(self, rpc):
+    """Get-result hook for delete_multi_async()."""
     try:
-      self._make_sync_call('memcache', 'Delete', request, response)
+      rpc.check_success()
     except apiproxy_errors.Error:
       return False
     return True
@@ -558,7 +1007,8 @@ class Client(object):
         By default, items never expire, though items may be evicted due to
         memory pressure.  Float values will be rounded up to the nearest
         whole second.
-      min_compress_len: Ignored option for compatibility.
+      min_compress_len: Compress the value if it is at least this many
+        bytes long once encoded.  Defaults to 0, which means never.
       namespace: a string specifying an optional namespace to use in
         the request.
 
@@ -566,7 +1016,8 @@ class Client(object):
       True if set.  False on error.
     """
     return self._set_with_policy(MemcacheSetRequest.SET, key, value, time=time,
-                                 namespace=namespace)
+                                 namespace=namespace,
+                                 min_compress_len=min_compress_len)
 
   def add(self, key, value, time=0, min_compress_len=0, namespace=None):
     """Sets a key's value, iff item is not already in memcache.
@@ -579,7 +1030,8 @@ class Client(object):
         By default, items never expire, though items may be evicted due to
         memory pressure.  Float values will be rounded up to the nearest
         whole second.
-      min_compress_len: Ignored option for compatibility.
+      min_compress_len: Compress the value if it is at least this many
+        bytes long once encoded.  Defaults to 0, which means never.
       namespace: a string specifying an optional namespace to use in
         the request.
 
@@ -587,7 +1039,8 @@ class Client(object):
       True if added.  False on error.
     """
     return self._set_with_policy(MemcacheSetRequest.ADD, key, value, time=time,
-                                 namespace=namespace)
+                                 namespace=namespace,
+                                 min_compress_len=min_compress_len)
 
   def replace(self, key, value, time=0, min_compress_len=0, namespace=None):
     """Replaces a key's value, failing if item isn't already in memcache.
@@ -600,7 +1053,8 @@ class Client(object):
         By default, items never expire, though items may be evicted due to
         memory pressure.  Float values will be rounded up to the nearest
         whole second.
-      min_compress_len: Ignored option for compatibility.
+      min_compress_len: Compress the value if it is at least this many
+        bytes long once encoded.  Defaults to 0, which means never.
       namespace: a string specifying an optional namespace to use in
         the request.
 
@@ -608,20 +1062,62 @@ class Client(object):
       True if replaced.  False on RPC error or cache miss.
     """
     return self._set_with_policy(MemcacheSetRequest.REPLACE,
-                                 key, value, time=time, namespace=namespace)
+                                 key, value, time=time, namespace=namespace,
+                                 min_compress_len=min_compress_len)
+
+  def cas(self, key, value, time=0, min_compress_len=0, namespace=None):
+    """Compare-And-Set update.
+
+    This requires that the key has previously been successfully fetched with
+    gets() or get_multi(..., for_cas=True), and that no changes have been
+    made to the key since that fetch.  Typical usage is::
 
-  def _set_with_policy(self, policy, key, value, time=0, namespace=None):
+      key = ...
+      client = memcache.Client()
+      value = client.gets(key)
+      <updated value>
+      ok = client.cas(key, value)
+
+    If two processes run similar code, the first one calling cas() will
+    succeed (ok == True), while the second one will fail (ok == False).
+    This can be used to detect race conditions.
+
+    Args:
+      key: Key to set.  See docs on Client for details.
+      value: The new value.
+      time: Optional expiration time, either relative number of seconds
+        from current time (up to 1 month), or an absolute Unix epoch time.
+        By default, items never expire, though items may be evicted due to
+        memory pressure.  Float values will be rounded up to the nearest
+        whole second.
+      min_compress_len: Compress the value if it is at least this many
+        bytes long once encoded.  Defaults to 0, which means never.
+      namespace: a string specifying an optional namespace to use in
+        the request.
+
+    Returns:
+      True if updated.  False on RPC error, if the key was not fetched with
+      gets(), or if the value changed or was evicted since it was fetched.
+    """
+    return self._set_with_policy(MemcacheSetRequest.CAS, key, value,
+                                 time=time, namespace=namespace,
+                                 min_compress_len=min_compress_len)
+
+  def _set_with_policy(self, policy, key, value, time=0, namespace=None,
+                       min_compress_len=0):
     """Sets a single key with a specified policy.
 
-    Helper function for set(), add(), and replace().
+    Helper function for set(), add(), replace() and cas().
 
     Args:
-      policy:  One of MemcacheSetRequest.SET, .ADD, or .REPLACE.
+      policy:  One of MemcacheSetRequest.SET, .ADD, .REPLACE or .CAS.
       key: Key to add, set, or replace.  See docs on Client for details.
       value: Value to set.
       time: Expiration time, defaulting to 0 (never expiring).
       namespace: a string specifying an optional namespace to use in
         the request.
+      min_compress_len: Compress the value if it is at least this many
+        bytes long once encoded.
 
     Returns:
       True if stored, False on RPC error or policy error, e.g. a replace
@@ -634,14 +1130,25 @@ class Client(object):
       raise ValueError('Expiration must not be negative.')
 
     request = MemcacheSetRequest()
+    namespace_manager._add_name_space(request, namespace)
+    server_key = _key_string(key)
+    self._invalidate_local(request.name_space(), [server_key])
+    if policy == MemcacheSetRequest.CAS:
+      cas_id = self._cas_ids.ids.get((request.name_space(), server_key))
+      if cas_id is None:
+        return False
+    stored_value, flags = self._encode_value(value, min_compress_len, time,
+                                             namespace)
+    if stored_value is None:
+      return False
     item = request.add_item()
-    item.set_key(_key_string(key))
-    stored_value, flags = _validate_encode_value(value, self._do_pickle)
+    item.set_key(server_key)
     item.set_value(stored_value)
     item.set_flags(flags)
     item.set_set_policy(policy)
     item.set_expiration_time(int(math.ceil(time)))
-    namespace_manager._add_name_space(request, namespace)
+    if policy == MemcacheSetRequest.CAS:
+      item.set_cas_id(cas_id)
     response = MemcacheSetResponse()
     try:
       self._make_sync_call('memcache', 'Set', request, response)
@@ -652,14 +1159,15 @@ class Client(object):
     return response.set_status(0) == MemcacheSetResponse.STORED
 
   def _set_multi_with_policy(self, policy, mapping, time=0, key_prefix='',
-                             namespace=None):
+                             namespace=None, min_compress_len=0):
     """Set multiple keys with a specified policy.
 
-    Helper function for set_multi(), add_multi(), and replace_multi(). This
-    reduces the network latency of doing many requests in serial.
+    Helper function for set_multi(), add_multi(), replace_multi() and
+    cas_multi(). This reduces the network latency of doing many requests in
+    serial.
 
     Args:
-      policy:  One of MemcacheSetRequest.SET, ADD, or REPLACE.
+      policy:  One of MemcacheSetRequest.SET, ADD, REPLACE or CAS.
       mapping: Dictionary of keys to values.
       time: Optional expiration time, either relative number of seconds
         from current time (up to 1 month), or an absolute Unix epoch time.
@@ -669,6 +1177,8 @@ class Client(object):
       key_prefix: Prefix for to prepend to all keys.
       namespace: a string specifying an optional namespace to use in
         the request.
+      min_compress_len: Compress values that are at least this many bytes
+        long once encoded.
 
     Returns:
       A list of keys whose values were NOT set.  On total success,
@@ -676,17 +1186,69 @@ class Client(object):
       a list of all input keys is returned; in this case the keys
       may or may not have been updated.
     """
+    request, user_data = self._make_set_request(policy, mapping, time,
+                                                key_prefix, namespace,
+                                                min_compress_len)
+    server_keys, user_key, skipped_keys = user_data
+    if not server_keys:
+      return list(skipped_keys)
+
+    response = MemcacheSetResponse()
+    try:
+      self._make_sync_call('memcache', 'Set', request, response)
+    except apiproxy_errors.Error:
+      return user_key.values()
+    return self._set_multi_result(response, user_data)
+
+  def _set_multi_async_with_policy(self, policy, mapping, time, key_prefix,
+                                   namespace, min_compress_len, rpc):
+    """Asynchronous version of _set_multi_with_policy().
+
+    Returns:
+      A UserRPC whose get_result() returns what _set_multi_with_policy()
+      would.
+    """
+    request, user_data = self._make_set_request(policy, mapping, time,
+                                                key_prefix, namespace,
+                                                min_compress_len)
+    return self._make_async_call(rpc, 'Set', request, MemcacheSetResponse(),
+                                 self._set_multi_hook, user_data)
+
+  def _make_set_request(self, policy, mapping, time, key_prefix, namespace,
+                        min_compress_len):
+    """Builds the request for the set_multi() family of methods.
+
+    Keys whose CAS ID is unknown, or whose value needed chunking and the
+    chunks could not be stored, are left out of the request.
+
+    Returns:
+      A (MemcacheSetRequest, user_data) tuple.  user_data is a tuple of the
+      server keys in request order, a dictionary mapping server keys to the
+      keys the caller passed in, and a list of keys left out of the request.
+    """
     if not isinstance(time, (int, long, float)):
       raise TypeError('Expiration must be a number.')
     if time < 0.0:
       raise ValueError('Expiration must not be negative.')
 
     request = MemcacheSetRequest()
+    namespace_manager._add_name_space(request, namespace)
     user_key = {}
     server_keys = []
+    unset_list = []
     for key, value in mapping.iteritems():
       server_key = _key_string(key, key_prefix, user_key)
-      stored_value, flags = _validate_encode_value(value, self._do_pickle)
+      self._invalidate_local(request.name_space(), [server_key])
+      if policy == MemcacheSetRequest.CAS:
+        cas_id = self._cas_ids.ids.get((request.name_space(), server_key))
+        if cas_id is None:
+          unset_list.append(key)
+          continue
+      stored_value, flags = self._encode_value(value, min_compress_len, time,
+                                               namespace)
+      if stored_value is None:
+        unset_list.append(key)
+        continue
       server_keys.append(server_key)
 
       item = request.add_item()
@@ -695,17 +1257,24 @@ class Client(object):
       item.set_flags(flags)
       item.set_set_policy(policy)
       item.set_expiration_time(int(math.ceil(time)))
-    namespace_manager._add_name_space(request, namespace)
+      if policy == MemcacheSetRequest.CAS:
+        item.set_cas_id(cas_id)
+    return request, (server_keys, user_key, unset_list)
 
-    response = MemcacheSetResponse()
+  def _set_multi_hook(self, rpc):
+    """Get-result hook for the set_multi_async() family of methods."""
     try:
-      self._make_sync_call('memcache', 'Set', request, response)
+      rpc.check_success()
     except apiproxy_errors.Error:
-      return user_key.values()
+      return rpc.user_data[1].values()
+    return self._set_multi_result(rpc.response, rpc.user_data)
 
+  def _set_multi_result(self, response, user_data):
+    """Decodes a MemcacheSetResponse into the list of keys NOT set."""
+    server_keys, user_key, skipped_keys = user_data
     assert response.set_status_size() == len(server_keys)
 
-    unset_list = []
+    unset_list = list(skipped_keys)
     for server_key, set_status in zip(server_keys, response.set_status_list()):
       if set_status != MemcacheSetResponse.STORED:
         unset_list.append(user_key[server_key])
@@ -724,7 +1293,8 @@ class Client(object):
         memory pressure.  Float values will be rounded up to the nearest
         whole second.
       key_prefix: Prefix for to prepend to all keys.
-      min_compress_len: Unimplemented compatibility option.
+      min_compress_len: Compress values that are at least this many bytes
+        long once encoded.  Defaults to 0, which means never.
       namespace: a string specifying an optional namespace to use in
         the request.
 
@@ -734,7 +1304,8 @@ class Client(object):
     """
     return self._set_multi_with_policy(MemcacheSetRequest.SET, mapping,
                                        time=time, key_prefix=key_prefix,
-                                       namespace=namespace)
+                                       namespace=namespace,
+                                       min_compress_len=min_compress_len)
 
   def add_multi(self, mapping, time=0, key_prefix='', min_compress_len=0,
                 namespace=None):
@@ -748,7 +1319,8 @@ class Client(object):
         memory pressure.  Float values will be rounded up to the nearest
         whole second.
       key_prefix: Prefix for to prepend to all keys.
-      min_compress_len: Unimplemented compatibility option.
+      min_compress_len: Compress values that are at least this many bytes
+        long once encoded.  Defaults to 0, which means never.
       namespace: a string specifying an optional namespace to use in
         the request.
 
@@ -758,7 +1330,8 @@ class Client(object):
     """
     return self._set_multi_with_policy(MemcacheSetRequest.ADD, mapping,
                                        time=time, key_prefix=key_prefix,
-                                       namespace=namespace)
+                                       namespace=namespace,
+                                       min_compress_len=min_compress_len)
 
   def replace_multi(self, mapping, time=0, key_prefix='', min_compress_len=0,
                     namespace=None):
@@ -772,7 +1345,8 @@ class Client(object):
         memory pressure.  Float values will be rounded up to the nearest
         whole second.
       key_prefix: Prefix for to prepend to all keys.
-      min_compress_len: Unimplemented compatibility option.
+      min_compress_len: Compress values that are at least this many bytes
+        long once encoded.  Defaults to 0, which means never.
       namespace: a string specifying an optional namespace to use in
         the request.
 
@@ -782,7 +1356,97 @@ class Client(object):
     """
     return self._set_multi_with_policy(MemcacheSetRequest.REPLACE, mapping,
                                        time=time, key_prefix=key_prefix,
-                                       namespace=namespace)
+                                       namespace=namespace,
+                                       min_compress_len=min_compress_len)
+
+  def cas_multi(self, mapping, time=0, key_prefix='', min_compress_len=0,
+                namespace=None):
+    """Compare-And-Set update for multiple keys.
+
+    See cas() docstring for an explanation.
+
+    Args:
+      mapping: Dictionary of keys to values.
+      time: Optional expiration time, either relative number of seconds
+        from current time (up to 1 month), or an absolute Unix epoch time.
+        By default, items never expire, though items may be evicted due to
+        memory pressure.  Float values will be rounded up to the nearest
+        whole second.
+      key_prefix: Prefix for to prepend to all keys.
+      min_compress_len: Compress values that are at least this many bytes
+        long once encoded.  Defaults to 0, which means never.
+      namespace: a string specifying an optional namespace to use in
+        the request.
+
+    Returns:
+      A list of keys whose values were NOT set because they were not fetched
+      with gets(), or were changed or evicted since they were fetched.  On
+      total success, this list should be empty.
+    """
+    return self._set_multi_with_policy(MemcacheSetRequest.CAS, mapping,
+                                       time=time, key_prefix=key_prefix,
+                                       namespace=namespace,
+                                       min_compress_len=min_compress_len)
+
+  def set_multi_async(self, mapping, time=0, key_prefix='',
+                      min_compress_len=0, namespace=None, rpc=None):
+    """Asynchronous version of set_multi().
+
+    Args:
+      See set_multi().
+      rpc: Optional UserRPC created by create_rpc().
+
+    Returns:
+      A UserRPC whose get_result() returns what set_multi() would.
+    """
+    return self._set_multi_async_with_policy(MemcacheSetRequest.SET, mapping,
+                                             time, key_prefix, namespace,
+                                             min_compress_len, rpc)
+
+  def add_multi_async(self, mapping, time=0, key_prefix='',
+                      min_compress_len=0, namespace=None, rpc=None):
+    """Asynchronous version of add_multi().
+
+    Args:
+      See add_multi().
+      rpc: Optional UserRPC created by create_rpc().
+
+    Returns:
+      A UserRPC whose get_result() returns what add_multi() would.
+    """
+    return self._set_multi_async_with_policy(MemcacheSetRequest.ADD, mapping,
+                                             time, key_prefix, namespace,
+                                             min_compress_len, rpc)
+
+  def replace_multi_async(self, mapping, time=0, key_prefix='',
+                          min_compress_len=0, namespace=None, rpc=None):
+    """Asynchronous version of replace_multi().
+
+    Args:
+      See replace_multi().
+      rpc: Optional UserRPC created by create_rpc().
+
+    Returns:
+      A UserRPC whose get_result() returns what replace_multi() would.
+    """
+    return self._set_multi_async_with_policy(MemcacheSetRequest.REPLACE,
+                                             mapping, time, key_prefix,
+                                             namespace, min_compress_len, rpc)
+
+  def cas_multi_async(self, mapping, time=0, key_prefix='',
+                      min_compress_len=0, namespace=None, rpc=None):
+    """Asynchronous version of cas_multi().
+
+    Args:
+      See cas_multi().
+      rpc: Optional UserRPC created by create_rpc().
+
+    Returns:
+      A UserRPC whose get_result() returns what cas_multi() would.
+    """
+    return self._set_multi_async_with_policy(MemcacheSetRequest.CAS, mapping,
+                                             time, key_prefix, namespace,
+                                             min_compress_len, rpc)
 
   def incr(self, key, delta=1, namespace=None, initial_value=None):
     """Atomically increments a key's value.
@@ -905,6 +1569,7 @@ class Client(object):
     namespace_manager._add_name_space(request, namespace)
     response = MemcacheIncrementResponse()
     request.set_key(_key_string(key))
+    self._invalidate_local(request.name_space(), [request.key()])
     request.set_delta(delta)
     if is_negative:
       request.set_direction(MemcacheIncrementRequest.DECREMENT)
@@ -942,6 +1607,40 @@ class Client(object):
       was not an integer type. The values will wrap-around at unsigned 64-bit
       integer-maximum and underflow will be floored at zero.
     """
+    request, keys = self._make_offset_request(mapping, key_prefix, namespace,
+                                              initial_value)
+    response = MemcacheBatchIncrementResponse()
+    try:
+      self._make_sync_call('memcache', 'BatchIncrement', request, response)
+    except apiproxy_errors.Error:
+      return dict((k, None) for k in keys)
+    return self._offset_multi_result(response, keys)
+
+  def offset_multi_async(self, mapping, key_prefix='',
+                         namespace=None, initial_value=None, rpc=None):
+    """Asynchronous version of offset_multi().
+
+    Args:
+      See offset_multi().
+      rpc: Optional UserRPC created by create_rpc().
+
+    Returns:
+      A UserRPC whose get_result() returns what offset_multi() would.
+    """
+    request, keys = self._make_offset_request(mapping, key_prefix, namespace,
+                                              initial_value)
+    return self._make_async_call(rpc, 'BatchIncrement', request,
+                                 MemcacheBatchIncrementResponse(),
+                                 self._offset_multi_hook, keys)
+
+  def _make_offset_request(self, mapping, key_prefix, namespace,
+                           initial_value):
+    """Builds the request for offset_multi() and offset_multi_async().
+
+    Returns:
+      A (MemcacheBatchIncrementRequest, keys) tuple, where keys lists the
+      caller's keys in request order.
+    """
     if initial_value is not None:
       if not isinstance(initial_value, (int, long)):
         raise TypeError('initial_value must be an integer')
@@ -949,9 +1648,9 @@ class Client(object):
         raise ValueError('initial_value must be >= 0')
 
     request = MemcacheBatchIncrementRequest()
-    response = MemcacheBatchIncrementResponse()
     namespace_manager._add_name_space(request, namespace)
 
+    keys = []
     for key, delta in mapping.iteritems():
       if not isinstance(delta, (int, long)):
         raise TypeError('Delta must be an integer or long, received %r' % delta)
@@ -962,6 +1661,8 @@ class Client(object):
         direction = MemcacheIncrementRequest.DECREMENT
 
       server_key = _key_string(key, key_prefix)
+      self._invalidate_local(request.name_space(), [server_key])
+      keys.append(key)
 
       item = request.add_item()
       item.set_key(server_key)
@@ -969,16 +1670,22 @@ class Client(object):
       item.set_direction(direction)
       if initial_value is not None:
         item.set_initial_value(initial_value)
+    return request, keys
 
+  def _offset_multi_hook(self, rpc):
+    """Get-result hook for offset_multi_async()."""
     try:
-      self._make_sync_call('memcache', 'BatchIncrement', request, response)
+      rpc.check_success()
     except apiproxy_errors.Error:
-      return dict((k, None) for k in mapping.iterkeys())
+      return dict((k, None) for k in rpc.user_data)
+    return self._offset_multi_result(rpc.response, rpc.user_data)
 
-    assert response.item_size() == len(mapping)
+  def _offset_multi_result(self, response, keys):
+    """Decodes a MemcacheBatchIncrementResponse into the result dictionary."""
+    assert response.item_size() == len(keys)
 
     result_dict = {}
-    for key, resp_item in zip(mapping.iterkeys(), response.item_list()):
+    for key, resp_item in zip(keys, response.item_list()):
       if (resp_item.increment_status() == MemcacheIncrementResponse.OK and
           resp_item.has_new_value()):
         result_dict[key] = resp_item.new_value()
@@ -988,6 +1695,243 @@ class Client(object):
     return result_dict
 
 
+class _BatchFuture(object):
+  """The eventual result of a call queued on a Batcher."""
+
+  def __init__(self, batcher):
+    """Constructor.
+
+    Args:
+      batcher: The Batcher the call was queued on.
+    """
+    self.__batcher = batcher
+    self.__done = False
+    self.__result = None
+    self.__exc_info = None
+
+  def done(self):
+    """Returns True if the result is available without calling memcache."""
+    return self.__done
+
+  def get_result(self):
+    """Gets the result, first flushing the Batcher if necessary.
+
+    Returns:
+      What the corresponding Client method would have returned.
+
+    Raises:
+      The exception raised by the call that carried this operation, if any.
+    """
+    if not self.__done:
+      self.__batcher._send()
+    if self.__exc_info is not None:
+      raise self.__exc_info[0], self.__exc_info[1], self.__exc_info[2]
+    return self.__result
+
+  def _set_result(self, result):
+    self.__result = result
+    self.__done = True
+
+  def _set_exception(self, exc_info):
+    self.__exc_info = exc_info
+    self.__done = True
+
+
+class Batcher(object):
+  """Collects memcache gets and sets and sends them in as few calls as possible.
+
+  Each get(), set(), add() or replace() queues the operation and returns an
+  object whose get_result() gives what the corresponding Client method would
+  have returned.  Queued operations are sent when flush() is called, when the
+  result of any of them is asked for, or at the end of a with block:
+
+    with memcache.batch() as batcher:
+      header = batcher.get('header')
+      footer = batcher.get('footer')
+    render(header.get_result(), footer.get_result())
+
+  A flush sends one Get call per namespace and one Set call per namespace,
+  policy and expiration time, using the UserRPC-based *_multi_async methods
+  of the Client, so the calls run concurrently.  Asking for the same key
+  twice only requests it once.  An operation on a key which is already
+  queued with a write flushes the queue first, so the results are the same
+  as if the calls had been made one at a time.
+
+  Like the Client, a Batcher must not be shared between threads.
+  """
+
+  def __init__(self, client=None):
+    """Constructor.
+
+    Args:
+      client: The Client to send the calls through; defaults to the one
+        used by the module-level functions.
+    """
+    self.__client = client
+    self.__gets = {}
+    self.__sets = {}
+    self.__pending = {}
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, exc_type, exc_value, traceback):
+    self.flush()
+
+  def __queue(self, namespace, key, is_write):
+    """Records that an operation on a key is about to be queued.
+
+    Flushes first if this would reorder operations on the key.
+
+    Returns:
+      The namespace to queue the operation under.
+    """
+    namespace = namespace or namespace_manager.get_namespace() or ''
+    pending_write = self.__pending.get((namespace, key))
+    if pending_write or (is_write and pending_write is not None):
+      self.flush()
+    self.__pending[(namespace, key)] = is_write
+    return namespace
+
+  def get(self, key, namespace=None):
+    """Queues the lookup of a single key.
+
+    Args:
+      See Client.get().
+
+    Returns:
+      A future whose get_result() returns the value of the key, or None.
+    """
+    _key_string(key)
+    namespace = self.__queue(namespace, key, False)
+    futures = self.__gets.setdefault(namespace, {})
+    future = futures.get(key)
+    if future is None:
+      future = futures[key] = _BatchFuture(self)
+    return future
+
+  def __set(self, policy, key, value, time, min_compress_len, namespace):
+    """Queues the write of a single key under the given policy.
+
+    Returns:
+      A future whose get_result() returns True if the value was stored.
+    """
+    if not isinstance(time, (int, long, float)):
+      raise TypeError('Expiration must be a number.')
+    if time < 0.0:
+      raise ValueError('Expiration must not be negative.')
+    _key_string(key)
+    namespace = self.__queue(namespace, key, True)
+    future = _BatchFuture(self)
+    mapping = self.__sets.setdefault(
+        (namespace, policy, time, min_compress_len), {})
+    mapping[key] = (value, future)
+    return future
+
+  def set(self, key, value, time=0, min_compress_len=0, namespace=None):
+    """Queues setting a key's value, regardless of previous contents.
+
+    Args:
+      See Client.set().
+
+    Returns:
+      A future whose get_result() returns what Client.set() would.
+    """
+    return self.__set(MemcacheSetRequest.SET, key, value, time,
+                      min_compress_len, namespace)
+
+  def add(self, key, value, time=0, min_compress_len=0, namespace=None):
+    """Queues setting a key's value, only if it is not already in memcache.
+
+    Args:
+      See Client.add().
+
+    Returns:
+      A future whose get_result() returns what Client.add() would.
+    """
+    return self.__set(MemcacheSetRequest.ADD, key, value, time,
+                      min_compress_len, namespace)
+
+  def replace(self, key, value, time=0, min_compress_len=0, namespace=None):
+    """Queues replacing a key's value, only if it is already in memcache.
+
+    Args:
+      See Client.replace().
+
+    Returns:
+      A future whose get_result() returns what Client.replace() would.
+    """
+    return self.__set(MemcacheSetRequest.REPLACE, key, value, time,
+                      min_compress_len, namespace)
+
+  def flush(self):
+    """Sends all queued operations and waits for their results.
+
+    Does nothing if no operations are queued.  If a call fails, the futures
+    of its operations raise its exception, the other calls still complete,
+    and the first exception is raised again here.
+    """
+    exc_info = self._send()
+    if exc_info is not None:
+      raise exc_info[0], exc_info[1], exc_info[2]
+
+  def _send(self):
+    """Implementation of flush() that leaves exceptions to the futures.
+
+    Returns:
+      The sys.exc_info() of the first call that failed, or None.
+    """
+    gets, sets = self.__gets, self.__sets
+    self.__gets = {}
+    self.__sets = {}
+    self.__pending = {}
+    client = self.__client or _CLIENT
+
+    calls = []
+    for (namespace, policy, time, min_compress_len), mapping in (
+        sets.iteritems()):
+      futures = [future for _, future in mapping.itervalues()]
+      try:
+        rpc = client._set_multi_async_with_policy(
+            policy,
+            dict((key, value) for key, (value, _) in mapping.iteritems()),
+            time, '', namespace or None, min_compress_len, None)
+      except Exception:
+        rpc = sys.exc_info()
+      calls.append((rpc, futures, mapping, True))
+    for namespace, futures in gets.iteritems():
+      try:
+        rpc = client.get_multi_async(futures.keys(),
+                                     namespace=namespace or None)
+      except Exception:
+        rpc = sys.exc_info()
+      calls.append((rpc, futures.values(), futures, False))
+
+    first_exc_info = None
+    for rpc, futures, entries, is_set in calls:
+      if isinstance(rpc, tuple):
+        exc_info = rpc
+      else:
+        try:
+          result = rpc.get_result()
+          exc_info = None
+        except Exception:
+          exc_info = sys.exc_info()
+      if exc_info is not None:
+        for future in futures:
+          future._set_exception(exc_info)
+        if first_exc_info is None:
+          first_exc_info = exc_info
+      elif is_set:
+        unset_keys = frozenset(result)
+        for key, (_, future) in entries.iteritems():
+          future._set_result(key not in unset_keys)
+      else:
+        for key, future in entries.iteritems():
+          future._set_result(result.get(key))
+    return first_exc_info
+
+
 _CLIENT = None
 
 
@@ -1009,6 +1953,7 @@ def setup_client(client_obj):
   var_dict['forget_dead_hosts'] = _CLIENT.forget_dead_hosts
   var_dict['debuglog'] = _CLIENT.debuglog
   var_dict['get'] = _CLIENT.get
+  var_dict['gets'] = _CLIENT.gets
   var_dict['get_multi'] = _CLIENT.get_multi
   var_dict['set'] = _CLIENT.set
   var_dict['set_multi'] = _CLIENT.set_multi
@@ -1016,6 +1961,9 @@ def setup_client(client_obj):
   var_dict['add_multi'] = _CLIENT.add_multi
   var_dict['replace'] = _CLIENT.replace
   var_dict['replace_multi'] = _CLIENT.replace_multi
+  var_dict['cas'] = _CLIENT.cas
+  var_dict['cas_multi'] = _CLIENT.cas_multi
+  var_dict['cas_reset'] = _CLIENT.cas_reset
   var_dict['delete'] = _CLIENT.delete
   var_dict['delete_multi'] = _CLIENT.delete_multi
   var_dict['incr'] = _CLIENT.incr
@@ -1023,6 +1971,57 @@ def setup_client(client_obj):
   var_dict['flush_all'] = _CLIENT.flush_all
   var_dict['get_stats'] = _CLIENT.get_stats
   var_dict['offset_multi'] = _CLIENT.offset_multi
+  var_dict['create_rpc'] = _CLIENT.create_rpc
+  var_dict['batch'] = _CLIENT.batch
+  var_dict['get_multi_async'] = _CLIENT.get_multi_async
+  var_dict['set_multi_async'] = _CLIENT.set_multi_async
+  var_dict['add_multi_async'] = _CLIENT.add_multi_async
+  var_dict['replace_multi_async'] = _CLIENT.replace_multi_async
+  var_dict['cas_multi_async'] = _CLIENT.cas_multi_async
+  var_dict['delete_multi_async'] = _CLIENT.delete_multi_async
+  var_dict['offset_multi_async'] = _CLIENT.offset_multi_async
+  var_dict['get_stats_async'] = _CLIENT.get_stats_async
+  var_dict['flush_all_async'] = _CLIENT.flush_all_async
+  var_dict['clear_local_cache'] = _CLIENT.clear_local_cache
+  var_dict['get_local_cache_stats'] = _CLIENT.get_local_cache_stats
 
 
 setup_client(Client())
+
+
+def local_cache_wsgi_middleware(app):
+  """WSGI middleware that empties the per-thread state around each request.
+
+  The module-level client's local cache, if it has one, is emptied and the
+  CAS IDs remembered by gets() are forgotten, so that neither outlives the
+  request.  A local cache is enabled with
+
+    memcache.setup_client(memcache.Client(local_cache=True))
+
+  Normally you install this middleware in your appengine_config.py file:
+
+    def webapp_add_wsgi_middleware(app):
+      from google.appengine.api import memcache
+      return memcache.local_cache_wsgi_middleware(app)
+  """
+
+  def local_cache_wsgi_wrapper(environ, start_response):
+    """Calls the wrapped app, clearing the per-thread state before and after."""
+    _CLIENT.clear_local_cache()
+    _CLIENT.cas_reset()
+    result = None
+    try:
+      result = app(environ, start_response)
+      if result is not None:
+        for value in result:
+          yield value
+    finally:
+      try:
+        close = getattr(result, 'close', None)
+        if close is not None:
+          close()
+      finally:
+        _CLIENT.clear_local_cache()
+        _CLIENT.cas_reset()
+
+  return local_cache_wsgi_wrapper
@@ -0,0 +1,457 @@
+#!/usr/bin/env python
+#
+# Copyright 2007 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""Stub version of the memcache API that spreads keys over several shards.
+
+Used in place of MemcacheServiceStub to see how keys and load would be spread
+over a cluster of memcache servers, and how an application copes when one of
+them goes away:
+
+  stub = memcache_cluster_stub.MemcacheClusterStub(shard_count=4)
+  apiproxy_stub_map.apiproxy.RegisterStub('memcache', stub)
+  ...
+  stub.SetShardDown(2)
+  ...
+  for shard_stats in stub.GetShardStats():
+    print shard_stats
+  print stub.GetLoadSkew()
+"""
+
+
+
+import bisect
+import md5
+import struct
+import threading
+import time
+
+from google.appengine.api import apiproxy_stub
+from google.appengine.api import memcache
+from google.appengine.api.memcache import memcache_service_pb
+from google.appengine.api.memcache import memcache_stub
+from google.appengine.runtime import apiproxy_errors
+
+MemcacheGetRequest = memcache_service_pb.MemcacheGetRequest
+MemcacheGetResponse = memcache_service_pb.MemcacheGetResponse
+MemcacheSetRequest = memcache_service_pb.MemcacheSetRequest
+MemcacheSetResponse = memcache_service_pb.MemcacheSetResponse
+MemcacheDeleteRequest = memcache_service_pb.MemcacheDeleteRequest
+MemcacheDeleteResponse = memcache_service_pb.MemcacheDeleteResponse
+MemcacheIncrementResponse = memcache_service_pb.MemcacheIncrementResponse
+MemcacheBatchIncrementRequest = (
+    memcache_service_pb.MemcacheBatchIncrementRequest)
+MemcacheBatchIncrementResponse = (
+    memcache_service_pb.MemcacheBatchIncrementResponse)
+MemcacheFlushRequest = memcache_service_pb.MemcacheFlushRequest
+MemcacheFlushResponse = memcache_service_pb.MemcacheFlushResponse
+MemcacheStatsRequest = memcache_service_pb.MemcacheStatsRequest
+MemcacheStatsResponse = memcache_service_pb.MemcacheStatsResponse
+
+DEFAULT_VIRTUAL_NODES = 160
+
+STAT_DOWN = 'down'
+STAT_REQUESTS = 'requests'
+STAT_HIT_RATIO = 'hit_ratio'
+
+
+def _Hash(value):
+  """Returns a 32 bit hash of a string, evenly spread over its range."""
+  return struct.unpack('>I', md5.new(value).digest()[:4])[0]
+
+
+class _HashRing(object):
+  """Maps keys to shards by consistent hashing with virtual nodes.
+
+  Each shard is placed on the ring at virtual_nodes points, and a key belongs
+  to the shard owning the first point at or after the hash of the key. Adding
+  or removing a shard therefore only moves the keys next to its points.
+  """
+
+  def __init__(self, shard_count, virtual_nodes):
+    """Constructor.
+
+    Args:
+      shard_count: The number of shards.
+      virtual_nodes: The number of points each shard has on the ring.
+    """
+    points = []
+    for shard in xrange(shard_count):
+      for node in xrange(virtual_nodes):
+        points.append((_Hash('%d-%d' % (shard, node)), shard))
+    points.sort()
+    self._hashes = [point_hash for point_hash, _ in points]
+    self._shards = [shard for _, shard in points]
+
+  def Lookup(self, hashed_key, is_up=None):
+    """Returns the shard that owns a key.
+
+    Args:
+      hashed_key: The _Hash() of the key.
+      is_up: If given, a function returning whether a shard is up; shards
+        that are down are skipped, as a client would after forgetting dead
+        hosts.
+
+    Returns:
+      The index of the shard, or None if is_up rejected every shard.
+    """
+    position = bisect.bisect_left(self._hashes, hashed_key)
+    point_count = len(self._shards)
+    for offset in xrange(point_count):
+      shard = self._shards[(position + offset) % point_count]
+      if is_up is None or is_up(shard):
+        return shard
+    return None
+
+
+class MemcacheClusterStub(apiproxy_stub.APIProxyStub):
+  """Memcache service stub that spreads keys over several in-process shards.
+
+  Every shard is a MemcacheServiceStub with its own cache and locks, and each
+  key is stored on the shard chosen by consistent hashing of its namespace
+  and key. Calls touching several keys are split into one call per shard.
+
+  A shard can be taken down with SetShardDown(). By default keys that map to
+  a shard that is down behave as they would for an unreachable memcache
+  server: gets miss, and sets, deletes and increments fail. If failover is
+  set, they are instead moved to the next shard on the ring, as they would be
+  by a client that forgets dead hosts.
+
+  Per-shard statistics, including how many key operations each shard has
+  received, are available from GetShardStats() and GetLoadSkew(). The Stats
+  call returns the totals over all shards that are up.
+  """
+
+  def __init__(self, shard_count=4, virtual_nodes=DEFAULT_VIRTUAL_NODES,
+               failover=False, gettime=time.time, service_name='memcache',
+               max_bytes_per_shard=None, persistence_path=None):
+    """Initializer.
+
+    Args:
+      shard_count: The number of shards.
+      virtual_nodes: The number of points each shard has on the hash ring.
+      failover: If True, keys of shards that are down are moved to the next
+        shard that is up rather than failing.
+      gettime: time.time()-like function used for testing.
+      service_name: Service name expected for all calls.
+      max_bytes_per_shard: Maximum number of bytes of keys and values each
+        shard keeps, or None for no limit.
+      persistence_path: If given, each shard keeps its cache across restarts
+        in this path with '.<shard index>' appended.
+    """
+    super(MemcacheClusterStub, self).__init__(service_name)
+    self._service_name = service_name
+    self._failover = failover
+    self._ring = _HashRing(shard_count, virtual_nodes)
+    self._shards = []
+    for index in xrange(shard_count):
+      shard_path = None
+      if persistence_path is not None:
+        shard_path = '%s.%d' % (persistence_path, index)
+      self._shards.append(memcache_stub.MemcacheServiceStub(
+          gettime=gettime, service_name=service_name,
+          max_bytes=max_bytes_per_shard, persistence_path=shard_path))
+    self._down = [False] * shard_count
+    self._requests = [0] * shard_count
+    self._lock = threading.Lock()
+
+  def SetShardDown(self, index, down=True, lose_data=True):
+    """Takes a shard down or brings it back up.
+
+    Args:
+      index: The index of the shard, from 0 to shard_count - 1.
+      down: True to take the shard down, False to bring it back up.
+      lose_data: If True, taking the shard down empties it, as if the server
+        had been restarted. Otherwise it comes back with its old contents,
+        as after a network partition.
+    """
+    if down and lose_data:
+      self._shards[index].MakeSyncCall(self._service_name, 'FlushAll',
+                                       MemcacheFlushRequest(),
+                                       MemcacheFlushResponse())
+    self._down[index] = down
+
+  def _IsUp(self, index):
+    """Returns True if the shard is up."""
+    return not self._down[index]
+
+  def _ShardFor(self, namespace, key):
+    """Returns the index of the shard that stores a key.
+
+    Args:
+      namespace: The namespace of the key.
+      key: The key.
+
+    Returns:
+      The index of the shard, or None if the key cannot be stored because its
+      shard is down.
+    """
+    hashed_key = _Hash('%s\0%s' % (namespace, key))
+    shard = self._ring.Lookup(hashed_key)
+    if self._down[shard]:
+      if self._failover:
+        shard = self._ring.Lookup(hashed_key, is_up=self._IsUp)
+      else:
+        shard = None
+    return shard
+
+  def _Route(self, namespace, keys):
+    """Assigns keys to shards and counts the requests each shard receives.
+
+    Args:
+      namespace: The namespace of the keys.
+      keys: The keys, in request order.
+
+    Returns:
+      A dictionary mapping each shard index to the positions in keys of the
+      keys it stores, in order. Positions of keys that cannot be stored are
+      listed under None.
+    """
+    positions_by_shard = {}
+    for position, key in enumerate(keys):
+      shard = self._ShardFor(namespace, key)
+      positions_by_shard.setdefault(shard, []).append(position)
+
+    self._lock.acquire()
+    try:
+      for shard, positions in positions_by_shard.iteritems():
+        if shard is not None:
+          self._requests[shard] += len(positions)
+    finally:
+      self._lock.release()
+    return positions_by_shard
+
+  def _Call(self, shard, call, request, response):
+    """Makes a call to one shard."""
+    self._shards[shard].MakeSyncCall(self._service_name, call, request,
+                                     response)
+
+  def _Dynamic_Get(self, request, response):
+    """Implementation of MemcacheService::Get().
+
+    Args:
+      request: A MemcacheGetRequest.
+      response: A MemcacheGetResponse.
+    """
+    keys = request.key_list()
+    for shard, positions in self._Route(request.name_space(), keys).iteritems():
+      if shard is None:
+        continue
+      shard_request = MemcacheGetRequest()
+      if request.has_name_space():
+        shard_request.set_name_space(request.name_space())
+      if request.for_cas():
+        shard_request.set_for_cas(True)
+      for position in positions:
+        shard_request.add_key(keys[position])
+      shard_response = MemcacheGetResponse()
+      self._Call(shard, 'Get', shard_request, shard_response)
+      for item in shard_response.item_list():
+        response.add_item().CopyFrom(item)
+
+  def _Dynamic_Set(self, request, response):
+    """Implementation of MemcacheService::Set().
+
+    Args:
+      request: A MemcacheSetRequest.
+      response: A MemcacheSetResponse.
+    """
+    items = request.item_list()
+    set_status = [MemcacheSetResponse.NOT_STORED] * len(items)
+    routes = self._Route(request.name_space(), [item.key() for item in items])
+    for shard, positions in routes.iteritems():
+      if shard is None:
+        continue
+      shard_request = MemcacheSetRequest()
+      if request.has_name_space():
+        shard_request.set_name_space(request.name_space())
+      for position in positions:
+        shard_request.add_item().CopyFrom(items[position])
+      shard_response = MemcacheSetResponse()
+      self._Call(shard, 'Set', shard_request, shard_response)
+      for position, status in zip(positions, shard_response.set_status_list()):
+        set_status[position] = status
+    for status in set_status:
+      response.add_set_status(status)
+
+  def _Dynamic_Delete(self, request, response):
+    """Implementation of MemcacheService::Delete().
+
+    Args:
+      request: A MemcacheDeleteRequest.
+      response: A MemcacheDeleteResponse.
+    """
+    items = request.item_list()
+    delete_status = [MemcacheDeleteResponse.NOT_FOUND] * len(items)
+    routes = self._Route(request.name_space(), [item.key() for item in items])
+    for shard, positions in routes.iteritems():
+      if shard is None:
+        continue
+      shard_request = MemcacheDeleteRequest()
+      if request.has_name_space():
+        shard_request.set_name_space(request.name_space())
+      for position in positions:
+        shard_request.add_item().CopyFrom(items[position])
+      shard_response = MemcacheDeleteResponse()
+      self._Call(shard, 'Delete', shard_request, shard_response)
+      for position, status in zip(positions,
+                                  shard_response.delete_status_list()):
+        delete_status[position] = status
+    for status in delete_status:
+      response.add_delete_status(status)
+
+  def _Dynamic_Increment(self, request, response):
+    """Implementation of MemcacheService::Increment().
+
+    Args:
+      request: A MemcacheIncrementRequest.
+      response: A MemcacheIncrementResponse.
+    """
+    routes = self._Route(request.name_space(), [request.key()])
+    shard = routes.keys()[0]
+    if shard is None:
+      raise apiproxy_errors.ApplicationError(
+          memcache_service_pb.MemcacheServiceError.UNSPECIFIED_ERROR)
+    self._Call(shard, 'Increment', request, response)
+
+  def _Dynamic_BatchIncrement(self, request, response):
+    """Implementation of MemcacheService::BatchIncrement().
+
+    Args:
+      request: A MemcacheBatchIncrementRequest.
+      response: A MemcacheBatchIncrementResponse.
+    """
+    items = request.item_list()
+    results = [None] * len(items)
+    routes = self._Route(request.name_space(), [item.key() for item in items])
+    for shard, positions in routes.iteritems():
+      if shard is None:
+        continue
+      shard_request = MemcacheBatchIncrementRequest()
+      if request.has_name_space():
+        shard_request.set_name_space(request.name_space())
+      for position in positions:
+        shard_request.add_item().CopyFrom(items[position])
+      shard_response = MemcacheBatchIncrementResponse()
+      self._Call(shard, 'BatchIncrement', shard_request, shard_response)
+      for position, item in zip(positions, shard_response.item_list()):
+        results[position] = item
+    for result in results:
+      item = response.add_item()
+      if result is None:
+        item.set_increment_status(MemcacheIncrementResponse.NOT_CHANGED)
+      else:
+        item.CopyFrom(result)
+
+  def _Dynamic_FlushAll(self, request, response):
+    """Implementation of MemcacheService::FlushAll().
+
+    Args:
+      request: A MemcacheFlushRequest.
+      response: A MemcacheFlushResponse.
+    """
+    for shard in xrange(len(self._shards)):
+      if self._IsUp(shard):
+        self._Call(shard, 'FlushAll', MemcacheFlushRequest(),
+                   MemcacheFlushResponse())
+    self._lock.acquire()
+    try:
+      self._requests = [0] * len(self._shards)
+    finally:
+      self._lock.release()
+
+  def _ShardStats(self, shard):
+    """Returns the MergedNamespaceStats of one shard."""
+    shard_response = MemcacheStatsResponse()
+    self._Call(shard, 'Stats', MemcacheStatsRequest(), shard_response)
+    return shard_response.stats()
+
+  def _Dynamic_Stats(self, request, response):
+    """Implementation of MemcacheService::Stats().
+
+    Args:
+      request: A MemcacheStatsRequest.
+      response: A MemcacheStatsResponse.
+    """
+    stats = response.mutable_stats()
+    stats.set_hits(0)
+    stats.set_misses(0)
+    stats.set_byte_hits(0)
+    stats.set_items(0)
+    stats.set_bytes(0)
+    stats.set_oldest_item_age(0)
+    stats.set_evictions(0)
+    for shard in xrange(len(self._shards)):
+      if not self._IsUp(shard):
+        continue
+      shard_stats = self._ShardStats(shard)
+      stats.set_hits(stats.hits() + shard_stats.hits())
+      stats.set_misses(stats.misses() + shard_stats.misses())
+      stats.set_byte_hits(stats.byte_hits() + shard_stats.byte_hits())
+      stats.set_items(stats.items() + shard_stats.items())
+      stats.set_bytes(stats.bytes() + shard_stats.bytes())
+      stats.set_evictions(stats.evictions() + shard_stats.evictions())
+      stats.set_oldest_item_age(max(stats.oldest_item_age(),
+                                    shard_stats.oldest_item_age()))
+
+  def GetShardStats(self):
+    """Gets statistics for each shard.
+
+    Returns:
+      A list with a dictionary for each shard, in shard order. Each has the
+      memcache.STAT_* statistics of the shard, plus STAT_DOWN, whether the
+      shard is down; STAT_REQUESTS, the number of key operations routed to
+      it since the last flush; and STAT_HIT_RATIO, its hits as a fraction of
+      its lookups, or None if it has had none.
+    """
+    shard_stats_list = []
+    for shard in xrange(len(self._shards)):
+      stats = self._ShardStats(shard)
+      lookups = stats.hits() + stats.misses()
+      hit_ratio = None
+      if lookups:
+        hit_ratio = float(stats.hits()) / lookups
+      shard_stats_list.append({
+        memcache.STAT_HITS: stats.hits(),
+        memcache.STAT_MISSES: stats.misses(),
+        memcache.STAT_BYTE_HITS: stats.byte_hits(),
+        memcache.STAT_ITEMS: stats.items(),
+        memcache.STAT_BYTES: stats.bytes(),
+        memcache.STAT_OLDEST_ITEM_AGES: stats.oldest_item_age(),
+        memcache.STAT_EVICTIONS: stats.evictions(),
+        STAT_DOWN: self._down[shard],
+        STAT_REQUESTS: self._requests[shard],
+        STAT_HIT_RATIO: hit_ratio,
+      })
+    return shard_stats_list
+
+  def GetLoadSkew(self, stat=STAT_REQUESTS):
+    """Measures how unevenly a statistic is spread over the shards that are up.
+
+    Args:
+      stat: The GetShardStats() statistic to compare, e.g. STAT_REQUESTS for
+        the load or memcache.STAT_ITEMS for the keys stored.
+
+    Returns:
+      The largest value of the statistic on any shard divided by its mean,
+      so 1.0 for a perfectly even spread. None if the statistic is zero on
+      every shard.
+    """
+    values = [shard_stats[stat] for shard_stats in self.GetShardStats()
+              if not shard_stats[STAT_DOWN]]
+    if not values or not sum(values):
+      return None
+    return max(values) / (float(sum(values)) / len(values))
@@ -19,11 +19,15 @@
 
 
 
+import gc
+import heapq
 import logging
+import threading
 import time
 
 from google.appengine.api import apiproxy_stub
 from google.appengine.api import memcache
+from google.appengine.api import stub_persistence
 from google.appengine.api.memcache import memcache_service_pb
 from google.appengine.runtime import apiproxy_errors
 
@@ -33,10 +37,21 @@ MemcacheIncrementRequest = memcache_service_pb.MemcacheIncrementRequest
 MemcacheIncrementResponse = memcache_service_pb.MemcacheIncrementResponse
 MemcacheDeleteResponse = memcache_service_pb.MemcacheDeleteResponse
 
+_KEY_LOCK_STRIPES = 64
+
+_LOG_SET = 0
+_LOG_DELETE = 1
+_LOG_LOCK = 2
+_LOG_VALUE = 3
+
 
 class CacheEntry(object):
   """An entry in the cache."""
 
+  __slots__ = ('_gettime', 'value', 'flags', 'created_time',
+               'last_access_time', 'will_expire', 'locked', 'expiration_time',
+               'cas_id', 'namespace', 'key', 'lru_prev', 'lru_next')
+
   def __init__(self, value, expiration, flags, gettime):
     """Initializer.
 
@@ -55,10 +70,17 @@ class CacheEntry(object):
     self.value = value
     self.flags = flags
     self.created_time = self._gettime()
+    self.last_access_time = self.created_time
     self.will_expire = expiration != 0
     self.locked = False
     self._SetExpiration(expiration)
 
+    self.cas_id = 0
+    self.namespace = None
+    self.key = None
+    self.lru_prev = None
+    self.lru_next = None
+
   def _SetExpiration(self, expiration):
     """Sets the expiration for this entry.
 
@@ -93,38 +115,507 @@ class CacheEntry(object):
     """Returns True if this entry was deleted but has not yet timed out."""
     return self.locked and not self.CheckExpired()
 
+  def Size(self):
+    """Returns the number of bytes this entry counts against the cache."""
+    return len(self.key) + len(self.value)
+
+
+class _LruList(object):
+  """Doubly linked list of CacheEntry objects, least recently used first."""
+
+  def __init__(self):
+    self._head = CacheEntry('', 0, 0, gettime=lambda: 0)
+    self._head.lru_prev = self._head
+    self._head.lru_next = self._head
+
+  def Append(self, entry):
+    """Adds an entry as the most recently used one."""
+    tail = self._head.lru_prev
+    entry.lru_prev = tail
+    entry.lru_next = self._head
+    tail.lru_next = entry
+    self._head.lru_prev = entry
+
+  def Remove(self, entry):
+    """Unlinks an entry from the list."""
+    entry.lru_prev.lru_next = entry.lru_next
+    entry.lru_next.lru_prev = entry.lru_prev
+    entry.lru_prev = None
+    entry.lru_next = None
+
+  def Touch(self, entry):
+    """Marks an entry as the most recently used one."""
+    self.Remove(entry)
+    self.Append(entry)
+
+  def Oldest(self):
+    """Returns the least recently used entry, or None if the list is empty."""
+    if self._head.lru_next is self._head:
+      return None
+    return self._head.lru_next
+
+  def Clear(self):
+    """Removes all entries."""
+    self._head.lru_prev = self._head
+    self._head.lru_next = self._head
+
+  def Entries(self):
+    """Yields every entry, least recently used first."""
+    entry = self._head.lru_next
+    while entry is not self._head:
+      yield entry
+      entry = entry.lru_next
+
+
+class _NamespaceStats(object):
+  """Running statistics for the entries and requests of one namespace."""
+
+  __slots__ = ('hits', 'misses', 'byte_hits', 'items', 'bytes', 'evictions')
+
+  def __init__(self):
+    self.hits = 0
+    self.misses = 0
+    self.byte_hits = 0
+    self.items = 0
+    self.bytes = 0
+    self.evictions = 0
+
+  def ToDict(self):
+    """Returns these statistics keyed by the memcache.STAT_* names."""
+    return {
+      memcache.STAT_HITS: self.hits,
+      memcache.STAT_MISSES: self.misses,
+      memcache.STAT_BYTE_HITS: self.byte_hits,
+      memcache.STAT_ITEMS: self.items,
+      memcache.STAT_BYTES: self.bytes,
+      memcache.STAT_EVICTIONS: self.evictions,
+    }
+
 
 class MemcacheServiceStub(apiproxy_stub.APIProxyStub):
   """Python only memcache service stub.
 
   This stub keeps all data in the local process' memory, not in any
-  external servers.
+  external servers. If max_bytes is given, the least recently used entries
+  are evicted once the keys and values stored exceed that many bytes. Expired
+  entries are removed as soon as they expire, rather than when next read.
+
+  Statistics are kept as running counters, both for the whole cache and per
+  namespace, so reading them does not depend on the size of the cache.
+
+  If persistence_path is given, the cache survives restarts. The stub keeps
+  a snapshot of the cache in that file and appends every change made since
+  the snapshot to a log next to it, and reloads both when it is created.
+  Expiration times are kept, so entries that expired while the stub was not
+  running are not restored. The log is folded into a new snapshot once it
+  has grown larger than the cache.
+
+  The stub is safe to call from several threads. Each read-modify-write of a
+  key (add, replace, cas, delete, incr and decr) holds one of a fixed set of key
+  locks, chosen by hashing the namespace and key, for its whole duration, so
+  operations on the same key are atomic with respect to each other while
+  operations on different keys mostly proceed independently. The shared
+  cache dictionaries, LRU list, expiration heap and counters are guarded by
+  a separate lock that is only held for individual updates. A key lock is
+  always taken before that lock, never after it.
   """
 
-  def __init__(self, gettime=time.time, service_name='memcache'):
+  def __init__(self, gettime=time.time, service_name='memcache',
+               max_bytes=None, persistence_path=None):
     """Initializer.
 
     Args:
       gettime: time.time()-like function used for testing.
       service_name: Service name expected for all calls.
+      max_bytes: Maximum number of bytes of keys and values to keep in the
+        cache, or None for no limit.
+      persistence_path: Path of the file to keep the cache in across
+        restarts, or None to keep it only in memory. The log of changes is
+        kept in the same path with '.log' appended.
     """
     super(MemcacheServiceStub, self).__init__(service_name)
     self._gettime = lambda: int(gettime())
+    self._max_bytes = max_bytes
     self._ResetStats()
 
+    self._lock = threading.Lock()
+    self._key_locks = [threading.Lock() for _ in xrange(_KEY_LOCK_STRIPES)]
+
     self._the_cache = {}
+    self._lru = _LruList()
+    self._expiration_heap = []
+    self._items = 0
+    self._bytes = 0
+    self._next_cas_id = 1
+
+    self._persistence = None
+    if persistence_path is not None:
+      self._persistence = stub_persistence.SnapshotLog(persistence_path)
+      self._Restore()
+      self._persistence.Open()
+
+  def _Restore(self):
+    """Loads the snapshot and replays the log into the empty cache."""
+    now = self._gettime()
+    gc_was_enabled = gc.isenabled()
+    gc.disable()
+    self._lock.acquire()
+    try:
+      self._LoadSnapshot(self._persistence.ReadSnapshot(), now)
+      for records in self._persistence.ReadLog():
+        for record in records:
+          self._Replay(record, now)
+    finally:
+      self._lock.release()
+      if gc_was_enabled:
+        gc.enable()
+    logging.info('Restored %d memcache items from %s', self._items,
+                 self._persistence.path)
+
+  def _LoadSnapshot(self, batches, now):
+    """Stores the entries of a snapshot in the empty cache.
+
+    Does the work of _AddEntry for all entries at once, since a snapshot
+    holds each key only once. The caller must hold self._lock.
+
+    Args:
+      batches: Iterable of lists of _LOG_SET records, least recently used
+        first.
+      now: The current time, used to skip entries that have expired.
+    """
+    the_cache = self._the_cache
+    lru = self._lru
+    heap = self._expiration_heap
+    for records in batches:
+      for _, namespace, key, value, flags, expiration_time, locked in records:
+        if expiration_time and expiration_time <= now:
+          continue
+        entry = CacheEntry(value, 0, flags, gettime=self._gettime)
+        entry.namespace = namespace
+        entry.key = key
+        entry.locked = locked
+        entry.cas_id = self._next_cas_id
+        self._next_cas_id += 1
+        if expiration_time:
+          entry.will_expire = True
+          entry.expiration_time = expiration_time
+          heap.append((expiration_time, namespace, key, entry.cas_id))
+        namespace_dict = the_cache.get(namespace, None)
+        if namespace_dict is None:
+          namespace_dict = the_cache[namespace] = {}
+        namespace_dict[key] = entry
+        lru.Append(entry)
+    heapq.heapify(heap)
+
+    for namespace, namespace_dict in the_cache.iteritems():
+      namespace_stats = self._GetNamespaceStats(namespace)
+      namespace_stats.items = len(namespace_dict)
+      namespace_stats.bytes = sum(entry.Size()
+                                  for entry in namespace_dict.itervalues())
+      self._items += namespace_stats.items
+      self._bytes += namespace_stats.bytes
+
+  def _Replay(self, record, now):
+    """Applies one snapshot or log record to the cache.
+
+    The caller must hold self._lock.
+
+    Args:
+      record: A tuple whose first element is one of the _LOG_* constants.
+      now: The current time, used to skip entries that have expired.
+    """
+    operation, namespace, key = record[:3]
+    if operation == _LOG_SET:
+      value, flags, expiration_time, locked = record[3:]
+      if expiration_time and expiration_time <= now:
+        self._RemoveEntry(namespace, key)
+        return
+      entry = CacheEntry(value, 0, flags, gettime=self._gettime)
+      if expiration_time:
+        entry.will_expire = True
+        entry.expiration_time = expiration_time
+      entry.locked = locked
+      self._AddEntry(namespace, key, entry)
+    elif operation == _LOG_DELETE:
+      self._RemoveEntry(namespace, key)
+    else:
+      entry = self._GetKey(namespace, key)
+      if entry is None:
+        return
+      if operation == _LOG_LOCK:
+        expiration_time = record[3]
+        if expiration_time <= now:
+          self._RemoveEntry(namespace, key)
+          return
+        entry.will_expire = True
+        entry.locked = True
+        entry.expiration_time = expiration_time
+        self._ScheduleExpiration(entry)
+      else:
+        self._SetValue(entry, record[3])
+
+  def _Log(self, record):
+    """Queues a record of a change for the log, if persistence is enabled.
+
+    The caller must hold self._lock.
+    """
+    if self._persistence is not None:
+      self._persistence.Append(record)
+
+  def _LogSet(self, entry):
+    """Queues a record that stores an entry. The caller must hold self._lock."""
+    if self._persistence is not None:
+      self._persistence.Append(self._SetRecord(entry))
+
+  def _SetRecord(self, entry):
+    """Returns the snapshot or log record that stores an entry."""
+    if entry.will_expire:
+      expiration_time = entry.expiration_time
+    else:
+      expiration_time = 0
+    return (_LOG_SET, entry.namespace, entry.key, entry.value, entry.flags,
+            expiration_time, entry.locked)
+
+  def _FlushLog(self):
+    """Writes the queued log records, compacting the log if it is too long."""
+    if self._persistence is None:
+      return
+    self._lock.acquire()
+    try:
+      if (self._persistence.Flush() and
+          self._persistence.NeedsCompaction(self._items)):
+        self._WriteSnapshot()
+    finally:
+      self._lock.release()
+
+  def Snapshot(self):
+    """Writes the whole cache to the snapshot file and empties the log.
+
+    Does nothing if the stub was created without a persistence_path.
+    """
+    if self._persistence is None:
+      return
+    self._ExpireEntries()
+    self._lock.acquire()
+    try:
+      self._WriteSnapshot()
+    finally:
+      self._lock.release()
+
+  def _WriteSnapshot(self):
+    """Implementation of Snapshot(). The caller must hold self._lock."""
+    self._persistence.WriteSnapshot(
+        self._SetRecord(entry) for entry in self._lru.Entries())
 
   def _ResetStats(self):
     """Resets statistics information."""
     self._hits = 0
     self._misses = 0
     self._byte_hits = 0
+    self._evictions = 0
+    self._namespace_stats = {}
     self._cache_creation_time = self._gettime()
 
+  def _GetNamespaceStats(self, namespace):
+    """Returns the _NamespaceStats for a namespace, creating it if needed."""
+    namespace_stats = self._namespace_stats.get(namespace, None)
+    if namespace_stats is None:
+      namespace_stats = self._namespace_stats[namespace] = _NamespaceStats()
+    return namespace_stats
+
+  def GetNamespaceStats(self, namespace=None):
+    """Gets statistics broken down by namespace.
+
+    Args:
+      namespace: If given, only return statistics for this namespace. The
+        empty string is the default namespace.
+
+    Returns:
+      If namespace is None, a dictionary mapping each namespace that has been
+      used since the last flush to a dictionary of its statistics. Otherwise
+      the statistics dictionary for the given namespace. Statistics are keyed
+      by the memcache.STAT_* names, except for oldest_item_age which is only
+      tracked for the whole cache.
+    """
+    self._ExpireEntries()
+    self._lock.acquire()
+    try:
+      if namespace is not None:
+        return self._GetNamespaceStats(namespace).ToDict()
+      return dict((name, namespace_stats.ToDict())
+                  for name, namespace_stats in self._namespace_stats.iteritems())
+    finally:
+      self._lock.release()
+
+  def _KeyLock(self, namespace, key):
+    """Returns the lock that serializes operations on a key.
+
+    Args:
+      namespace: The namespace that keys are stored under.
+      key: The key that will be operated on.
+
+    Returns:
+      A threading.Lock shared by every key that hashes to the same stripe.
+    """
+    return self._key_locks[hash((namespace, key)) % _KEY_LOCK_STRIPES]
+
+  def _IsStored(self, entry):
+    """Returns True if entry is still the cached entry for its key."""
+    namespace_dict = self._the_cache.get(entry.namespace, None)
+    return namespace_dict is not None and namespace_dict.get(entry.key) is entry
+
+  def _AddEntry(self, namespace, key, entry):
+    """Stores an entry, replacing any existing entry for the same key.
+
+    Evicts least recently used entries if the cache is over its byte budget.
+    The caller must hold self._lock.
+
+    Args:
+      namespace: The namespace that keys are stored under.
+      key: The key to store the entry under.
+      entry: The CacheEntry to store.
+    """
+    self._RemoveEntry(namespace, key)
+    entry.namespace = namespace
+    entry.key = key
+    entry.cas_id = self._NewCasId()
+    if namespace not in self._the_cache:
+      self._the_cache[namespace] = {}
+    self._the_cache[namespace][key] = entry
+    self._lru.Append(entry)
+    size = entry.Size()
+    self._items += 1
+    self._bytes += size
+    namespace_stats = self._GetNamespaceStats(namespace)
+    namespace_stats.items += 1
+    namespace_stats.bytes += size
+    self._ScheduleExpiration(entry)
+    self._LogSet(entry)
+
+    if self._max_bytes is not None:
+      while self._bytes > self._max_bytes:
+        oldest = self._lru.Oldest()
+        if oldest is None:
+          break
+        self._RemoveEntry(oldest.namespace, oldest.key)
+        self._Log((_LOG_DELETE, oldest.namespace, oldest.key))
+        self._evictions += 1
+        self._GetNamespaceStats(oldest.namespace).evictions += 1
+
+  def _RemoveEntry(self, namespace, key):
+    """Removes the entry for a key, if there is one.
+
+    The caller must hold self._lock.
+
+    Args:
+      namespace: The namespace that keys are stored under.
+      key: The key to remove.
+    """
+    namespace_dict = self._the_cache.get(namespace, None)
+    if namespace_dict is None:
+      return
+    entry = namespace_dict.pop(key, None)
+    if entry is None:
+      return
+    if not namespace_dict:
+      del self._the_cache[namespace]
+    self._lru.Remove(entry)
+    size = entry.Size()
+    self._items -= 1
+    self._bytes -= size
+    namespace_stats = self._GetNamespaceStats(namespace)
+    namespace_stats.items -= 1
+    namespace_stats.bytes -= size
+
+  def _SetValue(self, entry, value):
+    """Changes the value of an entry, keeping the byte count current.
+
+    The caller must hold self._lock.
+    """
+    if self._IsStored(entry):
+      delta = len(value) - len(entry.value)
+      self._bytes += delta
+      self._GetNamespaceStats(entry.namespace).bytes += delta
+    entry.value = value
+    entry.cas_id = self._NewCasId()
+    if self._IsStored(entry):
+      self._ScheduleExpiration(entry)
+    self._Log((_LOG_VALUE, entry.namespace, entry.key, value))
+
+  def _NewCasId(self):
+    """Returns a new CAS ID. The caller must hold self._lock."""
+    cas_id = self._next_cas_id
+    self._next_cas_id += 1
+    return cas_id
+
+  def _ScheduleExpiration(self, entry):
+    """Schedules a stored entry for removal once it expires.
+
+    The heap only records the entry's expiration time, key and CAS ID, so that
+    entries which are evicted or overwritten before they expire are not kept
+    alive by it. The caller must hold self._lock.
+    """
+    if entry.will_expire:
+      heapq.heappush(self._expiration_heap,
+                     (entry.expiration_time, entry.namespace, entry.key,
+                      entry.cas_id))
+      self._CompactExpirations()
+
+  def _ExpirationEntry(self, record):
+    """Returns the stored entry an expiration heap record refers to.
+
+    The caller must hold self._lock.
+
+    Args:
+      record: An (expiration_time, namespace, key, cas_id) tuple from the
+        expiration heap.
+
+    Returns:
+      The CacheEntry, or None if the record is stale because the entry has
+      since been removed, replaced, changed or given another expiration time.
+    """
+    expiration_time, namespace, key, cas_id = record
+    namespace_dict = self._the_cache.get(namespace, None)
+    if namespace_dict is None:
+      return None
+    entry = namespace_dict.get(key, None)
+    if (entry is None or entry.cas_id != cas_id or not entry.will_expire or
+        entry.expiration_time != expiration_time):
+      return None
+    return entry
+
+  def _CompactExpirations(self):
+    """Drops stale expiration records once they make up most of the heap.
+
+    The caller must hold self._lock.
+    """
+    heap = self._expiration_heap
+    if len(heap) > 2 * self._items + 16:
+      self._expiration_heap = [record for record in heap
+                               if self._ExpirationEntry(record) is not None]
+      heapq.heapify(self._expiration_heap)
+
+  def _ExpireEntries(self):
+    """Removes every entry whose expiration time has passed."""
+    now = self._gettime()
+    heap = self._expiration_heap
+    if not heap or heap[0][0] > now:
+      return
+    self._lock.acquire()
+    try:
+      heap = self._expiration_heap
+      while heap and heap[0][0] <= now:
+        entry = self._ExpirationEntry(heapq.heappop(heap))
+        if entry is not None:
+          self._RemoveEntry(entry.namespace, entry.key)
+    finally:
+      self._lock.release()
+
   def _GetKey(self, namespace, key):
     """Retrieves a CacheEntry from the cache if it hasn't expired.
 
-    Does not take deletion timeout into account.
+    Does not take deletion timeout into account. The caller must hold
+    self._lock.
 
     Args:
       namespace: The namespace that keys are stored under.
@@ -141,9 +632,11 @@ class MemcacheServiceStub(apiproxy_stub.APIProxyStub):
     if entry is None:
       return None
     elif entry.CheckExpired():
-      del namespace_dict[key]
+      self._RemoveEntry(namespace, key)
       return None
     else:
+      entry.last_access_time = self._gettime()
+      self._lru.Touch(entry)
       return entry
 
   def _Dynamic_Get(self, request, response):
@@ -153,19 +646,31 @@ class MemcacheServiceStub(apiproxy_stub.APIProxyStub):
       request: A MemcacheGetRequest.
       response: A MemcacheGetResponse.
     """
+    self._ExpireEntries()
     namespace = request.name_space()
+    for_cas = request.for_cas()
     keys = set(request.key_list())
-    for key in keys:
-      entry = self._GetKey(namespace, key)
-      if entry is None or entry.CheckLocked():
-        self._misses += 1
-        continue
-      self._hits += 1
-      self._byte_hits += len(entry.value)
-      item = response.add_item()
-      item.set_key(key)
-      item.set_value(entry.value)
-      item.set_flags(entry.flags)
+    self._lock.acquire()
+    try:
+      namespace_stats = self._GetNamespaceStats(namespace)
+      for key in keys:
+        entry = self._GetKey(namespace, key)
+        if entry is None or entry.CheckLocked():
+          self._misses += 1
+          namespace_stats.misses += 1
+          continue
+        self._hits += 1
+        self._byte_hits += len(entry.value)
+        namespace_stats.hits += 1
+        namespace_stats.byte_hits += len(entry.value)
+        item = response.add_item()
+        item.set_key(key)
+        item.set_value(entry.value)
+        item.set_flags(entry.flags)
+        if for_cas:
+          item.set_cas_id(entry.cas_id)
+    finally:
+      self._lock.release()
 
   def _Dynamic_Set(self, request, response):
     """Implementation of MemcacheService::Set().
@@ -174,29 +679,50 @@ class MemcacheServiceStub(apiproxy_stub.APIProxyStub):
       request: A MemcacheSetRequest.
       response: A MemcacheSetResponse.
     """
+    self._ExpireEntries()
     namespace = request.name_space()
     for item in request.item_list():
       key = item.key()
       set_policy = item.set_policy()
-      old_entry = self._GetKey(namespace, key)
-
-      set_status = MemcacheSetResponse.NOT_STORED
-      if ((set_policy == MemcacheSetRequest.SET) or
-          (set_policy == MemcacheSetRequest.ADD and old_entry is None) or
-          (set_policy == MemcacheSetRequest.REPLACE and old_entry is not None)):
-
-        if (old_entry is None or
-            set_policy == MemcacheSetRequest.SET
-            or not old_entry.CheckLocked()):
-          if namespace not in self._the_cache:
-            self._the_cache[namespace] = {}
-          self._the_cache[namespace][key] = CacheEntry(item.value(),
-                                                       item.expiration_time(),
-                                                       item.flags(),
-                                                       gettime=self._gettime)
-          set_status = MemcacheSetResponse.STORED
+      new_entry = CacheEntry(item.value(), item.expiration_time(), item.flags(),
+                             gettime=self._gettime)
+      key_lock = self._KeyLock(namespace, key)
+      key_lock.acquire()
+      try:
+        self._lock.acquire()
+        try:
+          old_entry = self._GetKey(namespace, key)
+        finally:
+          self._lock.release()
+
+        set_status = MemcacheSetResponse.NOT_STORED
+        if set_policy == MemcacheSetRequest.CAS:
+          if old_entry is not None and not old_entry.CheckLocked():
+            if old_entry.cas_id == item.cas_id():
+              set_status = MemcacheSetResponse.STORED
+            else:
+              set_status = MemcacheSetResponse.EXISTS
+        elif ((set_policy == MemcacheSetRequest.SET) or
+              (set_policy == MemcacheSetRequest.ADD and old_entry is None) or
+              (set_policy == MemcacheSetRequest.REPLACE and
+               old_entry is not None)):
+
+          if (old_entry is None or
+              set_policy == MemcacheSetRequest.SET
+              or not old_entry.CheckLocked()):
+            set_status = MemcacheSetResponse.STORED
+
+        if set_status == MemcacheSetResponse.STORED:
+          self._lock.acquire()
+          try:
+            self._AddEntry(namespace, key, new_entry)
+          finally:
+            self._lock.release()
+      finally:
+        key_lock.release()
 
       response.add_set_status(set_status)
+    self._FlushLog()
 
   def _Dynamic_Delete(self, request, response):
     """Implementation of MemcacheService::Delete().
@@ -205,20 +731,34 @@ class MemcacheServiceStub(apiproxy_stub.APIProxyStub):
       request: A MemcacheDeleteRequest.
       response: A MemcacheDeleteResponse.
     """
+    self._ExpireEntries()
     namespace = request.name_space()
     for item in request.item_list():
       key = item.key()
-      entry = self._GetKey(namespace, key)
-
-      delete_status = MemcacheDeleteResponse.DELETED
-      if entry is None:
-        delete_status = MemcacheDeleteResponse.NOT_FOUND
-      elif item.delete_time() == 0:
-        del self._the_cache[namespace][key]
-      else:
-        entry.ExpireAndLock(item.delete_time())
+      key_lock = self._KeyLock(namespace, key)
+      key_lock.acquire()
+      try:
+        self._lock.acquire()
+        try:
+          entry = self._GetKey(namespace, key)
+
+          delete_status = MemcacheDeleteResponse.DELETED
+          if entry is None:
+            delete_status = MemcacheDeleteResponse.NOT_FOUND
+          elif item.delete_time() == 0:
+            self._RemoveEntry(namespace, key)
+            self._Log((_LOG_DELETE, namespace, key))
+          else:
+            entry.ExpireAndLock(item.delete_time())
+            self._ScheduleExpiration(entry)
+            self._Log((_LOG_LOCK, namespace, key, entry.expiration_time))
+        finally:
+          self._lock.release()
+      finally:
+        key_lock.release()
 
       response.add_delete_status(delete_status)
+    self._FlushLog()
 
   def _internal_increment(self, namespace, request):
     """Internal function for incrementing from a MemcacheIncrementRequest.
@@ -232,38 +772,48 @@ class MemcacheServiceStub(apiproxy_stub.APIProxyStub):
       An integer or long if the offset was successful, None on error.
     """
     key = request.key()
-    entry = self._GetKey(namespace, key)
-    if entry is None:
-      if not request.has_initial_value():
-        return None
-      if namespace not in self._the_cache:
-        self._the_cache[namespace] = {}
-      self._the_cache[namespace][key] = CacheEntry(str(request.initial_value()),
-                                                   expiration=0,
-                                                   flags=0,
-                                                   gettime=self._gettime)
-      entry = self._GetKey(namespace, key)
-      assert entry is not None
-
+    key_lock = self._KeyLock(namespace, key)
+    key_lock.acquire()
     try:
-      old_value = long(entry.value)
-      if old_value < 0:
-        raise ValueError
-    except ValueError:
-      logging.error('Increment/decrement failed: Could not interpret '
-                    'value for key = "%s" as an unsigned integer.', key)
-      return None
+      self._lock.acquire()
+      try:
+        entry = self._GetKey(namespace, key)
+        if entry is None:
+          if not request.has_initial_value():
+            return None
+          entry = CacheEntry(str(request.initial_value()),
+                             expiration=0,
+                             flags=0,
+                             gettime=self._gettime)
+          self._AddEntry(namespace, key, entry)
+      finally:
+        self._lock.release()
+
+      try:
+        old_value = long(entry.value)
+        if old_value < 0:
+          raise ValueError
+      except ValueError:
+        logging.error('Increment/decrement failed: Could not interpret '
+                      'value for key = "%s" as an unsigned integer.', key)
+        return None
 
-    delta = request.delta()
-    if request.direction() == MemcacheIncrementRequest.DECREMENT:
-      delta = -delta
+      delta = request.delta()
+      if request.direction() == MemcacheIncrementRequest.DECREMENT:
+        delta = -delta
 
-    new_value = old_value + delta
-    if not (0 <= new_value < 2**64):
-      new_value = 0
+      new_value = old_value + delta
+      if not (0 <= new_value < 2**64):
+        new_value = 0
 
-    entry.value = str(new_value)
-    return new_value
+      self._lock.acquire()
+      try:
+        self._SetValue(entry, str(new_value))
+      finally:
+        self._lock.release()
+      return new_value
+    finally:
+      key_lock.release()
 
   def _Dynamic_Increment(self, request, response):
     """Implementation of MemcacheService::Increment().
@@ -272,8 +822,10 @@ class MemcacheServiceStub(apiproxy_stub.APIProxyStub):
       request: A MemcacheIncrementRequest.
       response: A MemcacheIncrementResponse.
     """
+    self._ExpireEntries()
     namespace = request.name_space()
     new_value = self._internal_increment(namespace, request)
+    self._FlushLog()
     if new_value is None:
       raise apiproxy_errors.ApplicationError(
           memcache_service_pb.MemcacheServiceError.UNSPECIFIED_ERROR)
@@ -286,6 +838,7 @@ class MemcacheServiceStub(apiproxy_stub.APIProxyStub):
       request: A MemcacheBatchIncrementRequest.
       response: A MemcacheBatchIncrementResponse.
     """
+    self._ExpireEntries()
     namespace = request.name_space()
     for request_item in request.item_list():
       new_value = self._internal_increment(namespace, request_item)
@@ -295,6 +848,7 @@ class MemcacheServiceStub(apiproxy_stub.APIProxyStub):
       else:
         item.set_increment_status(MemcacheIncrementResponse.OK)
         item.set_new_value(new_value)
+    self._FlushLog()
 
   def _Dynamic_FlushAll(self, request, response):
     """Implementation of MemcacheService::FlushAll().
@@ -303,8 +857,18 @@ class MemcacheServiceStub(apiproxy_stub.APIProxyStub):
       request: A MemcacheFlushRequest.
       response: A MemcacheFlushResponse.
     """
-    self._the_cache.clear()
-    self._ResetStats()
+    self._lock.acquire()
+    try:
+      self._the_cache.clear()
+      self._lru.Clear()
+      self._expiration_heap = []
+      self._items = 0
+      self._bytes = 0
+      self._ResetStats()
+      if self._persistence is not None:
+        self._WriteSnapshot()
+    finally:
+      self._lock.release()
 
   def _Dynamic_Stats(self, request, response):
     """Implementation of MemcacheService::Stats().
@@ -313,18 +877,21 @@ class MemcacheServiceStub(apiproxy_stub.APIProxyStub):
       request: A MemcacheStatsRequest.
       response: A MemcacheStatsResponse.
     """
+    self._ExpireEntries()
     stats = response.mutable_stats()
-    stats.set_hits(self._hits)
-    stats.set_misses(self._misses)
-    stats.set_byte_hits(self._byte_hits)
-    items = 0
-    total_bytes = 0
-    for namespace in self._the_cache.itervalues():
-      items += len(namespace)
-      for entry in namespace.itervalues():
-        total_bytes += len(entry.value)
-    stats.set_items(items)
-    stats.set_bytes(total_bytes)
-
-    stats.set_oldest_item_age(self._gettime() - self._cache_creation_time)
-
+    self._lock.acquire()
+    try:
+      stats.set_hits(self._hits)
+      stats.set_misses(self._misses)
+      stats.set_byte_hits(self._byte_hits)
+      stats.set_items(self._items)
+      stats.set_bytes(self._bytes)
+      stats.set_evictions(self._evictions)
+
+      oldest = self._lru.Oldest()
+      if oldest is None:
+        stats.set_oldest_item_age(self._gettime() - self._cache_creation_time)
+      else:
+        stats.set_oldest_item_age(self._gettime() - oldest.last_access_time)
+    finally:
+      self._lock.release()
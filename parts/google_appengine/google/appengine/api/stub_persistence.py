@@ -0,0 +1,164 @@
+#!/usr/bin/env python
+#
+# Copyright 2007 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""Snapshot and log files that let API stubs keep their data across restarts.
+
+A stub keeps its whole state in a snapshot file and appends the changes it
+makes afterwards to a log file next to it. On restart it loads the snapshot
+and replays the log. Once the log grows too long the stub writes a new
+snapshot, which empties the log. Both files hold marshalled lists of records,
+whose meaning is up to the stub.
+"""
+
+
+
+import logging
+import marshal
+import os
+
+SNAPSHOT_BATCH_SIZE = 1000
+MIN_LOG_RECORDS_TO_COMPACT = 10000
+
+
+def ReadRecords(path):
+  """Yields the lists of records in a snapshot or log file.
+
+  A missing file is treated as empty. An incomplete list at the end of the
+  file, left by a process that died while writing it, is ignored and cut off,
+  so that records appended later can be read back.
+
+  Args:
+    path: Path of the file to read.
+  """
+  if not os.path.isfile(path):
+    return
+  data_file = open(path, 'r+b')
+  try:
+    while True:
+      offset = data_file.tell()
+      try:
+        records = marshal.load(data_file)
+      except (EOFError, ValueError, TypeError):
+        if offset < os.fstat(data_file.fileno()).st_size:
+          logging.warning('Ignoring incomplete data at the end of %s', path)
+          data_file.truncate(offset)
+        return
+      yield records
+  finally:
+    data_file.close()
+
+
+class SnapshotLog(object):
+  """The snapshot file of a stub and the log of changes made since.
+
+  Records are queued with Append() and written to the log by Flush(), so
+  that a call making several changes writes them at once. The object is not
+  thread safe; the stub must serialize its use, usually with the lock that
+  protects the data being persisted.
+
+  Public properties:
+    path: Path of the snapshot file.
+    log_path: Path of the log file, path with '.log' appended.
+    log_records: Number of records in the log file.
+  """
+
+  def __init__(self, path):
+    """Constructor.
+
+    Args:
+      path: Path of the snapshot file.
+    """
+    self.path = path
+    self.log_path = path + '.log'
+    self.log_records = 0
+    self._log_file = None
+    self._buffer = []
+
+  def ReadSnapshot(self):
+    """Yields the lists of records in the snapshot file."""
+    return ReadRecords(self.path)
+
+  def ReadLog(self):
+    """Yields the lists of records in the log file, counting them."""
+    for records in ReadRecords(self.log_path):
+      self.log_records += len(records)
+      yield records
+
+  def Open(self):
+    """Opens the log file for appending, once the stub has been restored."""
+    self._log_file = open(self.log_path, 'ab')
+
+  def Append(self, record):
+    """Queues a record to be written to the log by the next Flush()."""
+    self._buffer.append(record)
+
+  def Flush(self):
+    """Writes the queued records to the log.
+
+    Returns:
+      True if any records were written.
+    """
+    if not self._buffer:
+      return False
+    marshal.dump(self._buffer, self._log_file)
+    self._log_file.flush()
+    self.log_records += len(self._buffer)
+    self._buffer = []
+    return True
+
+  def NeedsCompaction(self, snapshot_records):
+    """Returns whether the log has grown longer than a new snapshot would be.
+
+    Args:
+      snapshot_records: The number of records a new snapshot would hold.
+    """
+    return (self.log_records > MIN_LOG_RECORDS_TO_COMPACT and
+            self.log_records > snapshot_records)
+
+  def WriteSnapshot(self, records):
+    """Replaces the snapshot file with the given records and empties the log.
+
+    The snapshot is written to a temporary file that is then renamed over
+    the old one, so that a process dying partway leaves the old snapshot and
+    log in place.
+
+    Args:
+      records: Iterable of all the records of the new snapshot.
+    """
+    temp_path = self.path + '.tmp'
+    snapshot_file = open(temp_path, 'wb')
+    try:
+      batch = []
+      for record in records:
+        batch.append(record)
+        if len(batch) >= SNAPSHOT_BATCH_SIZE:
+          marshal.dump(batch, snapshot_file)
+          batch = []
+      if batch:
+        marshal.dump(batch, snapshot_file)
+    finally:
+      snapshot_file.close()
+    try:
+      os.rename(temp_path, self.path)
+    except OSError:
+      os.remove(self.path)
+      os.rename(temp_path, self.path)
+
+    self._log_file.close()
+    self._log_file = open(self.log_path, 'wb')
+    self._buffer = []
+    self.log_records = 0
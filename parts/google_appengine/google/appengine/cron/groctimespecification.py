@@ -32,6 +32,7 @@ Extensions to be considered:
 """
 
 
+import bisect
 import calendar
 import datetime
 
@@ -45,6 +46,12 @@ import groc
 HOURS = 'hours'
 MINUTES = 'minutes'
 
+MAX_EMPTY_YEARS = 400
+
+_YEAR_CALENDAR_CACHE_SIZE = 4096
+
+_year_calendars = {}
+
 try:
   from pytz import NonExistentTimeError
   from pytz import AmbiguousTimeError
@@ -57,6 +64,14 @@ except ImportError:
     pass
 
 
+def _Bits(values):
+  """Returns an int with bit n set for each integer n in values."""
+  bits = 0
+  for value in values:
+    bits |= 1 << value
+  return bits
+
+
 def GrocTimeSpecification(schedule):
   """Factory function.
 
@@ -180,13 +195,18 @@ class SpecificTimeSpecification(TimeSpecification):
 
   In this case, ordinals would be {1,3}, weekdays {0,6}, months {1,2,3} and
   time would be '09:15'.
+
+  The sets are also kept as bitsets, and the days of a year that match them
+  are computed once and kept in a calendar shared by all specifications with
+  the same days, so finding the next matches is a binary search followed by
+  a walk along that calendar.
   """
 
   timezone = None
 
   def __init__(self, ordinals=None, weekdays=None, months=None, monthdays=None,
                timestr='00:00', timezone=None):
-    super(SpecificTimeSpecification, self).__init__(self)
+    super(SpecificTimeSpecification, self).__init__()
     if weekdays and monthdays:
       raise ValueError('cannot supply both monthdays and weekdays')
     if ordinals is None:
@@ -217,6 +237,11 @@ class SpecificTimeSpecification(TimeSpecification):
         raise ValueError('need pytz in order to specify a timezone')
       self.timezone = pytz.timezone(timezone)
 
+    self._month_bits = _Bits(self.months)
+    self._weekday_bits = _Bits(self.weekdays)
+    self._ordinal_bits = _Bits(self.ordinals)
+    self._monthday_bits = _Bits(self.monthdays)
+
   def _MatchingDays(self, year, month):
     """Returns matching days for the given year and month.
 
@@ -233,93 +258,120 @@ class SpecificTimeSpecification(TimeSpecification):
       a list of matching days, as ints in range 1-31
     """
     start_day, last_day = calendar.monthrange(year, month)
-    if self.monthdays:
-      return sorted([day for day in self.monthdays if day <= last_day])
+    if self._monthday_bits:
+      return [day for day in xrange(1, last_day + 1)
+              if self._monthday_bits >> day & 1]
 
-    out_days = []
     start_day = (start_day + 1) % 7
-    for ordinal in self.ordinals:
-      for weekday in self.weekdays:
-        day = ((weekday - start_day) % 7) + 1
-        day += 7 * (ordinal - 1)
-        if day <= last_day:
-          out_days.append(day)
-    return sorted(out_days)
+    return [day for day in xrange(1, last_day + 1)
+            if (self._weekday_bits >> ((start_day + day - 1) % 7) & 1 and
+                self._ordinal_bits >> ((day - 1) // 7 + 1) & 1)]
+
+  def _YearCalendar(self, year):
+    """Returns the days of a year that match the schedule.
+
+    The result is shared with other instances that match the same days, and
+    must not be modified.
 
-  def _NextMonthGenerator(self, start, matches):
-    """Creates a generator that produces results from the set 'matches'.
+    Arguments:
+      year: the year as an integer
 
-    Matches must be >= 'start'. If none match, the wrap counter is incremented,
-    and the result set is reset to the full set. Yields a 2-tuple of (match,
-    wrapcount).
+    Returns:
+      a sorted list of the proleptic Gregorian ordinals of the matching days
+    """
+    key = (self._month_bits, self._weekday_bits, self._ordinal_bits,
+           self._monthday_bits, year)
+    days = _year_calendars.get(key)
+    if days is None:
+      if len(_year_calendars) >= _YEAR_CALENDAR_CACHE_SIZE:
+        _year_calendars.clear()
+      days = []
+      for month in xrange(1, 13):
+        if self._month_bits >> month & 1:
+          month_start = datetime.date(year, month, 1).toordinal() - 1
+          days.extend([month_start + day
+                       for day in self._MatchingDays(year, month)])
+      _year_calendars[key] = days
+    return days
+
+  def _Localize(self, out):
+    """Converts a match from the schedule's timezone to UTC.
 
     Arguments:
-      start: first set of matches will be >= this value (an int)
-      matches: the set of potential matches (a sequence of ints)
+      out: a naive datetime in the schedule's timezone
 
-    Yields:
-      a two-tuple of (match, wrap counter). match is an int in range (1-12),
-      wrapcount is a int indicating how many times we've wrapped around.
+    Returns:
+      a UTC datetime, moved forward out of any gap caused by a DST change
     """
-    potential = matches = sorted(matches)
-    after = start - 1
-    wrapcount = 0
-    while True:
-      potential = [x for x in potential if x > after]
-      if not potential:
-        wrapcount += 1
-        potential = matches
-      after = potential[0]
-      yield (after, wrapcount)
+    try:
+      out = self.timezone.localize(out, is_dst=None)
+    except AmbiguousTimeError:
+      out = self.timezone.localize(out)
+    except NonExistentTimeError:
+      for _ in range(24):
+        out = out.replace(minute=1) + datetime.timedelta(minutes=60)
+        try:
+          out = self.timezone.localize(out)
+        except NonExistentTimeError:
+          continue
+        break
+    return out.astimezone(pytz.utc)
 
-  def GetMatch(self, start):
-    """Returns the next time that matches the schedule after time start.
+  def GetMatches(self, start, n):
+    """Returns the next n times that match the schedule, starting at time start.
 
     Arguments:
       start: a UTC datetime to start from. Matches will start after this time
+      n:     the number of matching times to return
 
     Returns:
-      a datetime object
+      a list of n datetime objects
+
+    Raises:
+      ValueError: if the schedule matches no day in MAX_EMPTY_YEARS years.
     """
     start_time = start
-    if self.timezone and pytz is not None:
+    localize = self.timezone and pytz is not None
+    if localize:
       if not start_time.tzinfo:
         start_time = pytz.utc.localize(start_time)
       start_time = start_time.astimezone(self.timezone)
       start_time = start_time.replace(tzinfo=None)
-    if self.months:
-      months = self._NextMonthGenerator(start_time.month, self.months)
-    while True:
-      month, yearwraps = months.next()
-      candidate_month = start_time.replace(day=1, month=month,
-                                           year=start_time.year + yearwraps)
-
-      day_matches = self._MatchingDays(candidate_month.year, month)
-
-      if ((candidate_month.year, candidate_month.month)
-          == (start_time.year, start_time.month)):
-        day_matches = [x for x in day_matches if x >= start_time.day]
-        while (day_matches and day_matches[0] == start_time.day
-               and start_time.time() >= self.time):
-          day_matches.pop(0)
-      while day_matches:
-        out = candidate_month.replace(day=day_matches[0], hour=self.time.hour,
-
-
-                                      minute=self.time.minute, second=0,
-                                      microsecond=0)
-        if self.timezone and pytz is not None:
-          try:
-            out = self.timezone.localize(out, is_dst=None)
-          except AmbiguousTimeError:
-            out = self.timezone.localize(out)
-          except NonExistentTimeError:
-            for _ in range(24):
-              out = out.replace(minute=1) + datetime.timedelta(minutes=60)
-              try:
-                out = self.timezone.localize(out)
-              except NonExistentTimeError:
-                continue
-              break
-          out = out.astimezone(pytz.utc)
-        return out
+
+    first_day = start_time.toordinal()
+    if start_time.time() >= self.time:
+      first_day += 1
+    year = datetime.date.fromordinal(first_day).year
+    match_time = self.time.replace(tzinfo=start_time.tzinfo)
+    combine = datetime.datetime.combine
+    fromordinal = datetime.date.fromordinal
+
+    out = []
+    empty_years = 0
+    while len(out) < n:
+      days = self._YearCalendar(year)
+      if days:
+        empty_years = 0
+      else:
+        empty_years += 1
+        if empty_years > MAX_EMPTY_YEARS:
+          raise ValueError('schedule does not match any day')
+      first = bisect.bisect_left(days, first_day)
+      matches = [combine(fromordinal(day), match_time)
+                 for day in days[first:first + n - len(out)]]
+      if localize:
+        matches = [self._Localize(match) for match in matches]
+      out.extend(matches)
+      year += 1
+    return out
+
+  def GetMatch(self, start):
+    """Returns the next time that matches the schedule after time start.
+
+    Arguments:
+      start: a UTC datetime to start from. Matches will start after this time
+
+    Returns:
+      a datetime object
+    """
+    return self.GetMatches(start, 1)[0]
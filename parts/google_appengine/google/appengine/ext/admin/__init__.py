@@ -61,6 +61,8 @@ from google.appengine.ext import db
 from google.appengine.ext import webapp
 from google.appengine.ext.webapp import template
 
+from django.utils import simplejson
+
 _DEBUG = True
 
 
@@ -301,6 +303,19 @@ class QueuesPageHandler(BaseRequestHandler):
     self.redirect(self.request.path_url)
 
 
+class QueueStatsHandler(BaseRequestHandler):
+  """Returns the running statistics of the task queues as JSON."""
+  PATH = '/queues/stats'
+
+  def __init__(self):
+    self.stub = apiproxy_stub_map.apiproxy.GetStub('taskqueue')
+
+  def get(self):
+    """Writes the list returned by the stub's GetQueueStats()."""
+    self.response.headers['Content-Type'] = 'application/json'
+    self.response.out.write(simplejson.dumps(self.stub.GetQueueStats()))
+
+
 class TasksPageHandler(BaseRequestHandler):
   """Shows information about a queue's tasks."""
 
@@ -1346,6 +1361,7 @@ def main():
     ('.*' + InteractiveExecuteHandler.PATH, InteractiveExecuteHandler),
     ('.*' + MemcachePageHandler.PATH, MemcachePageHandler),
     ('.*' + ImageHandler.PATH, ImageHandler),
+    ('.*' + QueueStatsHandler.PATH, QueueStatsHandler),
     ('.*' + QueuesPageHandler.PATH, QueuesPageHandler),
     ('.*' + TasksPageHandler.PATH, TasksPageHandler),
     ('.*' + XMPPPageHandler.PATH, XMPPPageHandler),
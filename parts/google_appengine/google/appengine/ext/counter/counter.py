@@ -0,0 +1,297 @@
+#!/usr/bin/env python
+#
+# Copyright 2007 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""Sharded counters that aggregate increments in memcache.
+
+Updating one datastore entity on every hit limits a counter to a few updates
+per second, and the usual workaround, memcache.incr() followed by a deferred
+datastore write, easily loses or double counts updates. This module does it
+once for everyone:
+
+  from google.appengine.ext import counter
+
+  counter.incr('hits')
+  counter.incr_multi({'hits': 1, 'bytes': len(body)})
+  print counter.get_count('hits')
+
+An increment goes to one of MEMCACHE_SHARDS memcache counters for its name,
+chosen at random, so that concurrent increments do not all update the same
+memcache key; negative increments go to a second set of counters, since
+memcache counters cannot go below zero. The first increment of a name in
+each FLUSH_SECONDS interval defers a task that flushes the name at the end of
+the interval. The flush claims each pending delta by resetting its memcache
+counter with a compare-and-set, so that increments made since it was read are
+left for the next flush, and adds the claimed deltas to one of
+DATASTORE_SHARDS datastore entities for the name in a transaction. If the
+transaction fails, the deltas are put back and the task is retried.
+
+get_count() and get_counts() add up the datastore shards and the pending
+deltas, and cache the total in memcache for CACHE_SECONDS.
+
+Deltas that memcache evicts before they are flushed are lost, as are deltas
+claimed by a flush that dies before it stores them, so counts can be slightly
+low. Use these counters where that is acceptable, such as for page views.
+
+The flushes are run by the deferred library, so its handler must be set up;
+see google.appengine.ext.deferred. The flushes of all the names incremented
+in a request wrapped with deferred.batch_wsgi_middleware() are sent as a
+single task.
+"""
+
+
+
+
+
+import logging
+import random
+import time
+
+from google.appengine.api import memcache
+from google.appengine.ext import db
+from google.appengine.ext import deferred
+
+
+MEMCACHE_SHARDS = 16
+DATASTORE_SHARDS = 8
+FLUSH_SECONDS = 10
+CACHE_SECONDS = 1
+
+_KEY_PREFIX = "__counter__:"
+
+_flush_due = {}
+_next_prune = 0
+
+
+class _CounterShard(db.Model):
+  """Part of the flushed count of a counter."""
+  name = db.StringProperty(required=True)
+  count = db.IntegerProperty(required=True, default=0)
+
+
+def _delta_keys(name):
+  """Returns the memcache keys of all the pending deltas of a counter."""
+  return (["+%d:%s" % (i, name) for i in xrange(MEMCACHE_SHARDS)] +
+          ["-%d:%s" % (i, name) for i in xrange(MEMCACHE_SHARDS)])
+
+
+def _delta_value(key, value):
+  """Returns the signed delta stored in memcache under a delta key."""
+  if key.startswith("-"):
+    return -int(value)
+  return int(value)
+
+
+def _shard_key_names(name):
+  """Returns the key names of the datastore shards of a counter."""
+  return ["%d:%s" % (i, name) for i in xrange(DATASTORE_SHARDS)]
+
+
+def incr(name, delta=1):
+  """Adds to a counter.
+
+  Args:
+    name: The name of the counter.
+    delta: The integer to add, which may be negative.
+  """
+  incr_multi({name: delta})
+
+
+def incr_multi(mapping):
+  """Adds to several counters with a single memcache call.
+
+  Args:
+    mapping: Dictionary mapping counter names to the integers to add to them.
+  """
+  offsets = {}
+  for name, delta in mapping.iteritems():
+    if not isinstance(delta, (int, long)):
+      raise TypeError("delta must be an integer; found %r" % (delta,))
+    shard = random.randrange(MEMCACHE_SHARDS)
+    if delta > 0:
+      offsets["+%d:%s" % (shard, name)] = delta
+    elif delta < 0:
+      offsets["-%d:%s" % (shard, name)] = -delta
+  if not offsets:
+    return
+  results = memcache.offset_multi(offsets, key_prefix=_KEY_PREFIX,
+                                  initial_value=0)
+  failed = [key for key, value in results.iteritems() if value is None]
+  if failed:
+    logging.warning("Could not add to counters in memcache: %s",
+                    ", ".join(failed))
+  _schedule_flush([name for name, delta in mapping.iteritems() if delta])
+
+
+def _schedule_flush(names):
+  """Defers a flush of counters unless one is already due.
+
+  A memcache key per name, expiring when the flush runs, marks the names
+  whose flush has been deferred. Names this process deferred a flush for are
+  also remembered until the flush runs, which saves checking the marker on
+  every increment of a hot counter.
+  """
+  now = time.time()
+  _prune_flush_due(now)
+  markers = dict(("f:" + name, name) for name in names
+                 if _flush_due.get(name, 0) <= now)
+  if not markers:
+    return
+  not_added = memcache.add_multi(dict((marker, 1) for marker in markers),
+                                 time=FLUSH_SECONDS, key_prefix=_KEY_PREFIX)
+  for marker in not_added:
+    del markers[marker]
+  if not markers:
+    return
+  try:
+    deferred.defer(_flush, *sorted(markers.itervalues()),
+                   **{"_countdown": FLUSH_SECONDS})
+  except:
+    memcache.delete_multi(markers.keys(), key_prefix=_KEY_PREFIX)
+    raise
+  for name in markers.itervalues():
+    _flush_due[name] = now + FLUSH_SECONDS
+
+
+def _prune_flush_due(now):
+  """Forgets the names whose flush has run, at most once per FLUSH_SECONDS.
+
+  Keeps _flush_due down to the names incremented in the last two intervals,
+  however many different names the process increments over its life.
+  """
+  global _next_prune
+  if now < _next_prune:
+    return
+  _next_prune = now + FLUSH_SECONDS
+  for name, due in _flush_due.items():
+    if due <= now:
+      _flush_due.pop(name, None)
+
+
+@deferred.batchable(key=lambda *names: names)
+def _flush(calls):
+  """Flushes the counters named in a batch of deferred calls."""
+  names = set()
+  for call in calls:
+    names.update(call)
+  flush(names)
+
+
+def flush(names):
+  """Moves the pending deltas of counters from memcache to the datastore.
+
+  Normally called by the task deferred by incr(), but can be called directly,
+  e.g. before reading the datastore shards in a test.
+
+  Args:
+    names: Iterable of counter names.
+  """
+  names = list(names)
+  keys = []
+  for name in names:
+    keys.extend(_delta_keys(name))
+  client = memcache.Client()
+  values = client.get_multi(keys, key_prefix=_KEY_PREFIX, for_cas=True)
+  pending = dict((key, value) for key, value in values.iteritems()
+                 if int(value))
+  if not pending:
+    return
+  not_claimed = set(client.cas_multi(dict((key, 0) for key in pending),
+                                     key_prefix=_KEY_PREFIX))
+
+  claimed = {}
+  for key, value in pending.iteritems():
+    name = key.split(":", 1)[1]
+    if key in not_claimed:
+      continue
+    claimed.setdefault(name, {})[key] = int(value)
+
+  if not_claimed:
+    _schedule_flush(list(set(key.split(":", 1)[1] for key in not_claimed)))
+
+  claimed_names = claimed.keys()
+  for i, name in enumerate(claimed_names):
+    deltas = claimed[name]
+    total = sum(_delta_value(key, value) for key, value in deltas.iteritems())
+    if not total:
+      continue
+    key_name = "%d:%s" % (random.randrange(DATASTORE_SHARDS), name)
+    try:
+      db.run_in_transaction(_add_to_shard, key_name, name, total)
+    except:
+      unstored = {}
+      for unstored_name in claimed_names[i:]:
+        unstored.update(claimed[unstored_name])
+      memcache.offset_multi(unstored, key_prefix=_KEY_PREFIX, initial_value=0)
+      raise
+
+
+def _add_to_shard(key_name, name, delta):
+  """Adds to a datastore shard of a counter. Runs in a transaction."""
+  shard = _CounterShard.get_by_key_name(key_name)
+  if shard is None:
+    shard = _CounterShard(key_name=key_name, name=name)
+  shard.count += delta
+  shard.put()
+
+
+def get_count(name):
+  """Returns the current value of a counter; see get_counts()."""
+  return get_counts([name])[name]
+
+
+def get_counts(names):
+  """Gets the current values of counters.
+
+  Each value is the sum of the counter's datastore shards and its pending
+  deltas in memcache. Values are cached in memcache for CACHE_SECONDS, so
+  they may leave out the latest increments.
+
+  Args:
+    names: Iterable of counter names.
+
+  Returns:
+    A dictionary mapping each name to the value of its counter, 0 for
+    counters that have never been incremented.
+  """
+  names = list(names)
+  cached = memcache.get_multi(["t:" + name for name in names],
+                              key_prefix=_KEY_PREFIX)
+  counts = dict((name, cached["t:" + name]) for name in names
+                if "t:" + name in cached)
+  missing = [name for name in names if name not in counts]
+  if not missing:
+    return counts
+
+  key_names = []
+  shard_names = []
+  keys = []
+  for name in missing:
+    counts[name] = 0
+    key_names.extend(_shard_key_names(name))
+    shard_names.extend([name] * DATASTORE_SHARDS)
+    keys.extend(_delta_keys(name))
+  shards = _CounterShard.get_by_key_name(key_names)
+  for name, shard in zip(shard_names, shards):
+    if shard is not None:
+      counts[name] += shard.count
+  for key, value in memcache.get_multi(keys,
+                                       key_prefix=_KEY_PREFIX).iteritems():
+    counts[key.split(":", 1)[1]] += _delta_value(key, value)
+
+  memcache.set_multi(dict(("t:" + name, counts[name]) for name in missing),
+                     time=CACHE_SECONDS, key_prefix=_KEY_PREFIX)
+  return counts
@@ -49,12 +49,37 @@ manipulation. Alternately, you can include deferred.TaskHandler in your own
 webapp application instead of using the easy-install method detailed below.
 
 When you create a deferred task using deferred.defer, the task is serialized,
-and an attempt is made to add it directly to the task queue. If the task is too
-big (larger than about 10 kilobytes when serialized), a datastore entry will be
-created for the task, and a new task will be enqueued, which will fetch the
-original task from the datastore and execute it. This is much less efficient
-than the direct execution model, so it's a good idea to minimize the size of
-your tasks when possible.
+and compressed with zlib if that makes it smaller. If the result fits in a task
+(about 10 kilobytes), it is added directly to the task queue. Otherwise, a
+datastore entry will be created for the task, and a new task will be enqueued,
+which will fetch the original task from the datastore and execute it. This is
+much less efficient than the direct execution model, so it's a good idea to
+minimize the size of your tasks when possible.
+
+A callable can also be registered under a short name, which is then sent in
+place of the pickled reference to the callable:
+
+  deferred.register(do_something_later, "dsl")
+
+The callable must be registered in the process that runs the task as well, so
+register it in the module that defines it, and make sure that module is
+imported by the handler before tasks for it arrive.
+
+A callable marked as batchable is always called with a list of the argument
+tuples of one or more deferred calls, and may not take keyword arguments:
+
+  @deferred.batchable(key=lambda counter_key: counter_key)
+  def update_counters(calls):
+    for (counter_key,) in calls:
+      ...
+
+Inside a request wrapped with batch_wsgi_middleware(), or between
+start_batching() and flush_batches(), deferring a batchable callable only
+records the call. At the end, the calls for each callable and set of task
+options are enqueued together as a few tasks, each running the callable once
+with up to max_batch_size calls. If a key function is given, a later call
+with the same key replaces the earlier one. Outside batching, and for named or
+transactional calls, each deferred call is sent as a list of one.
 
 In order for tasks to be processed, you need to set up the handler. Add the
 following to your app.yaml handlers section:
@@ -87,7 +112,9 @@ Example usage:
 import logging
 import os
 import pickle
+import threading
 import types
+import zlib
 
 from google.appengine.api.labs import taskqueue
 from google.appengine.ext import db
@@ -99,6 +126,15 @@ _TASKQUEUE_HEADERS = {"Content-Type": "application/octet-stream"}
 _DEFAULT_URL = "/_ah/queue/deferred"
 _DEFAULT_QUEUE = "default"
 
+_COMPRESSED_FLAG = "\x00"
+_MIN_COMPRESS_BYTES = 128
+
+DEFAULT_MAX_BATCH_SIZE = 500
+
+_registry = {}
+_registered_names = {}
+_batchable = {}
+
 
 class Error(Exception):
   """Base class for exceptions in this module."""
@@ -108,20 +144,85 @@ class PermanentTaskFailure(Error):
   """Indicates that a task failed, and will never succeed."""
 
 
+class UnknownCallableError(Error):
+  """A task names a callable that has not been registered in this process."""
+
+
+def register(obj, name=None):
+  """Registers a callable under a short name to use in serialized tasks.
+
+  Tasks for a registered callable carry its name instead of a pickled
+  reference to it. The callable must be registered under the same name in the
+  process that runs the task.
+
+  Args:
+    obj: The callable to register. See the module docstring for restrictions.
+    name: The name to register it under. Defaults to obj.__name__.
+  Returns:
+    obj, so that register can be used as a decorator.
+  Raises:
+    ValueError: If the name is already registered for another callable.
+  """
+  if name is None:
+    name = obj.__name__
+  if _registry.get(name, obj) is not obj:
+    raise ValueError("A different callable is registered as %r" % name)
+  _registry[name] = obj
+  _registered_names[obj] = name
+  return obj
+
+
+def batchable(func=None, key=None, max_batch_size=DEFAULT_MAX_BATCH_SIZE):
+  """Marks a callable as taking a list of deferred calls; see module docstring.
+
+  Can be used as @batchable or as @batchable(key=..., max_batch_size=...).
+
+  Args:
+    func: The callable to mark. It must take a single list of argument tuples.
+    key: Optional function that is passed the arguments of a deferred call
+      and returns a hashable key. While batching, a call replaces an earlier
+      call with the same key.
+    max_batch_size: The most calls passed to a single invocation.
+  Returns:
+    func, or a decorator if func is not given.
+  """
+  if func is None:
+    return lambda func: batchable(func, key, max_batch_size)
+  _batchable[func] = (key, max_batch_size)
+  return func
+
+
+def _get_batch_options(obj):
+  """Returns the (key, max_batch_size) of a batchable callable, else None."""
+  try:
+    return _batchable.get(obj)
+  except TypeError:
+    return None
+
+
 def run(data):
   """Unpickles and executes a task.
 
   Args:
-    data: A pickled tuple of (function, args, kwargs) to execute.
+    data: A serialized task, as returned by serialize().
   Returns:
     The return value of the function invocation.
+  Raises:
+    UnknownCallableError: If the task names a callable that is not
+      registered in this process.
   """
   try:
+    if data.startswith(_COMPRESSED_FLAG):
+      data = zlib.decompress(data[len(_COMPRESSED_FLAG):])
     func, args, kwds = pickle.loads(data)
   except Exception, e:
     raise PermanentTaskFailure(e)
-  else:
-    return func(*args, **kwds)
+  if isinstance(func, basestring):
+    if func not in _registry:
+      raise UnknownCallableError(
+          "No callable is registered as %r in this process" % func)
+    func = _registry[func]
+  return func(*args, **kwds)
 
 
 class _DeferredTaskEntity(db.Model):
@@ -201,6 +302,10 @@ def _curry_callable(obj, *args, **kwargs):
 def serialize(obj, *args, **kwargs):
   """Serializes a callable into a format recognized by the deferred executor.
 
+  A registered callable is replaced by its name. The pickle is compressed
+  with zlib, and marked with _COMPRESSED_FLAG, if that makes it smaller; no
+  pickle starts with that byte.
+
   Args:
     obj: The callable to serialize. See module docstring for restrictions.
     args: Positional arguments to call the callable with.
@@ -208,8 +313,18 @@ def serialize(obj, *args, **kwargs):
   Returns:
     A serialized representation of the callable.
   """
-  curried = _curry_callable(obj, *args, **kwargs)
-  return pickle.dumps(curried, protocol=pickle.HIGHEST_PROTOCOL)
+  func, args, kwargs = _curry_callable(obj, *args, **kwargs)
+  try:
+    func = _registered_names.get(func, func)
+  except TypeError:
+    pass
+  pickled = pickle.dumps((func, args, kwargs),
+                         protocol=pickle.HIGHEST_PROTOCOL)
+  if len(pickled) >= _MIN_COMPRESS_BYTES:
+    compressed = _COMPRESSED_FLAG + zlib.compress(pickled)
+    if len(compressed) < len(pickled):
+      return compressed
+  return pickled
 
 
 def defer(obj, *args, **kwargs):
@@ -233,15 +348,159 @@ def defer(obj, *args, **kwargs):
   transactional = kwargs.pop("_transactional", False)
   taskargs["headers"] = _TASKQUEUE_HEADERS
   queue = kwargs.pop("_queue", _DEFAULT_QUEUE)
-  pickled = serialize(obj, *args, **kwargs)
+
+  batch_options = _get_batch_options(obj)
+  if batch_options is not None:
+    if kwargs:
+      raise ValueError("Batchable callables take no keyword arguments")
+    if (_batch_state.active and not taskargs["name"] and
+        not transactional):
+      _batch_state.Add(obj, batch_options, args, queue, taskargs)
+      return
+    args, kwargs = ([args],), {}
+
+  task, inline = _make_task(serialize(obj, *args, **kwargs), taskargs)
+  task.add(queue, transactional=transactional and inline)
+
+
+def _make_task(pickled, taskargs):
+  """Creates the Task for a serialized deferred call.
+
+  If the payload does not fit in a task, it is stored in the datastore and
+  the Task runs it from there.
+
+  Args:
+    pickled: The serialized call, as returned by serialize().
+    taskargs: Keyword arguments for the Task constructor.
+  Returns:
+    A tuple (task, inline), where inline is False if the payload was stored
+    in the datastore.
+  """
   try:
-    task = taskqueue.Task(payload=pickled, **taskargs)
-    task.add(queue, transactional=transactional)
+    return taskqueue.Task(payload=pickled, **taskargs), True
   except taskqueue.TaskTooLargeError:
     key = _DeferredTaskEntity(data=pickled).put()
     pickled = serialize(run_from_datastore, str(key))
-    task = taskqueue.Task(payload=pickled, **taskargs)
-    task.add(queue)
+    return taskqueue.Task(payload=pickled, **taskargs), False
+
+
+class _Batch(object):
+  """The calls to one batchable callable with one set of task options."""
+
+  def __init__(self, obj, batch_options, queue, taskargs):
+    self.obj = obj
+    self.key, self.max_batch_size = batch_options
+    self.queue = queue
+    self.taskargs = taskargs
+    self.calls = []
+    self.positions = {}
+
+  def Add(self, args):
+    """Records a call, replacing an earlier call with the same key."""
+    if self.key is None:
+      self.calls.append(args)
+      return
+    call_key = self.key(*args)
+    position = self.positions.get(call_key)
+    if position is None:
+      self.positions[call_key] = len(self.calls)
+      self.calls.append(args)
+    else:
+      self.calls[position] = args
+
+  def Tasks(self):
+    """Returns the Tasks running the recorded calls, in max_batch_size lists."""
+    tasks = []
+    for i in xrange(0, len(self.calls), self.max_batch_size):
+      pickled = serialize(self.obj, self.calls[i:i + self.max_batch_size])
+      tasks.append(_make_task(pickled, self.taskargs)[0])
+    return tasks
+
+
+class _BatchState(threading.local):
+  """Per-thread store of the batchable calls deferred while batching."""
+
+  def __init__(self):
+    self.Clear()
+
+  def Clear(self):
+    """Forgets all recorded calls and stops batching."""
+    self.active = False
+    self.batches = {}
+    self.order = []
+
+  def Add(self, obj, batch_options, args, queue, taskargs):
+    """Records a deferred call in the batch for its callable and options."""
+    batch_key = (obj, queue, taskargs["url"], taskargs["countdown"],
+                 taskargs["eta"])
+    batch = self.batches.get(batch_key)
+    if batch is None:
+      batch = self.batches[batch_key] = _Batch(obj, batch_options, queue,
+                                               taskargs)
+      self.order.append(batch_key)
+    batch.Add(args)
+
+
+_batch_state = _BatchState()
+
+
+def start_batching():
+  """Starts recording deferred calls to batchable callables in this thread."""
+  _batch_state.Clear()
+  _batch_state.active = True
+
+
+def flush_batches():
+  """Enqueues the calls recorded since start_batching() and stops batching.
+
+  The tasks for each queue are added with a single Queue.add() call.
+
+  Raises:
+    taskqueue.BulkAddError if some of the tasks could not be added.
+  """
+  batches = [_batch_state.batches[batch_key]
+             for batch_key in _batch_state.order]
+  _batch_state.Clear()
+  queue_tasks = {}
+  queue_order = []
+  for batch in batches:
+    if batch.queue not in queue_tasks:
+      queue_tasks[batch.queue] = []
+      queue_order.append(batch.queue)
+    queue_tasks[batch.queue].extend(batch.Tasks())
+  for queue in queue_order:
+    taskqueue.Queue(queue).add(queue_tasks[queue])
+
+
+def batch_wsgi_middleware(app):
+  """WSGI middleware that batches deferred calls made during each request.
+
+  The recorded calls are enqueued when the request ends, even if it failed,
+  as they would have been without batching. Install it like any middleware,
+  e.g. in a handler script:
+
+    application = deferred.batch_wsgi_middleware(
+        webapp.WSGIApplication(...))
+  """
+
+  def batch_wsgi_wrapper(environ, start_response):
+    """Calls the wrapped app between start_batching() and flush_batches()."""
+    start_batching()
+    result = None
+    try:
+      result = app(environ, start_response)
+      if result is not None:
+        for value in result:
+          yield value
+    finally:
+      try:
+        close = getattr(result, "close", None)
+        if close is not None:
+          close()
+      finally:
+        flush_batches()
+
+  return batch_wsgi_wrapper
 
 
 class TaskHandler(webapp.RequestHandler):
@@ -88,6 +88,7 @@ from google.appengine.api import blobstore
 from google.appengine.api import croninfo
 from google.appengine.api import datastore_admin
 from google.appengine.api import datastore_file_stub
+from google.appengine.api import datastore_stub_server
 from google.appengine.api import mail
 from google.appengine.api import mail_stub
 from google.appengine.api import urlfetch_stub
@@ -97,6 +98,7 @@ from google.appengine.api.blobstore import blobstore_stub
 from google.appengine.api.blobstore import file_blob_storage
 from google.appengine.api.capabilities import capability_stub
 from google.appengine.api.labs.taskqueue import taskqueue_stub
+from google.appengine.api.memcache import memcache_cluster_stub
 from google.appengine.api.memcache import memcache_stub
 from google.appengine.api.xmpp import xmpp_service_stub
 
@@ -3484,7 +3486,15 @@ def SetupStubs(app_id, **config):
     login_url: Relative URL which should be used for handling user login/logout.
     blobstore_path: Path to the directory to store Blobstore blobs in.
     datastore_path: Path to the file to store Datastore file stub data in.
+    datastore_server: 'host:port' of a running datastore_stub_server to use
+        instead of a local Datastore file stub.
     history_path: DEPRECATED, No-op.
+    memcache_path: Path to the file to keep memcache data in across restarts,
+        or None to keep it only in memory.
+    memcache_shards: Number of shards to spread memcache keys over; more
+        than one uses a MemcacheClusterStub.
+    taskqueue_path: Path to the file to keep task queue tasks in across
+        restarts, or None to keep them only in memory.
     clear_datastore: If the datastore should be cleared on startup.
     smtp_host: SMTP host used for sending test mail.
     smtp_port: SMTP port.
@@ -3501,7 +3511,11 @@ def SetupStubs(app_id, **config):
   login_url = config['login_url']
   blobstore_path = config['blobstore_path']
   datastore_path = config['datastore_path']
+  datastore_server = config.get('datastore_server', None)
   clear_datastore = config['clear_datastore']
+  memcache_path = config.get('memcache_path', None)
+  memcache_shards = config.get('memcache_shards', 1)
+  taskqueue_path = config.get('taskqueue_path', None)
   require_indexes = config.get('require_indexes', False)
   smtp_host = config.get('smtp_host', None)
   smtp_port = config.get('smtp_port', 25)
@@ -3514,7 +3528,7 @@ def SetupStubs(app_id, **config):
 
   os.environ['APPLICATION_ID'] = app_id
 
-  if clear_datastore:
+  if clear_datastore and not datastore_server:
     path = datastore_path
     if os.path.lexists(path):
       logging.info('Attempting to remove file at %s', path)
@@ -3525,9 +3539,13 @@ def SetupStubs(app_id, **config):
 
   apiproxy_stub_map.apiproxy = apiproxy_stub_map.APIProxyStubMap()
 
-  datastore = datastore_file_stub.DatastoreFileStub(
-      app_id, datastore_path, require_indexes=require_indexes,
-      trusted=trusted)
+  if datastore_server:
+    host, port = datastore_server.rsplit(':', 1)
+    datastore = datastore_stub_server.DatastoreClientStub((host, int(port)))
+  else:
+    datastore = datastore_file_stub.DatastoreFileStub(
+        app_id, datastore_path, require_indexes=require_indexes,
+        trusted=trusted)
   apiproxy_stub_map.apiproxy.RegisterStub('datastore_v3', datastore)
 
   fixed_login_url = '%s?%s=%%s' % (login_url,
@@ -3553,9 +3571,13 @@ def SetupStubs(app_id, **config):
                                 enable_sendmail=enable_sendmail,
                                 show_mail_body=show_mail_body))
 
-  apiproxy_stub_map.apiproxy.RegisterStub(
-      'memcache',
-      memcache_stub.MemcacheServiceStub())
+  if memcache_shards > 1:
+    memcache = memcache_cluster_stub.MemcacheClusterStub(
+        shard_count=memcache_shards, persistence_path=memcache_path)
+  else:
+    memcache = memcache_stub.MemcacheServiceStub(
+        persistence_path=memcache_path)
+  apiproxy_stub_map.apiproxy.RegisterStub('memcache', memcache)
 
   apiproxy_stub_map.apiproxy.RegisterStub(
       'capability_service',
@@ -3563,7 +3585,8 @@ def SetupStubs(app_id, **config):
 
   apiproxy_stub_map.apiproxy.RegisterStub(
       'taskqueue',
-      taskqueue_stub.TaskQueueServiceStub(root_path=root_path))
+      taskqueue_stub.TaskQueueServiceStub(root_path=root_path,
+                                          persistence_path=taskqueue_path))
 
   apiproxy_stub_map.apiproxy.RegisterStub(
       'xmpp',
@@ -3766,6 +3789,26 @@ class HTTPServerWithScheduler(BaseHTTPServer.HTTPServer):
         unused_eta, runnable = heapq.heappop(self._events)
         runnable()
 
+  def serve_forever(self):
+    """Handles requests until interrupted, running events as they fall due.
+
+    SocketServer's serve_forever() on Python 2.6 and later only calls
+    get_request() once the socket is readable, so events would never run
+    while the server is idle. This loop waits in get_request() instead, as
+    Python 2.5 does.
+    """
+    while True:
+      try:
+        request, client_address = self.get_request()
+      except socket.error:
+        continue
+      if self.verify_request(request, client_address):
+        try:
+          self.process_request(request, client_address)
+        except:
+          self.handle_error(request, client_address)
+          self.close_request(request)
+
   def AddEvent(self, eta, runnable):
     """Add a runnable event to be run at the specified time.
 
@@ -0,0 +1,299 @@
+#!/usr/bin/env python
+#
+# Copyright 2007 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""Runs the jobs in cron.yaml against the development application server.
+
+A CronScheduler puts the next run of each job on the event heap of an
+HTTPServerWithScheduler. When a run is due, the job's URL is requested on a
+separate thread, so that the server can handle the request, and the following
+run is scheduled.
+
+The scheduler can run on an accelerated clock: with a speedup of 1440, the
+jobs of a simulated day run in one real minute. The requests themselves take
+as long as they take, so a slow job is more likely to still be running when
+its next run comes due as the speedup grows; GetJobStats() reports the
+durations and such overlaps for each job. The development server handles one
+request at a time, so due runs wait while a job's request is being handled.
+
+Like the cron page of the development console, the scheduler ignores the
+timezone of cron entries and treats all schedules as UTC.
+"""
+
+
+
+import datetime
+import logging
+import os
+import threading
+import time
+
+from google.appengine.cron import groctimespecification
+from google.appengine.tools import dev_appserver
+
+CRON_HEADER = 'X-AppEngine-Cron'
+
+
+def LoadCronEntries(root_path):
+  """Reads the cron entries of an application.
+
+  Args:
+    root_path: Path to the root directory of the application.
+
+  Returns:
+    A list of croninfo.CronEntry objects; empty if the application has no
+    cron.yaml file.
+  """
+  for filename in ('cron.yaml', 'cron.yml'):
+    path = os.path.join(root_path, filename)
+    if os.path.isfile(path):
+      cron_info = dev_appserver.ReadCronConfig(path)
+      return cron_info.cron or []
+  return []
+
+
+def _Seconds(delta):
+  """Returns the length of a datetime.timedelta in seconds."""
+  return delta.days * 86400 + delta.seconds + delta.microseconds / 1e6
+
+
+class _CronJob(object):
+  """A cron entry with its parsed schedule and run statistics."""
+
+  def __init__(self, entry):
+    self.url = entry.url
+    self.schedule = entry.schedule
+    self.description = entry.description
+    self.time_spec = groctimespecification.GrocTimeSpecification(
+        entry.schedule)
+    self.running = 0
+    self.runs = 0
+    self.failed = 0
+    self.total_seconds = 0.0
+    self.max_seconds = 0.0
+    self.overlaps = 0
+    self.max_concurrent = 0
+    self.max_lag_seconds = 0.0
+    self.last_run = None
+    self.next_run = None
+
+  def ToDict(self):
+    """Returns the statistics of the job; see CronScheduler.GetJobStats()."""
+    mean_seconds = None
+    if self.runs:
+      mean_seconds = self.total_seconds / self.runs
+    return {
+        'url': self.url,
+        'schedule': self.schedule,
+        'description': self.description,
+        'runs': self.runs,
+        'failed': self.failed,
+        'running': self.running,
+        'mean_seconds': mean_seconds,
+        'max_seconds': self.max_seconds,
+        'overlaps': self.overlaps,
+        'max_concurrent': self.max_concurrent,
+        'max_lag_seconds': self.max_lag_seconds,
+        'last_run': self.last_run,
+        'next_run': self.next_run,
+    }
+
+
+class CronScheduler(object):
+  """Schedules cron jobs on the event heap of an HTTPServerWithScheduler."""
+
+  def __init__(self, server, entries, dispatcher, speedup=1,
+               gettime=time.time):
+    """Constructor.
+
+    Args:
+      server: The HTTPServerWithScheduler whose AddEvent() runs the jobs.
+      entries: List of croninfo.CronEntry objects, e.g. from
+        LoadCronEntries().
+      dispatcher: Callable taking the HTTP method, relative URL, list of
+        (name, value) header tuples and body of a request, and returning the
+        HTTP status code; e.g. a taskqueue_executor.HttpDispatcher.
+      speedup: How many times faster than real time the simulated clock that
+        the schedules are evaluated on runs.
+      gettime: time.time()-like function used for testing.
+    """
+    if speedup <= 0:
+      raise ValueError('speedup must be positive; found %r' % speedup)
+    self._server = server
+    self._jobs = [_CronJob(entry) for entry in entries]
+    self._dispatcher = dispatcher
+    self._speedup = float(speedup)
+    self._gettime = gettime
+    self._lock = threading.Lock()
+    self._running = False
+    self._real_start = None
+    self._simulated_start = None
+
+  def Start(self):
+    """Starts the simulated clock and schedules the first run of each job.
+
+    A job whose schedule never matches is logged and not run.
+    """
+    self._running = True
+    self._real_start = self._gettime()
+    self._simulated_start = datetime.datetime.utcfromtimestamp(
+        self._real_start)
+    for job in self._jobs:
+      try:
+        self._ScheduleAfter(job, self._simulated_start)
+      except ValueError, e:
+        logging.error('Not running cron job %s (%s): %s', job.url,
+                      job.schedule, e)
+
+  def Stop(self):
+    """Stops running jobs and logs their statistics.
+
+    Runs that have already started are not waited for.
+    """
+    self._running = False
+    for stats in self.GetJobStats():
+      logging.info('Cron job %s (%s): %d runs, %d failed, mean %s s, '
+                   'max %.3f s, %d overlaps, %d still running',
+                   stats['url'], stats['schedule'], stats['runs'],
+                   stats['failed'],
+                   stats['mean_seconds'] is not None and
+                   '%.3f' % stats['mean_seconds'] or '-',
+                   stats['max_seconds'], stats['overlaps'], stats['running'])
+
+  def SimulatedNow(self):
+    """Returns the current time on the simulated clock, as a UTC datetime."""
+    return self._ToSimulated(self._gettime())
+
+  def GetJobStats(self):
+    """Gets the statistics of each job.
+
+    Returns:
+      A list with a dictionary for each cron entry, containing its 'url',
+      'schedule' and 'description'; the number of 'runs' finished, the
+      number that 'failed' and the number 'running'; 'mean_seconds' and
+      'max_seconds', the real duration of the runs; 'overlaps', the runs
+      that were still going when the next run came due; 'max_concurrent',
+      the most runs going at once; 'max_lag_seconds', the most real time a
+      run started after it was due; and 'last_run' and 'next_run', simulated
+      UTC datetimes.
+    """
+    self._lock.acquire()
+    try:
+      return [job.ToDict() for job in self._jobs]
+    finally:
+      self._lock.release()
+
+  def _ToSimulated(self, real_time):
+    """Converts seconds since the epoch to a simulated UTC datetime."""
+    return self._simulated_start + datetime.timedelta(
+        seconds=(real_time - self._real_start) * self._speedup)
+
+  def _ToReal(self, simulated_time):
+    """Converts a simulated UTC datetime to seconds since the epoch."""
+    return (self._real_start +
+            _Seconds(simulated_time - self._simulated_start) / self._speedup)
+
+  def _ScheduleAfter(self, job, simulated_time):
+    """Puts the first run of a job after a simulated time on the event heap."""
+    self._Schedule(job, job.time_spec.GetMatch(simulated_time))
+
+  def _Schedule(self, job, match):
+    """Puts a run of a job due at a simulated time on the event heap."""
+    job.next_run = match
+    self._server.AddEvent(self._ToReal(match),
+                          lambda: self._Fire(job, match))
+
+  def _Fire(self, job, match):
+    """Starts a due run of a job and schedules the next one.
+
+    Called by the server's event loop, so errors are logged rather than
+    raised.
+
+    Args:
+      job: The _CronJob to run.
+      match: The simulated time the run was due.
+    """
+    if not self._running:
+      return
+    try:
+      self._FireJob(job, match)
+    except Exception:
+      logging.exception('Failed to run cron job %s (%s) due at %s', job.url,
+                        job.schedule, match)
+
+  def _FireJob(self, job, match):
+    """Implementation of _Fire()."""
+    started = self._gettime()
+    try:
+      next_match = job.time_spec.GetMatch(match)
+    except ValueError, e:
+      logging.error('Not scheduling cron job %s (%s) again: %s', job.url,
+                    job.schedule, e)
+      next_match = None
+      next_due = None
+    else:
+      next_due = self._ToReal(next_match)
+    self._lock.acquire()
+    try:
+      job.running += 1
+      job.max_concurrent = max(job.max_concurrent, job.running)
+      job.max_lag_seconds = max(job.max_lag_seconds,
+                                started - self._ToReal(match))
+      job.last_run = match
+      job.next_run = next_match
+    finally:
+      self._lock.release()
+
+    logging.info('Running cron job %s (%s) due at %s', job.url,
+                 job.schedule, match)
+    thread = threading.Thread(target=self._Run,
+                              args=(job, started, next_due),
+                              name='Cron job %s' % job.url)
+    thread.setDaemon(True)
+    thread.start()
+    if next_match is not None:
+      self._Schedule(job, next_match)
+
+  def _Run(self, job, started, next_due):
+    """Requests a job's URL and records the result. Runs on its own thread.
+
+    Args:
+      job: The _CronJob to run.
+      started: When the run started, in seconds since the epoch.
+      next_due: When the next run of the job is due, in seconds since the
+        epoch, or None if it is not scheduled again.
+    """
+    try:
+      status = self._dispatcher('GET', job.url, [(CRON_HEADER, 'true')], '')
+    except Exception:
+      logging.exception('Cron job %s raised an exception', job.url)
+      status = None
+    finished = self._gettime()
+    seconds = finished - started
+
+    self._lock.acquire()
+    try:
+      job.running -= 1
+      job.runs += 1
+      if next_due is not None and finished > next_due:
+        job.overlaps += 1
+      if status is None or not 200 <= status < 300:
+        job.failed += 1
+        logging.warning('Cron job %s failed with status %s', job.url, status)
+      job.total_seconds += seconds
+      job.max_seconds = max(job.max_seconds, seconds)
+    finally:
+      self._lock.release()
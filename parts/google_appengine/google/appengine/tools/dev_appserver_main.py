@@ -32,10 +32,27 @@ Options:
   --blobstore_path=PATH      Path to use for storing Blobstore file stub data.
   --datastore_path=PATH      Path to use for storing Datastore file stub data.
                              (Default %(datastore_path)s)
+  --datastore_server=HOST:PORT
+                             Use the datastore served by a running
+                             datastore_stub_server instead of a local file
+                             stub. (Default none)
+  --memcache_path=PATH       Keep memcache data in this file so that it
+                             survives restarts. (Default none)
+  --memcache_shards=COUNT    Spread memcache keys over this many in-process
+                             shards by consistent hashing. (Default 1)
+  --taskqueue_path=PATH      Keep task queue tasks in this file so that they
+                             survive restarts. (Default none)
   --history_path=PATH        Path to use for storing Datastore history.
                              (Default %(history_path)s)
   --require_indexes          Disallows queries that require composite indexes
                              not defined in index.yaml.
+  --run_tasks                Run task queue tasks when they are due, at the
+                             rates set in queue.yaml. (Default false)
+  --run_cron                 Run the jobs in cron.yaml on schedule.
+                             (Default false)
+  --cron_speedup=FACTOR      Run the cron schedules on a clock this many times
+                             faster than real time, e.g. 1440 to run a day of
+                             jobs in a minute. (Default 1)
   --smtp_host=HOSTNAME       SMTP host to send test mail to.  Leaving this
                              unset will disable SMTP mail sending.
                              (Default '%(smtp_host)s')
@@ -77,11 +94,16 @@ logging.basicConfig(
     level=logging.INFO,
     format='%(levelname)-8s %(asctime)s %(filename)s:%(lineno)s] %(message)s')
 
+from google.appengine.api import apiproxy_stub_map
+from google.appengine.api import croninfo
 from google.appengine.api import yaml_errors
+from google.appengine.api.labs.taskqueue import taskqueue_executor
 from google.appengine.dist import py_zipimport
 from google.appengine.tools import appcfg
 from google.appengine.tools import appengine_rpc
 from google.appengine.tools import dev_appserver
+from google.appengine.tools import dev_appserver_cron
+from google.appengine.tools import dev_appserver_login
 
 
 
@@ -94,14 +116,21 @@ ARG_AUTH_DOMAIN = 'auth_domain'
 ARG_CLEAR_DATASTORE = 'clear_datastore'
 ARG_BLOBSTORE_PATH = 'blobstore_path'
 ARG_DATASTORE_PATH = 'datastore_path'
+ARG_DATASTORE_SERVER = 'datastore_server'
 ARG_DEBUG_IMPORTS = 'debug_imports'
 ARG_ENABLE_SENDMAIL = 'enable_sendmail'
 ARG_SHOW_MAIL_BODY = 'show_mail_body'
 ARG_HISTORY_PATH = 'history_path'
 ARG_LOGIN_URL = 'login_url'
 ARG_LOG_LEVEL = 'log_level'
+ARG_MEMCACHE_PATH = 'memcache_path'
+ARG_MEMCACHE_SHARDS = 'memcache_shards'
+ARG_TASKQUEUE_PATH = 'taskqueue_path'
 ARG_PORT = 'port'
 ARG_REQUIRE_INDEXES = 'require_indexes'
+ARG_RUN_TASKS = 'run_tasks'
+ARG_RUN_CRON = 'run_cron'
+ARG_CRON_SPEEDUP = 'cron_speedup'
 ARG_ALLOW_SKIPPED_FILES = 'allow_skipped_files'
 ARG_SMTP_HOST = 'smtp_host'
 ARG_SMTP_PASSWORD = 'smtp_password'
@@ -119,6 +148,8 @@ SDK_PATH = os.path.dirname(
              )
            )
 
+TASK_RUNNER_EMAIL = 'taskqueue@localhost'
+
 DEFAULT_ARGS = {
   ARG_PORT: 8080,
   ARG_LOG_LEVEL: logging.INFO,
@@ -126,11 +157,18 @@ DEFAULT_ARGS = {
                                    'dev_appserver.blobstore'),
   ARG_DATASTORE_PATH: os.path.join(tempfile.gettempdir(),
                                    'dev_appserver.datastore'),
+  ARG_DATASTORE_SERVER: None,
   ARG_HISTORY_PATH: os.path.join(tempfile.gettempdir(),
                                  'dev_appserver.datastore.history'),
   ARG_LOGIN_URL: '/_ah/login',
+  ARG_MEMCACHE_PATH: None,
+  ARG_MEMCACHE_SHARDS: 1,
+  ARG_TASKQUEUE_PATH: None,
   ARG_CLEAR_DATASTORE: False,
   ARG_REQUIRE_INDEXES: False,
+  ARG_RUN_TASKS: False,
+  ARG_RUN_CRON: False,
+  ARG_CRON_SPEEDUP: 1.0,
   ARG_TEMPLATE_DIR: os.path.join(SDK_PATH, 'templates'),
   ARG_SMTP_HOST: '',
   ARG_SMTP_PORT: 25,
@@ -189,6 +227,7 @@ def ParseArguments(argv):
         'clear_datastore',
         'blobstore_path=',
         'datastore_path=',
+        'datastore_server=',
         'debug',
         'debug_imports',
         'enable_sendmail',
@@ -196,12 +235,18 @@ def ParseArguments(argv):
         'show_mail_body',
         'help',
         'history_path=',
+        'memcache_path=',
+        'memcache_shards=',
         'port=',
         'require_indexes',
+        'run_tasks',
+        'run_cron',
+        'cron_speedup=',
         'smtp_host=',
         'smtp_password=',
         'smtp_port=',
         'smtp_user=',
+        'taskqueue_path=',
         'template_dir=',
         'trusted',
       ])
@@ -234,15 +279,48 @@ def ParseArguments(argv):
     if option == '--datastore_path':
       option_dict[ARG_DATASTORE_PATH] = os.path.abspath(value)
 
+    if option == '--datastore_server':
+      option_dict[ARG_DATASTORE_SERVER] = value
+
     if option == '--history_path':
       option_dict[ARG_HISTORY_PATH] = os.path.abspath(value)
 
+    if option == '--memcache_path':
+      option_dict[ARG_MEMCACHE_PATH] = os.path.abspath(value)
+
+    if option == '--memcache_shards':
+      try:
+        option_dict[ARG_MEMCACHE_SHARDS] = int(value)
+        if option_dict[ARG_MEMCACHE_SHARDS] < 1:
+          raise ValueError
+      except ValueError:
+        print >>sys.stderr, 'Invalid value supplied for memcache shards'
+        PrintUsageExit(1)
+
+    if option == '--taskqueue_path':
+      option_dict[ARG_TASKQUEUE_PATH] = os.path.abspath(value)
+
     if option in ('-c', '--clear_datastore'):
       option_dict[ARG_CLEAR_DATASTORE] = True
 
     if option == '--require_indexes':
       option_dict[ARG_REQUIRE_INDEXES] = True
 
+    if option == '--run_tasks':
+      option_dict[ARG_RUN_TASKS] = True
+
+    if option == '--run_cron':
+      option_dict[ARG_RUN_CRON] = True
+
+    if option == '--cron_speedup':
+      try:
+        option_dict[ARG_CRON_SPEEDUP] = float(value)
+        if option_dict[ARG_CRON_SPEEDUP] <= 0:
+          raise ValueError
+      except ValueError:
+        print >>sys.stderr, 'Invalid value supplied for cron speedup'
+        PrintUsageExit(1)
+
     if option == '--smtp_host':
       option_dict[ARG_SMTP_HOST] = value
 
@@ -323,6 +401,61 @@ def SigTermHandler(signum, frame):
   raise KeyboardInterrupt()
 
 
+def _CreateAdminDispatcher(serve_address, port):
+  """Creates a dispatcher that sends requests to this server as an admin.
+
+  Args:
+    serve_address: The address the server listens on.
+    port: The port the server listens on.
+
+  Returns:
+    A taskqueue_executor.HttpDispatcher whose requests carry a login cookie
+    for TASK_RUNNER_EMAIL as an administrator, so that handlers restricted
+    to 'login: admin' accept them. A request that gets no response within
+    a task's lease fails, so that it cannot block shutdown.
+  """
+  cookie = '%s=%s' % (dev_appserver_login.COOKIE_NAME,
+                      dev_appserver_login.CreateCookieData(TASK_RUNNER_EMAIL,
+                                                           True))
+  return taskqueue_executor.HttpDispatcher(
+      serve_address or 'localhost', port, extra_headers=[('Cookie', cookie)],
+      timeout=taskqueue_executor.DEFAULT_LEASE_SECONDS)
+
+
+def CreateTaskExecutor(serve_address, port):
+  """Creates a TaskExecutor that runs queued tasks against this server.
+
+  Args:
+    serve_address: The address the server listens on.
+    port: The port the server listens on.
+
+  Returns:
+    A taskqueue_executor.TaskExecutor that has not been started.
+  """
+  stub = apiproxy_stub_map.apiproxy.GetStub('taskqueue')
+  return taskqueue_executor.TaskExecutor(
+      stub, _CreateAdminDispatcher(serve_address, port))
+
+
+def CreateCronScheduler(http_server, root_path, serve_address, port, speedup):
+  """Creates a CronScheduler that runs the app's cron jobs on this server.
+
+  Args:
+    http_server: The HTTPServerWithScheduler the jobs are scheduled on.
+    root_path: Path to the root directory of the application.
+    serve_address: The address the server listens on.
+    port: The port the server listens on.
+    speedup: How much faster than real time the cron clock runs.
+
+  Returns:
+    A dev_appserver_cron.CronScheduler that has not been started.
+  """
+  entries = dev_appserver_cron.LoadCronEntries(root_path)
+  return dev_appserver_cron.CronScheduler(
+      http_server, entries, _CreateAdminDispatcher(serve_address, port),
+      speedup=speedup)
+
+
 def main(argv):
   """Runs the development application server."""
   args, option_dict = ParseArguments(argv)
@@ -393,8 +526,29 @@ def main(argv):
       allow_skipped_files=allow_skipped_files,
       static_caching=static_caching)
 
+  cron_scheduler = None
+  if option_dict[ARG_RUN_CRON]:
+    try:
+      cron_scheduler = CreateCronScheduler(http_server, root_path,
+                                           serve_address, port,
+                                           option_dict[ARG_CRON_SPEEDUP])
+    except (dev_appserver.InvalidAppConfigError,
+            croninfo.MalformedCronfigurationFile,
+            yaml_errors.EventListenerError), e:
+      logging.error('Cron configuration invalid:\n%s', e)
+      http_server.server_close()
+      return 1
+
   signal.signal(signal.SIGTERM, SigTermHandler)
 
+  task_executor = None
+  if option_dict[ARG_RUN_TASKS]:
+    task_executor = CreateTaskExecutor(serve_address, port)
+    task_executor.Start()
+
+  if cron_scheduler:
+    cron_scheduler.Start()
+
   logging.info('Running application %s on port %d: http://%s:%d',
                config.application, port, serve_address, port)
   try:
@@ -408,7 +562,11 @@ def main(argv):
       logging.error('Error encountered:\n%s\nNow terminating.', info_string)
       return 1
   finally:
+    if cron_scheduler:
+      cron_scheduler.Stop()
     http_server.server_close()
+    if task_executor:
+      task_executor.Stop()
 
   return 0
 